@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# Runs donglify's provisioning and update flows end to end and fails when
+# they regress against e2e_baseline.json, in time, subprocess spawns or
+# bytes written to the dongle.
+#
+# Every host path donglify touches is relocated under a temporary
+# DONGLIFY_ROOT. In the default fake mode the external tools are replaced
+# by recording stand-ins on PATH, so the flows run without root or a USB
+# stick. With --real the block device tools run for real against a sparse
+# file on a loop device, only pacman, mkinitcpio and grub-install stay
+# stand-ins so the host system is never touched. --real needs root and
+# must not be used with a dongle plugged in, the mapper names are shared.
+#
+#   python benchmarks/e2e.py                    compare against baseline
+#   python benchmarks/e2e.py --real             same against a loop device
+#   python benchmarks/e2e.py --update-baseline  record a new baseline
+
+import os
+import sys
+import json
+import stat
+import shutil
+import argparse
+import tempfile
+import subprocess
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "..", "src")
+BASELINE = os.path.join(HERE, "e2e_baseline.json")
+
+FAKE_TOOLS = ["parted", "cryptsetup", "mkfs.ext4", "mkfs.vfat", "mount", "umount", "udevadm",
+              "blkid", "chattr", "pacman", "mkinitcpio", "grub-install"]
+# stand-ins even with --real
+HOST_TOOLS = ["pacman", "mkinitcpio", "grub-install"]
+
+DISK_SIZE = 3 * 1024 * 1024 * 1024
+ISO_SIZE = 64 * 1024 * 1024
+
+FAKE_TOOL = r'''#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import hashlib
+
+ROOT = os.environ["DONGLIFY_ROOT"]
+tool = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+
+with open(os.environ["DONGLIFY_FAKE_LOG"], "a") as f:
+    f.write(json.dumps({"tool": tool, "args": args, "time": time.time()}) + "\n")
+
+def write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+
+if tool == "pacman" and args[0] == "-Q":
+    for package in args[1:]:
+        print(f"{package} 6.12.1.arch1-1")
+elif tool == "pacman" and args[0] == "-S":
+    for package in args[1:]:
+        if package.startswith("-") or package == "mkinitcpio":
+            continue
+        if package.endswith("-ucode"):
+            write(f"{ROOT}/boot/{package}.img", 64 * 1024)
+        else:
+            write(f"{ROOT}/boot/vmlinuz-{package}", 12 * 1024 * 1024)
+            write(f"{ROOT}/boot/initramfs-{package}.img", 16 * 1024 * 1024)
+            write(f"{ROOT}/boot/initramfs-{package}-fallback.img", 32 * 1024 * 1024)
+elif tool == "grub-install":
+    options = dict(arg.split("=", 1) for arg in args if "=" in arg)
+    write(f"{options['--efi-directory']}/EFI/BOOT/BOOTX64.EFI", 256 * 1024)
+    write(f"{options['--boot-directory']}/grub/x86_64-efi/normal.mod", 1024 * 1024)
+elif tool == "blkid":
+    print(hashlib.sha256(args[-1].encode()).hexdigest()[:8] + "-0000-0000-0000-000000000000")
+elif tool == "cryptsetup" and args[0] in ("open", "luksFormat") and not sys.stdin.isatty():
+    sys.stdin.read()
+'''
+
+# flows of the child, each one runs in a transaction like a command does
+PHASES = ["provision", "mount", "install", "reinstall-incremental", "grub-config",
+          "iso-import", "iso-add", "unmount"]
+
+
+def snapshot(root):
+    files = {}
+    for top in ["boot", "efi", "mnt/iso"]:
+        for dirpath, _, filenames in os.walk(os.path.join(root, top)):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                files[path] = (st.st_ino, st.st_size, st.st_mtime_ns)
+    return files
+
+
+def sectors_written(dev):
+    with open(f"/sys/block/{os.path.basename(dev)}/stat") as f:
+        return int(f.read().split()[6])
+
+
+def child(mode, root, dev, results_path):
+    # runs in a fresh interpreter with DONGLIFY_ROOT and PATH already set
+    from donglify.lib import unlock_disk, mount_mapper
+    from donglify.config import DongleState, DongleInstallValidator
+    from donglify.dongle import DonglifyState
+    from donglify.partition import DonglePartitions
+    from donglify.fleet import DongleFleet, DongleFleetSpecValidator
+    from donglify.layout import DongleLayout, DongleTopology
+    from donglify import commands
+
+    spawns = [0]
+
+    def audit(event, args):
+        if event == "subprocess.Popen":
+            spawns[0] += 1
+    sys.addaudithook(audit)
+
+    key_file = os.path.join(root, "keyfile")
+    with open(key_file, "w") as f:
+        f.write("donglify-benchmark")
+
+    spec = DongleFleetSpecValidator.validate_python({
+        "devices": [dev], "iso_size": 512, "persistent_size": 1,
+        "mountpoint_root": f"{root}/mnt/donglify"})
+    source = os.path.join(root, "source.iso")
+    with open(source, "wb") as f:
+        f.write(os.urandom(ISO_SIZE))
+
+    if mode == "fake":
+        # mount does nothing in fake mode, the dongle's partitions are plain
+        # directories which provisioning sees under its own mountpoints
+        provision_root = f"{spec.mountpoint_root}/{os.path.basename(dev)}"
+        os.makedirs(provision_root)
+        for part, target in [("boot", "boot"), ("efi", "efi"), ("isos", "mnt/iso")]:
+            os.symlink(f"{root}/{target}", f"{provision_root}/{part}")
+
+    def provision():
+        layout = None
+        if mode == "fake":
+            layout = DongleLayout.plan(DongleTopology(os.path.basename(dev), DISK_SIZE), spec.iso_size,
+                                       spec.persistent_size)
+        config = DongleFleet.provision(dev, spec, key_file, None, {}, {}, {}, lambda *_: None, layout)
+        # mount_all asks for the passphrase, unlock with the key file first
+        unlock_disk(DonglePartitions.partition(dev, 2), "dongleboot", key_file=key_file)
+        mount_mapper("dongleboot", f"{root}/boot")
+        DongleState.assume_yes = True
+        DonglifyState.read(review=True)
+        return config
+
+    def install():
+        DonglifyState.installs["bench"] = DongleInstallValidator.validate_python({
+            "kernel_name": "linux", "kernel_args": "quiet", "kernel_version": "", "cryptokeyfile": "",
+            "hooks_added": "", "ucode": "amd-ucode"})
+        commands.dongle_install_system("bench")
+
+    # setup of a phase, not measured
+    prepare = {
+        "iso-add": lambda: shutil.copy(source, f"{root}/mnt/iso/second.iso"),
+    }
+
+    flows = {
+        "provision": provision,
+        "mount": DonglifyState.mount_all,
+        "install": install,
+        "reinstall-incremental": lambda: commands.dongle_install_system("bench", incremental=True),
+        "grub-config": DonglifyState.config_install,
+        "iso-import": lambda: commands.dongle_iso_import(source, "bench-iso", "/boot/grub/loopback.cfg",
+                                                         "loopback"),
+        "iso-add": lambda: commands.dongle_iso_add("second", "second.iso", "/boot/grub/loopback.cfg",
+                                                   "loopback"),
+        "unmount": DonglifyState.umount_all,
+    }
+
+    results = {}
+    for phase in PHASES:
+        if phase in prepare:
+            prepare[phase]()
+        before = snapshot(root) if mode == "fake" else sectors_written(dev)
+        spawns[0] = 0
+        start = time.perf_counter()
+        if phase == "provision":
+            flows[phase]()
+        else:
+            with DonglifyState.transaction():
+                flows[phase]()
+        elapsed = (time.perf_counter() - start) * 1000
+        count = spawns[0]
+
+        if mode == "fake":
+            after = snapshot(root)
+            # counted by inode, renames and hardlinks to unchanged data write nothing
+            unchanged = set(before.values())
+            written = sum({st[0]: st[1] for st in after.values() if st not in unchanged}.values())
+        else:
+            os.sync()
+            written = (sectors_written(dev) - before) * 512
+        results[phase] = {"ms": round(elapsed, 1), "spawns": count, "bytes": written}
+
+    with open(results_path, "w") as f:
+        json.dump(results, f)
+
+
+def setup_root(root, mode):
+    for path in ["boot", "efi", "mnt/iso", "etc/default", "etc/initcpio/install"]:
+        os.makedirs(os.path.join(root, path), exist_ok=True)
+    with open(os.path.join(root, "etc/default/grub"), "w") as f:
+        f.write("GRUB_TIMEOUT=5\n")
+
+    bindir = os.path.join(root, "bin")
+    os.makedirs(bindir)
+    tool_path = os.path.join(bindir, "fake-tool")
+    with open(tool_path, "w") as f:
+        f.write(FAKE_TOOL)
+    os.chmod(tool_path, os.stat(tool_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    for tool in FAKE_TOOLS if mode == "fake" else HOST_TOOLS:
+        os.symlink(tool_path, os.path.join(bindir, tool))
+    return bindir
+
+
+def measure(mode):
+    with tempfile.TemporaryDirectory(prefix="donglify-e2e-") as root:
+        bindir = setup_root(root, mode)
+        log = os.path.join(root, "fake-tools.jsonl")
+
+        loop = None
+        if mode == "real":
+            image = os.path.join(root, "dongle.img")
+            with open(image, "wb") as f:
+                f.truncate(DISK_SIZE)
+            loop = subprocess.run(["losetup", "-fP", "--show", image], check=True,
+                                  capture_output=True).stdout.decode().strip()
+            dev = loop
+        else:
+            dev = "/dev/donglify-fake"
+
+        env = dict(os.environ, DONGLIFY_ROOT=root, DONGLIFY_FAKE_LOG=log,
+                   PATH=bindir + os.pathsep + os.environ.get("PATH", ""),
+                   PYTHONPATH=SRC + os.pathsep + os.environ.get("PYTHONPATH", ""))
+        results_path = os.path.join(root, "results.json")
+        try:
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode, root, dev,
+                                   results_path], env=env, stdin=subprocess.DEVNULL, capture_output=True)
+        finally:
+            if loop is not None:
+                subprocess.run(["umount", "-R", f"{root}/boot", f"{root}/efi", f"{root}/mnt/iso"],
+                               capture_output=True)
+                subprocess.run(["cryptsetup", "close", "dongleboot"], capture_output=True)
+                subprocess.run(["losetup", "-d", loop], capture_output=True)
+
+        if proc.returncode != 0:
+            sys.stdout.write(proc.stdout.decode(errors="replace"))
+            sys.stderr.write(proc.stderr.decode(errors="replace"))
+            raise SystemExit(f"{mode} run failed with returncode {proc.returncode}")
+
+        with open(results_path) as f:
+            results = json.load(f)
+        tools = {}
+        if os.path.exists(log):
+            with open(log) as f:
+                for line in f:
+                    tool = json.loads(line)["tool"]
+                    tools[tool] = tools.get(tool, 0) + 1
+        return results, tools
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--real", action="store_true", help="run against a loop device, needs root")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed relative slowdown over the baseline")
+    parser.add_argument("--slack", type=float, default=50.0,
+                        help="allowed absolute slowdown in ms, absorbs noise on fast phases")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--child", nargs=4, metavar=("MODE", "ROOT", "DEV", "RESULTS"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    mode = "real" if args.real else "fake"
+    if mode == "real" and os.geteuid() != 0:
+        raise SystemExit("--real needs root for losetup, cryptsetup and mount")
+
+    results, tools = measure(mode)
+
+    baselines = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baselines = json.load(f)
+    if args.update_baseline:
+        baselines[mode] = results
+        with open(BASELINE, "w") as f:
+            json.dump(baselines, f, indent=2)
+            f.write("\n")
+        print(f"wrote {BASELINE}")
+    baseline = baselines.get(mode, {})
+
+    failures = []
+    print(f'{"phase":<24}{"ms":>9}{"base":>9}{"spawns":>8}{"base":>6}{"MiB":>9}{"base":>9}')
+    for phase, result in results.items():
+        base = baseline.get(phase, {})
+        mib = result["bytes"] / (1024 * 1024)
+        base_mib = f'{base["bytes"] / (1024 * 1024):.1f}' if base else "-"
+        print(f'{phase:<24}{result["ms"]:>9.1f}{base.get("ms", "-"):>9}'
+              f'{result["spawns"]:>8}{base.get("spawns", "-"):>6}{mib:>9.1f}{base_mib:>9}')
+        if not base:
+            continue
+        if result["ms"] > base["ms"] * (1 + args.tolerance) + args.slack:
+            failures.append(f'{phase}: {result["ms"]:.1f} ms is slower than baseline {base["ms"]:.1f} ms')
+        if result["spawns"] > base["spawns"]:
+            failures.append(f'{phase}: {result["spawns"]} subprocesses, baseline {base["spawns"]}')
+        # random kernel images make the exact amount vary a little
+        if result["bytes"] > base["bytes"] * 1.05 + 64 * 1024:
+            failures.append(f'{phase}: wrote {mib:.1f} MiB, baseline {base_mib} MiB')
+
+    print()
+    print("stand-in calls: " + ", ".join(f"{tool} {count}" for tool, count in sorted(tools.items())))
+
+    for failure in failures:
+        print("REGRESSION " + failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
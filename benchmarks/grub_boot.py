@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Measures how long GRUB takes to show the dongle's menu, under QEMU with
+# OVMF. A sparse file on a loop device is provisioned as a dongle with
+# 'donglify fleet', grub-install runs for real, and is booted from a USB
+# stick next to --disks blank partitioned disks, which GRUB probes too.
+# The console is on the serial port: without a video device gfxterm stays
+# off and the menu is drawn as text, so the time of gfxterm's mode setting
+# is not part of the numbers.
+#
+# Reported per boot, from the serial output:
+#   to prompt  QEMU start to the /boot passphrase prompt, firmware, GRUB's
+#              core image and the search for the LUKS partition
+#   to menu    passphrase sent to the menu, key derivation, reading
+#              grub.cfg and the modules it loads from the encrypted /boot
+#   grub       GRUB's banner to the menu without the prompt's wait, only
+#              when GRUB prints a banner
+#
+#   sudo python benchmarks/grub_boot.py
+#   sudo python benchmarks/grub_boot.py --disks 16 --runs 5
+#
+# Needs root, qemu-system-x86_64, OVMF and GRUB. It must not run with a
+# dongle plugged in, the mapper names are shared.
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import selectors
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "..", "src")
+
+# EFI 256 MiB, BOOT 2048 MiB and the 256 MiB ISOs and persistent partitions
+DISK_SIZE = 3 * 1024 * 1024 * 1024
+EXTRA_DISK_SIZE = 64 * 1024 * 1024
+EXTRA_DISK_PARTITIONS = 4
+PASSPHRASE = b"donglify-grub-boot"
+OVMF_CANDIDATES = [
+    ("/usr/share/edk2/x64/OVMF_CODE.4m.fd", "/usr/share/edk2/x64/OVMF_VARS.4m.fd"),
+    ("/usr/share/edk2-ovmf/x64/OVMF_CODE.fd", "/usr/share/edk2-ovmf/x64/OVMF_VARS.fd"),
+    ("/usr/share/OVMF/OVMF_CODE.fd", "/usr/share/OVMF/OVMF_VARS.fd"),
+    ("/usr/share/ovmf/x64/OVMF_CODE.fd", "/usr/share/ovmf/x64/OVMF_VARS.fd"),
+]
+
+BANNER = re.compile(rb"Welcome to GRUB")
+PROMPT = re.compile(rb"Enter passphrase for")
+MENU = re.compile(rb"enter to boot the selected", re.IGNORECASE)
+# OVMF draws the serial console with VT100 escapes
+ESCAPE = re.compile(rb"\x1b\[[0-9;?]*[A-Za-z]")
+
+
+def find_ovmf(code, vars_template):
+    if code is not None:
+        return code, vars_template
+    for code, vars_template in OVMF_CANDIDATES:
+        if os.path.exists(code):
+            return code, vars_template if os.path.exists(vars_template) else None
+    raise SystemExit("OVMF not found, pass --ovmf-code")
+
+
+def provision(workdir, image):
+    loop = subprocess.run(["losetup", "-fP", "--show", image], check=True,
+                          capture_output=True).stdout.decode().strip()
+    key_file = os.path.join(workdir, "key")
+    with open(key_file, "wb") as f:
+        f.write(PASSPHRASE)
+    spec = os.path.join(workdir, "fleet.ini")
+    with open(spec, "w") as f:
+        f.write(f"[fleet]\ndevices = {loop}\niso_size = 256\npersistent_size = 256\nworkers = 1\n"
+                f"keyfile = {key_file}\nmountpoint_root = {workdir}/mnt\n")
+
+    env = dict(os.environ, PYTHONPATH=SRC + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    try:
+        proc = subprocess.run([sys.executable, "-m", "donglify.donglify", "fleet", spec], env=env,
+                              input=b"DESTROY MY DONGLES\n", capture_output=True)
+    finally:
+        subprocess.run(["losetup", "-d", loop], capture_output=True)
+    if proc.returncode != 0:
+        sys.stdout.write(proc.stdout.decode(errors="replace"))
+        sys.stderr.write(proc.stderr.decode(errors="replace"))
+        raise SystemExit(f"provisioning failed with returncode {proc.returncode}")
+
+
+def extra_disk(path):
+    with open(path, "wb") as f:
+        f.truncate(EXTRA_DISK_SIZE)
+    cmd = ["parted", "-s", path, "mklabel", "gpt"]
+    step = 100 // EXTRA_DISK_PARTITIONS
+    for i in range(EXTRA_DISK_PARTITIONS):
+        cmd += ["mkpart", f"part{i}", f"{i * step}%", f"{(i + 1) * step}%"]
+    subprocess.run(cmd, check=True, capture_output=True)
+
+
+def boot(image, disks, ovmf_code, ovmf_vars, workdir, timeout):
+    cmd = ["qemu-system-x86_64", "-machine", "q35", "-m", "1024", "-nodefaults", "-display", "none",
+           "-vga", "none", "-serial", "stdio", "-monitor", "none",
+           "-drive", f"if=pflash,format=raw,readonly=on,file={ovmf_code}"]
+    if ovmf_vars is not None:
+        vars_copy = os.path.join(workdir, "OVMF_VARS.fd")
+        shutil.copyfile(ovmf_vars, vars_copy)
+        cmd += ["-drive", f"if=pflash,format=raw,file={vars_copy}"]
+    if os.path.exists("/dev/kvm"):
+        cmd += ["-enable-kvm", "-cpu", "host"]
+    cmd += ["-device", "qemu-xhci",
+            "-drive", f"if=none,id=dongle,format=raw,file={image}",
+            "-device", "usb-storage,drive=dongle,bootindex=0"]
+    for i, disk in enumerate(disks):
+        cmd += ["-drive", f"if=none,id=disk{i},format=raw,file={disk}", "-device", f"virtio-blk-pci,drive=disk{i}"]
+
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    os.set_blocking(proc.stdout.fileno(), False)
+    selector = selectors.DefaultSelector()
+    selector.register(proc.stdout, selectors.EVENT_READ)
+
+    output = b""
+    banner = prompt = sent = menu = None
+    try:
+        while menu is None:
+            if time.monotonic() - start > timeout:
+                raise SystemExit(f"no menu after {timeout}s, serial output:\n" +
+                                 ESCAPE.sub(b"", output).decode(errors="replace"))
+            if not selector.select(timeout=1):
+                continue
+            chunk = proc.stdout.read()
+            if not chunk:
+                raise SystemExit("qemu exited before the menu")
+            now = time.monotonic()
+            output += chunk
+            text = ESCAPE.sub(b"", output)
+            if banner is None and BANNER.search(text):
+                banner = now
+            if prompt is None and PROMPT.search(text):
+                prompt = now
+                proc.stdin.write(PASSPHRASE + b"\r")
+                proc.stdin.flush()
+                sent = time.monotonic()
+            if sent is not None and MENU.search(text[text.rfind(b"Enter passphrase for"):]):
+                menu = now
+    finally:
+        proc.kill()
+        proc.wait()
+
+    result = {"to_prompt": prompt - start, "to_menu": menu - sent}
+    if banner is not None:
+        result["grub"] = (prompt - banner) + (menu - sent)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--disks", type=int, default=8, help="blank partitioned disks next to the dongle")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds one boot may take")
+    parser.add_argument("--ovmf-code")
+    parser.add_argument("--ovmf-vars")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        raise SystemExit("needs root for losetup, cryptsetup, mount and grub-install")
+    for tool in ["qemu-system-x86_64", "grub-install", "parted", "cryptsetup"]:
+        if shutil.which(tool) is None:
+            raise SystemExit(f"{tool} is not installed")
+    ovmf_code, ovmf_vars = find_ovmf(args.ovmf_code, args.ovmf_vars)
+
+    with tempfile.TemporaryDirectory(prefix="donglify-grub-boot-") as workdir:
+        image = os.path.join(workdir, "dongle.img")
+        with open(image, "wb") as f:
+            f.truncate(DISK_SIZE)
+        provision(workdir, image)
+
+        disks = []
+        for i in range(args.disks):
+            disks.append(os.path.join(workdir, f"disk{i}.img"))
+            extra_disk(disks[-1])
+
+        runs = [boot(image, disks, ovmf_code, ovmf_vars, workdir, args.timeout) for _ in range(args.runs)]
+
+    print(f"{len(runs)} boots with {args.disks} extra disks{'' if os.path.exists('/dev/kvm') else ', without KVM'}")
+    print(f'{"phase":<12}{"min ms":>10}{"median ms":>12}')
+    for phase in ["to_prompt", "to_menu", "grub"]:
+        timings = [run[phase] * 1000 for run in runs if phase in run]
+        if timings:
+            print(f'{phase:<12}{min(timings):>10.0f}{statistics.median(timings):>12.0f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# Measures donglify's startup latency and fails when it regresses against
+# startup_baseline.json. Every scenario runs in a fresh interpreter, the
+# time of a bare interpreter start is subtracted so the numbers are
+# comparable between machines.
+#
+#   python benchmarks/startup.py                    compare against baseline
+#   python benchmarks/startup.py --update-baseline  record a new baseline
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "..", "src")
+BASELINE = os.path.join(HERE, "startup_baseline.json")
+
+DONGLE_INI = """[dongle]
+version = 1
+efi_uuid = 1234-ABCD
+locked_boot_uuid = 00000000-0000-0000-0000-000000000001
+unlocked_boot_uuid = 00000000-0000-0000-0000-000000000002
+part_iso_uuid = 00000000-0000-0000-0000-000000000003
+
+[work]
+kernel_name = linux
+kernel_args = quiet
+kernel_version = 6.12.1-arch1-1
+cryptokeyfile =
+hooks_added =
+ucode = amd-ucode
+"""
+
+# modules which must stay out of the given scenario
+FORBIDDEN = {
+    "import": ["prompt_toolkit", "pydantic", "termcolor", "importlib.metadata"],
+    "list": ["prompt_toolkit"],
+}
+
+
+def scenario_code(name, config_path):
+    if name == "bare":
+        return "pass"
+    if name == "import":
+        return "import donglify.donglify"
+    argv = {
+        "version": ["--version"],
+        "list": ["--yes", "--config", config_path, "list", "--json"],
+    }[name]
+    return f"import sys; sys.argv = ['donglify'] + {argv!r}\n" + \
+        "from donglify.donglify import main\n" + \
+        "try:\n    main()\nexcept SystemExit:\n    pass\n"
+
+
+def run_once(code, env, check_modules=None):
+    if check_modules:
+        code += "\nimport sys\nprint('LOADED', ' '.join(m for m in " + repr(check_modules) + \
+            " if m in sys.modules), file=sys.stderr)"
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr.decode())
+        raise SystemExit(f"scenario failed: {code!r}")
+    loaded = []
+    for line in proc.stderr.decode().splitlines():
+        if line.startswith("LOADED"):
+            loaded = line.split()[1:]
+    return elapsed, loaded
+
+
+def measure(runs):
+    env = dict(os.environ, PYTHONPATH=SRC + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    results = {}
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, "dongle.ini")
+        with open(config_path, "w") as f:
+            f.write(DONGLE_INI)
+
+        for name in ["bare", "import", "version", "list"]:
+            code = scenario_code(name, config_path)
+            samples = []
+            for _ in range(runs):
+                elapsed, loaded = run_once(code, env, FORBIDDEN.get(name))
+                samples.append(elapsed)
+                if loaded:
+                    failures.append(f"{name}: imported {' '.join(loaded)}")
+            results[name] = statistics.median(samples)
+
+    bare = results.pop("bare")
+    return {name: round(ms - bare, 1) for name, ms in results.items()}, sorted(set(failures))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=15)
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed relative slowdown over the baseline")
+    parser.add_argument("--slack", type=float, default=15.0,
+                        help="allowed absolute slowdown in ms, absorbs noise on fast scenarios")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results, failures = measure(args.runs)
+
+    if args.update_baseline:
+        with open(BASELINE, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"wrote {BASELINE}")
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    print(f'{"scenario":<10}{"ms":>8}{"baseline":>10}')
+    for name, ms in results.items():
+        base = baseline.get(name)
+        print(f'{name:<10}{ms:>8.1f}{base if base is not None else "-":>10}')
+        if base is not None and ms > base * (1 + args.tolerance) + args.slack:
+            failures.append(f"{name}: {ms:.1f} ms is slower than baseline {base:.1f} ms")
+
+    for failure in failures:
+        print("REGRESSION " + failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,143 @@
+import hashlib
 import pathlib
 
 from donglify.lib import *
 
 from donglify.config import *
+from donglify.store import *
+from donglify.dongle import Dongle
+
+# packages whose binaries mkinitcpio's hooks copy into the initramfs
+INITRAMFS_PACKAGES = ["systemd", "cryptsetup", "lvm2", "kmod"]
 
 class DonglifyBoot:
     @staticmethod
-    def setup_mkinitcpio_config(name: str):
-        print(name)
-        current_install = DonglifyState.installs[name]
-    
+    def render_mkinitcpio_config(dongle: Dongle, name: str) -> dict[str, bytes]:
+        current_install = dongle.installs[name]
+
         template = get_asset_data("templates/mkinitcpio.conf").decode('utf-8')
         template = template.replace(
             "$CRYPTO_KEYFILE", current_install.cryptokeyfile)
         template = template.replace(
             "$HOOKS_ADDED", current_install.hooks_added)
-        pathlib.Path("/etc/mkinitcpio.conf").write_text(template)
-        good("wrote /etc/mkinitcpio.conf")
-    
-        hook = get_asset_data("sd-sulogin.initramfs.hook").decode('utf-8')
-        pathlib.Path("/etc/initcpio/install/sd-sulogin").write_text(hook)
-        good("wrote /etc/initcpio/install/sd-sulogin")
-    
-        shadow = get_asset_data("shadow.initramfs").decode('utf-8')
-        pathlib.Path("/etc/shadow.initramfs").write_text(shadow)
-        good("wrote /etc/shadow.initramfs")
-
-    @staticmethod 
-    def configure_sys(current_install_name: str):
-        DonglifyBoot.setup_mkinitcpio_config(current_install_name)
-            
-        current_install = DonglifyState.installs[current_install_name]
+        template = template.replace(
+            "$COMPRESSION_OPTIONS", current_install.compression_options)
+        template = template.replace(
+            "$COMPRESSION", current_install.compression)
+
+        return {
+            rooted("/etc/mkinitcpio.conf"): template.encode('utf-8'),
+            rooted("/etc/initcpio/install/sd-sulogin"): get_asset_data("sd-sulogin.initramfs.hook"),
+            rooted("/etc/shadow.initramfs"): get_asset_data("shadow.initramfs"),
+        }
+
+    @staticmethod
+    @DongleTrace.traced("mkinitcpio config")
+    def setup_mkinitcpio_config(dongle: Dongle, name: str):
+        print(name)
+        for path, data in DonglifyBoot.render_mkinitcpio_config(dongle, name).items():
+            if write_if_changed(path, data):
+                good(f"wrote {path}")
+
+    @staticmethod
+    @DongleTrace.traced("build fingerprint")
+    def fingerprint(dongle: Dongle, name: str) -> dict[str, str]:
+        current_install = dongle.installs[name]
+
+        def digest(data: bytes):
+            return hashlib.sha256(data).hexdigest()[:16]
+
+        packages = subprocess.run(f"pacman -Q {current_install.kernel_name} {current_install.ucode} mkinitcpio "
+                                  f"{' '.join(INITRAMFS_PACKAGES)}", shell=True, capture_output=True).stdout
+
+        crypttab = pathlib.Path(rooted("/etc/crypttab.initramfs"))
+        rendered = DonglifyBoot.render_mkinitcpio_config(dongle, name)
+        return {
+            "packages": digest(packages),
+            "mkinitcpio": digest(rendered[rooted("/etc/mkinitcpio.conf")]),
+            "hook": digest(rendered[rooted("/etc/initcpio/install/sd-sulogin")]),
+            "shadow": digest(rendered[rooted("/etc/shadow.initramfs")]),
+            "crypttab": digest(crypttab.read_bytes()) if crypttab.exists() else "missing",
+        }
+
+    @staticmethod
+    def missing_images(dongle: Dongle, name: str) -> list[str]:
+        return [image for image in DongleStore.image_names(dongle, name)
+                if not os.path.exists(f'{dongle.boot_dir}/{image}')]
+
+    @staticmethod
+    def rebuild_reasons(dongle: Dongle, name: str, fingerprint: dict[str, str],
+                        missing: list[str] = None) -> list[str]:
+        # missing is looked up before a staged build hides the dongle's /boot
+        current_install = dongle.installs[name]
+        if missing is None:
+            missing = DonglifyBoot.missing_images(dongle, name)
+
+        reasons = [f'/boot/{image} is missing' for image in missing]
+        # pacman's mkinitcpio hook builds the images under the kernel's name
+        # on any upgrade which touches the initramfs, they are not renamed yet
+        for image in [f'vmlinuz-{current_install.kernel_name}', f'initramfs-{current_install.kernel_name}.img']:
+            if os.path.exists(rooted(f'/boot/{image}')):
+                reasons.append(f'pacman left a new /boot/{image}')
+
+        if current_install.build_fingerprint == "":
+            reasons.append("no previous build is recorded")
+            return reasons
+
+        previous = dict(part.split("=", 1) for part in current_install.build_fingerprint.split(","))
+        for key, value in fingerprint.items():
+            if previous.get(key) != value:
+                reasons.append(f"{key} changed since the last build")
+        return reasons
+
+    @staticmethod
+    @DongleTrace.traced("configure_sys")
+    def configure_sys(dongle: Dongle, current_install_name: str, incremental=False,
+                      missing: list[str] = None) -> bool:
+        # builds into whatever is mounted at the host's /boot, where pacman
+        # and mkinitcpio put the images, returns whether it did
+        if incremental:
+            reasons = DonglifyBoot.rebuild_reasons(dongle, current_install_name,
+                                                   DonglifyBoot.fingerprint(dongle, current_install_name), missing)
+            if not reasons:
+                good(f"kernel & initramfs of {current_install_name} are up to date, skipping rebuild")
+                return False
+            for reason in reasons:
+                tell(f"rebuilding {current_install_name}: {reason}")
+
+        DonglifyBoot.setup_mkinitcpio_config(dongle, current_install_name)
+
+        current_install = dongle.installs[current_install_name]
         KERNEL_NAME = current_install.kernel_name
         UCODE_NAME = current_install.ucode
         cmd = f'pacman -S --noconfirm {KERNEL_NAME} {UCODE_NAME} mkinitcpio'
         execute(cmd, desc=f'install the kernel, microcode, and mkinitcpio')
-    
-        cmd = 'rm /boot/*fallback*'
+
+        boot = rooted("/boot")
+        cmd = f'rm {boot}/*fallback*'
         execute(cmd, desc=f'remove kernel fallback images')
-    
+
         # rename the newly installed images
-        new_kernel_image_path = f'/boot/vmlinuz-{current_install_name}'
-        new_initramfs_image_path = f'/boot/initramfs-{current_install_name}.img'
-        new_ucode_image_path = f'/boot/{UCODE_NAME}-{current_install_name}.img'
-    
-        cmd = f"mv -f /boot/vmlinuz-{KERNEL_NAME} {new_kernel_image_path}"
+        new_kernel_image_path = f'{boot}/vmlinuz-{current_install_name}'
+        new_initramfs_image_path = f'{boot}/initramfs-{current_install_name}.img'
+        new_ucode_image_path = f'{boot}/{UCODE_NAME}-{current_install_name}.img'
+
+        cmd = f"mv -f {boot}/vmlinuz-{KERNEL_NAME} {new_kernel_image_path}"
         execute(cmd, desc=f'rename linux kernel image')
-        cmd = f"mv -f /boot/initramfs-{KERNEL_NAME}.img {new_initramfs_image_path}"
+        cmd = f"mv -f {boot}/initramfs-{KERNEL_NAME}.img {new_initramfs_image_path}"
         execute(cmd, desc=f'rename initramfs image')
-        cmd = f"mv -f /boot/{UCODE_NAME}.img {new_ucode_image_path}"
+        cmd = f"mv -f {boot}/{UCODE_NAME}.img {new_ucode_image_path}"
         execute(cmd, desc=f'rename microcode image')
-    
-        DonglifyState.installs[current_install_name].kernel_version =  \
-            subprocess.run(f"pacman -Q {KERNEL_NAME}", 
+
+        current_install.kernel_version =  \
+            subprocess.run(f"pacman -Q {KERNEL_NAME}",
                            shell=True, capture_output=True).stdout.decode('utf-8').strip().split(" ")[1]
-        DonglifyState.write()
-    
+        # recorded after the install, pacman -S may have upgraded the packages
+        current_install.build_fingerprint = ','.join(
+            f'{key}={value}' for key, value in DonglifyBoot.fingerprint(dongle, current_install_name).items())
+        dongle.write()
+
         good("kernel & initramfs should be correctly positioned in /boot for detection by 'grub-mkconfig' now")
-    
+
         #clean_mkinitcpio_config(current_install)
+        return True
@@ -0,0 +1,271 @@
+import io
+import os
+import re
+import sys
+import mmap
+import time
+import queue
+import hashlib
+import threading
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import BaseModel, TypeAdapter
+
+from donglify.lib import *
+from donglify.iso9660 import inspect_iso
+
+class DongleISOImage(BaseModel, extra="forbid"):
+    size: int
+    mtime_ns: int
+    inode: int
+    volume_label: str = ""
+    # boot config found inside the image and the grub.d/isos template for it,
+    # NO_BOOT_CONFIG as the template when the image has none
+    boot_config: str = ""
+    template: str = ""
+    sha256: str = ""
+    # ok or mismatch against a vendor checksum file, "" when there is none
+    checksum: str = ""
+
+DongleISOImageValidator = TypeAdapter(DongleISOImage)
+
+# template of an image inspected without finding a boot config GRUB can use,
+# such images are cached like any other instead of being read again
+NO_BOOT_CONFIG = "none"
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+COPY_BUFFERS = 4
+COPY_CHECKPOINT = 1024 * 1024 * 1024
+
+CHECKSUM_FILES = re.compile(r"(?i)^(sha256sums?(\.txt)?|.*\.sha256(sum)?)$")
+
+class DongleISOCatalog:
+    # metadata of the images on the ISOs partition, kept on the partition
+    # itself so it travels with the dongle. An entry stays valid as long as
+    # the (inode, size, mtime) of its file is unchanged, so multi-GB images
+    # are only hashed and inspected once.
+    FILE = ".donglify-catalog.ini"
+
+    def __init__(self, root: str, images: dict[str, DongleISOImage]):
+        self.root = root
+        self.images = images
+
+    @staticmethod
+    def load(root=rooted("/mnt/iso")) -> "DongleISOCatalog":
+        parser = configparser.ConfigParser(interpolation=None)
+        parser.read(f"{root}/{DongleISOCatalog.FILE}")
+        images = {}
+        for name in parser.sections():
+            try:
+                images[name] = DongleISOImageValidator.validate_python(dict(parser[name].items()))
+            except Exception:
+                tell(f"ignoring invalid catalog entry {name}")
+        return DongleISOCatalog(root, images)
+
+    def save(self):
+        parser = configparser.ConfigParser(interpolation=None)
+        for name, image in sorted(self.images.items()):
+            parser.read_dict({name: image.model_dump()})
+        buffer = io.StringIO()
+        parser.write(buffer, space_around_delimiters=True)
+        write_if_changed(f"{self.root}/{DongleISOCatalog.FILE}", buffer.getvalue().encode('utf-8'))
+
+    @staticmethod
+    def inspect(path, stat) -> DongleISOImage:
+        volume_label, boot_config, template = inspect_iso(path)
+        if boot_config == "":
+            template = NO_BOOT_CONFIG
+        return DongleISOImage(size=stat.st_size, mtime_ns=stat.st_mtime_ns, inode=stat.st_ino,
+                              volume_label=volume_label, boot_config=boot_config, template=template)
+
+    @staticmethod
+    def hash_file(path) -> str:
+        # hashlib releases the GIL on large updates, so workers hash in parallel
+        sha = hashlib.sha256()
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        with open(path, "rb", buffering=0) as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                sha.update(view[:n])
+        return sha.hexdigest()
+
+    def vendor_checksums(self, directory=None) -> dict[str, str]:
+        checksums = {}
+        for entry in os.scandir(directory or self.root):
+            if not entry.is_file() or not CHECKSUM_FILES.match(entry.name):
+                continue
+            with open(entry.path, errors='replace') as f:
+                for line in f:
+                    # GNU '<hash>  [*]<name>' or BSD 'SHA256 (<name>) = <hash>'
+                    gnu = re.match(r"^([0-9a-fA-F]{64})\s+\*?(.+)$", line.strip())
+                    bsd = re.match(r"^SHA256 \((.+)\) = ([0-9a-fA-F]{64})$", line.strip())
+                    if gnu:
+                        checksums[os.path.basename(gnu.group(2))] = gnu.group(1).lower()
+                    elif bsd:
+                        checksums[os.path.basename(bsd.group(1))] = bsd.group(2).lower()
+        return checksums
+
+    def scan(self) -> list[str]:
+        # refreshes the cheap metadata, returns the images that need hashing
+        images = {}
+        stale = []
+        for entry in os.scandir(self.root):
+            if not entry.is_file() or not entry.name.lower().endswith(".iso"):
+                continue
+            stat = entry.stat()
+            cached = self.images.get(entry.name)
+            if cached is not None and (cached.inode, cached.size, cached.mtime_ns) == \
+                    (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                images[entry.name] = cached
+                if cached.template == "":
+                    # catalogs written before images were inspected, images
+                    # without a boot config are cached as NO_BOOT_CONFIG
+                    inspected = self.inspect(entry.path, stat)
+                    cached.boot_config, cached.template = inspected.boot_config, inspected.template
+            else:
+                images[entry.name] = self.inspect(entry.path, stat)
+            if images[entry.name].sha256 == "":
+                stale.append(entry.name)
+        self.images = images
+        return stale
+
+    @staticmethod
+    def partial_size(dest) -> int:
+        # bytes of an interrupted import of dest already on the partition
+        try:
+            return os.path.getsize(os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.part"))
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def copy_image(src, dest) -> str:
+        # copies src to dest and returns its sha256, hashed while copying so
+        # the image is never read twice. The copy goes to a .part file which
+        # is checkpointed every COPY_CHECKPOINT bytes, an interrupted copy
+        # resumes from the last checkpoint.
+        partial = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.part")
+        checkpoint_file = partial + ".offset"
+        stat = os.stat(src)
+        total = stat.st_size
+
+        offset = 0
+        try:
+            with open(checkpoint_file) as f:
+                saved_offset, saved_size, saved_mtime = (int(field) for field in f.read().split())
+            if (saved_size, saved_mtime) == (total, stat.st_mtime_ns) and os.path.exists(partial) and \
+                    os.path.getsize(partial) >= saved_offset:
+                offset = saved_offset
+        except (FileNotFoundError, ValueError):
+            pass
+
+        sha = hashlib.sha256()
+        with open(src, "rb", buffering=0) as fsrc, open(partial, "ab+", buffering=0) as fdst:
+            fdst.truncate(offset)
+            if offset > 0:
+                tell(f"resuming copy of {os.path.basename(src)} at {offset // (1024 * 1024)} MiB")
+                # the part already on the dongle is read back, not copied again
+                fdst.seek(0)
+                remaining = offset
+                buffer = bytearray(HASH_CHUNK_SIZE)
+                while remaining > 0:
+                    n = fdst.readinto(memoryview(buffer)[:min(remaining, HASH_CHUNK_SIZE)])
+                    sha.update(memoryview(buffer)[:n])
+                    remaining -= n
+                fsrc.seek(offset)
+            fdst.seek(offset)
+
+            # the reader fills page aligned buffers and hashes them while the
+            # writer drains the previous ones to the dongle
+            free = queue.Queue()
+            full = queue.Queue()
+            for _ in range(COPY_BUFFERS):
+                free.put(mmap.mmap(-1, HASH_CHUNK_SIZE))
+
+            def reader():
+                try:
+                    while True:
+                        buffer = free.get()
+                        n = fsrc.readinto(buffer)
+                        if not n:
+                            full.put(None)
+                            return
+                        sha.update(memoryview(buffer)[:n])
+                        full.put((buffer, n))
+                except BaseException as e:
+                    full.put(e)
+
+            thread = threading.Thread(target=reader, daemon=True)
+            thread.start()
+
+            copied = offset
+            checkpoint = offset
+            start = time.monotonic()
+            last_report = 0
+            while True:
+                item = full.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                buffer, n = item
+                fdst.write(memoryview(buffer)[:n])
+                free.put(buffer)
+                copied += n
+
+                if copied - checkpoint >= COPY_CHECKPOINT:
+                    os.fsync(fdst.fileno())
+                    with open(checkpoint_file, "w") as f:
+                        f.write(f"{copied} {total} {stat.st_mtime_ns}")
+                    checkpoint = copied
+
+                now = time.monotonic()
+                if now - last_report >= 0.5 or copied == total:
+                    last_report = now
+                    rate = (copied - offset) / max(now - start, 1e-6)
+                    eta = (total - copied) / rate if rate > 0 else 0
+                    sys.stderr.write(f"\r{copied * 100 // max(total, 1):3}% "
+                                     f"{copied // (1024 * 1024)}/{total // (1024 * 1024)} MiB "
+                                     f"{rate / (1024 * 1024):.1f} MiB/s ETA {int(eta // 60)}:{int(eta % 60):02} ")
+                    sys.stderr.flush()
+            thread.join()
+            sys.stderr.write("\n")
+
+            os.fsync(fdst.fileno())
+
+        os.replace(partial, dest)
+        dirfd = os.open(os.path.dirname(dest) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        if os.path.exists(checkpoint_file):
+            os.unlink(checkpoint_file)
+
+        return sha.hexdigest()
+
+    def add_image(self, name, sha256, checksum=""):
+        path = f"{self.root}/{name}"
+        self.images[name] = self.inspect(path, os.stat(path))
+        self.images[name].sha256 = sha256
+        self.images[name].checksum = checksum
+        self.save()
+
+    def verify(self, workers=4):
+        stale = self.scan()
+        if stale:
+            tell(f"hashing {len(stale)} iso(s) with {workers} workers")
+            paths = [f"{self.root}/{name}" for name in stale]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for name, digest in zip(stale, pool.map(DongleISOCatalog.hash_file, paths)):
+                    self.images[name].sha256 = digest
+
+        checksums = self.vendor_checksums()
+        for name, image in self.images.items():
+            if name in checksums:
+                image.checksum = "ok" if checksums[name] == image.sha256 else "mismatch"
+            else:
+                image.checksum = ""
+        self.save()
@@ -0,0 +1,411 @@
+import sys
+import json
+import signal
+import subprocess
+
+from donglify.lib import *
+from donglify.boot import *
+from donglify.grub import *
+from donglify.isos import *
+from donglify.config import *
+from donglify.partition import *
+from donglify.luks import *
+from donglify.initramfs import *
+from donglify.stage import *
+from donglify.persist import *
+from donglify.daemon import *
+from donglify.dongle import *
+
+# TODO: do real cleanup
+
+def dongle_add_current_system(name=None, kernel_name=None, kernel_args=None, ucode=None,
+                              cryptokeyfile=None, hooks_added=None):
+    if name is None:
+        print("Fill configs for current system:")
+        name = input("install name, shown on GRUB: ")
+        kernel_name = input("kernel package name [linux/-hardened/-lts/..]: ")
+        kernel_args = input("kernel args [optional]: ")
+        ucode = input("microcode package to be installed [intel-ucode/amd-ucode]: ")
+        cryptokeyfile = input("encryption key file to be loaded into initramfs [optional]: ")
+        hooks_added = input("hooks to be added to initramfs [optional]: ")
+
+    current_install: DongleInstall = DongleInstallValidator.validate_python({
+        "kernel_name": kernel_name,
+        "kernel_args": kernel_args,
+        "ucode": ucode,
+        "cryptokeyfile": cryptokeyfile,
+        "hooks_added": hooks_added,
+        "kernel_version": subprocess.run("uname -r", shell=True, capture_output=True).stdout.decode('utf-8').strip(),
+        "machine_id": read_machine_id(),
+    })
+
+    DonglifyState.installs[name] = current_install
+    DonglifyState.write()
+
+    tell("adding current host system to donglify")
+    DonglifyState.umount_all()
+    ensure_local_dirs_mountpoint_only()
+
+    dongle_install_system(name)
+
+
+def dongle_reinstall_system(name=None, incremental=False, staged=False):
+    if name is None:
+        name = select_dongle_install()
+    if name == "":
+        bad("no available system configurations to reinstall")
+        return
+
+    dongle_install_system(name, incremental, staged)
+
+
+def dongle_install_system(current_install_name: str, incremental=False, staged=False):
+    current_install = DonglifyState.installs[current_install_name]
+    # installs from before machine ids were recorded are claimed by the
+    # first host which reinstalls them
+    if current_install.machine_id == "":
+        current_install.machine_id = read_machine_id()
+        DonglifyState.write()
+
+    if staged:
+        DongleStage.install(DonglifyState, current_install_name, incremental=incremental)
+        return
+
+    DonglifyState.mount_all()
+    if DonglifyBoot.configure_sys(DonglifyState, current_install_name, incremental):
+        # installs sharing a kernel build or microcode share one copy of it
+        DongleStore.adopt_install(DonglifyState, current_install_name)
+    DonglifyState.config_install()
+
+
+def read_machine_id() -> str:
+    try:
+        with open(rooted("/etc/machine-id")) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def dongle_daemon_sync():
+    # run by the daemon once it unlocked the dongle
+    DongleDaemon.remember(DonglifyState.config.locked_boot_uuid)
+    machine_id = read_machine_id()
+    names = [name for name, install in DonglifyState.installs.items()
+             if machine_id != "" and install.machine_id == machine_id]
+    if not names:
+        bad("no install on the dongle was added from this host, nothing to rebuild")
+    else:
+        DonglifyState.mount_all()
+        for name in names:
+            tell(f"rebuilding {name}")
+            if DonglifyBoot.configure_sys(DonglifyState, name, incremental=True):
+                DongleStore.adopt_install(DonglifyState, name)
+        DonglifyState.config_install()
+        DonglifyState.commit()
+    DonglifyState.umount_all()
+
+
+def dongle_list_installs(as_json=False):
+    if as_json:
+        print(json.dumps({name: config.model_dump() for name, config in DonglifyState.installs.items()}, indent=2))
+        return
+
+    if len(DonglifyState.installs) == 0:
+        bad("no system installs on dongle")
+        return
+
+    tell("listing registered installs on dongle")
+
+    for name, config in DonglifyState.installs.items():
+        print()
+        print(f'name: {name}')
+        print(f'kernel_name: {config.kernel_name}')
+        print(f'kernel_args: {config.kernel_args}')
+        print(f'kernel_version: {config.kernel_version}')
+        print(f'cryptokeyfile: {config.cryptokeyfile}')
+        print(f'hooks_added: {config.hooks_added}')
+        print(f'compression: {compression_label(config.compression, config.compression_options)}')
+        print(f'ucode: {config.ucode}')
+
+
+def dongle_status(as_json=False):
+    index = DeviceIndex.load()
+    boot = index.by_uuid.get(DonglifyState.config.locked_boot_uuid)
+    disk = index.disk_of(boot.path) if boot is not None else None
+
+    if not as_json:
+        if disk is None:
+            bad("dongle is not plugged in")
+            return
+        index.print_table(disk)
+        return
+
+    devices = []
+    if disk is not None:
+        for device in [disk] + index.partitions_of(disk):
+            devices.append(device.to_dict())
+            devices += [index.devices[f"/dev/mapper/{holder}"].to_dict() for holder in device.holders
+                        if f"/dev/mapper/{holder}" in index.devices]
+
+    mounts = MountIndex.load()
+    print(json.dumps({
+        "dongle": DonglifyState.config.model_dump(),
+        "mounts": {"/efi": mounts.is_mounted(DonglifyState.efi_dir),
+                   "/boot": mounts.is_mounted(DonglifyState.boot_dir),
+                   "/mnt/iso": mounts.is_mounted(DonglifyState.iso_dir)},
+        "unlocked": {name: mounts.is_unlocked(name) for name in [DonglifyState.boot_name, DonglifyState.persist_name]},
+        "devices": devices,
+        "installs": list(DonglifyState.installs.keys()),
+        "isos": list(DonglifyState.isos.keys()),
+    }, indent=2))
+
+
+def dongle_luks_tune(boot_target=BOOT_UNLOCK_TARGET, persist_target=PERSIST_UNLOCK_TARGET,
+                     grub_slowdown=GRUB_SLOWDOWN, apply=False):
+    tell("benchmarking this machine with cryptsetup benchmark")
+    benchmark = DongleLuksBenchmark.run()
+    boot = DongleLuks.tune_boot(benchmark, boot_target, grub_slowdown)
+    persist = DongleLuks.tune_persist(benchmark, persist_target)
+    print(f"boot, unlocked by GRUB in about {boot_target}s: {boot.describe()}")
+    print(f"persistent, unlocked by Linux in about {persist_target}s: {persist.describe()}")
+
+    if not apply:
+        tell("run with --apply to re-tune the dongle's key slots, new dongles are formatted with these")
+        return
+
+    index = DeviceIndex.load()
+    locked_boot = index.by_uuid.get(DonglifyState.config.locked_boot_uuid)
+    if locked_boot is None:
+        raise DonglifyError("dongle is not plugged in")
+    DongleLuks.retune(locked_boot.path, boot)
+
+    persistent = index.sibling(locked_boot.path, "DONGLE_PERSISTENT")
+    if persistent is not None:
+        DongleLuks.retune(persistent.path, persist)
+    good("key slots have been re-tuned, the cipher of existing partitions is unchanged")
+
+
+def dongle_initramfs_profile(name=None, top=15, use=None):
+    if name is None:
+        name = select_dongle_install()
+    if name == "":
+        bad("no available installs, try the 'add' command first")
+        return
+
+    DonglifyState.mount_all()
+    results = DongleInitramfs.profile(DonglifyState, name, top)
+    if use is None and sys.stdin.isatty() and not DonglifyState.assume_yes:
+        from prompt_toolkit import prompt
+        from prompt_toolkit.completion import WordCompleter
+        labels = ["best"] + [result.label for result in results]
+        use = prompt("compression to use, empty keeps the current one> ",
+                     completer=WordCompleter(labels, ignore_case=False))
+    if use:
+        DongleInitramfs.choose(DonglifyState, name, results, use)
+
+
+def select_dongle_install():
+    names = list(DonglifyState.installs.keys())
+
+    if len(names) == 0:
+        return ""
+
+    from prompt_toolkit import prompt
+    from prompt_toolkit.completion import WordCompleter
+
+    print("Select from available dongle install names:\n\t" +
+          colored(' '.join(names), 'green'))
+
+    return prompt("select> ", completer=WordCompleter(names, ignore_case=False))
+
+
+
+def dongle_safe_update(name=None, cmd=None, incremental=False, staged=False):
+    if name is None:
+        name = select_dongle_install()
+    if name == "":
+        bad("no available installs, try the 'add' command first")
+        return
+
+    if cmd is None:
+        cmd = input("Enter your system's update command: ")
+    if staged:
+        DongleStage.install(DonglifyState, name, cmd, incremental)
+        return
+
+    DonglifyState.mount_all()
+    execute(cmd, "Runs user given system update command.")
+    dongle_install_system(name, incremental)
+
+donglify_iso_cmds = {
+    "list": None,
+    "add": None,
+    "import": None,
+    "verify": None,
+    "templates": None
+}
+
+donglify_initramfs_cmds = {
+    "profile": None,
+}
+
+donglify_store_cmds = {
+    "report": None,
+    "gc": None,
+}
+
+donglify_persist_cmds = {
+    "add": None,
+    "remove": None,
+    "list": None,
+    "sync": None,
+}
+
+donglify_luks_cmds = {
+    "tune": None,
+}
+
+donglify_cmds = {'mount': None, 'unmount': None, 'add': None,
+                 'reinstall': None, 'update': None, 'status': None, 'list': None,
+                 "iso": donglify_iso_cmds, "luks": donglify_luks_cmds,
+                 "initramfs": donglify_initramfs_cmds, "store": donglify_store_cmds,
+                 "persist": donglify_persist_cmds}
+
+
+def run_command(args):
+    if args.command == "status":
+        dongle_status(args.json)
+    elif args.command == "list":
+        dongle_list_installs(args.json)
+    elif args.command == "mount":
+        DonglifyState.mount_all()
+    elif args.command == "unmount":
+        DonglifyState.umount_all()
+    elif args.command == "add":
+        dongle_add_current_system(args.name, args.kernel_name, args.kernel_args, args.ucode,
+                                  args.cryptokeyfile, args.hooks_added)
+    elif args.command == "reinstall":
+        if args.install not in DonglifyState.installs:
+            raise DonglifyError(f"no install named {args.install} on dongle")
+        dongle_reinstall_system(args.install, args.incremental, args.staged)
+    elif args.command == "update":
+        if args.install not in DonglifyState.installs:
+            raise DonglifyError(f"no install named {args.install} on dongle")
+        dongle_safe_update(args.install, args.cmd, args.incremental, args.staged)
+    elif args.command == "iso" and args.iso_cmd == "list":
+        dongle_iso_list(args.json)
+    elif args.command == "iso" and args.iso_cmd == "add":
+        dongle_iso_add(args.name, args.file, args.loopback_cfg, args.template)
+    elif args.command == "iso" and args.iso_cmd == "import":
+        dongle_iso_import(args.path, args.name, args.loopback_cfg, args.template)
+    elif args.command == "iso" and args.iso_cmd == "verify":
+        dongle_iso_verify(args.workers)
+    elif args.command == "iso" and args.iso_cmd == "templates":
+        dongle_iso_list_templates()
+    elif args.command == "initramfs" and args.initramfs_cmd == "profile":
+        if args.install not in DonglifyState.installs:
+            raise DonglifyError(f"no install named {args.install} on dongle")
+        dongle_initramfs_profile(args.install, args.top, args.use)
+    elif args.command == "store" and args.store_cmd == "report":
+        DonglifyState.mount_all()
+        DongleStore.print_report(DonglifyState, args.json)
+    elif args.command == "store" and args.store_cmd == "gc":
+        DonglifyState.mount_all()
+        DongleStore.gc(DonglifyState, args.dry_run)
+    elif args.command == "persist" and args.persist_cmd == "add":
+        dongle_persist_add(args.name, args.path)
+    elif args.command == "persist" and args.persist_cmd == "remove":
+        dongle_persist_remove(args.name)
+    elif args.command == "persist" and args.persist_cmd == "list":
+        dongle_persist_list(args.json)
+    elif args.command == "persist" and args.persist_cmd == "sync":
+        dongle_persist_sync(args.name, args.pull, args.dry_run, args.workers)
+    elif args.command == "luks" and args.luks_cmd == "tune":
+        dongle_luks_tune(args.boot_target, args.persist_target, args.grub_slowdown, args.apply)
+    elif args.command == "daemon" and args.daemon_cmd == "sync":
+        dongle_daemon_sync()
+
+
+def repl():
+    from prompt_toolkit import prompt
+    from prompt_toolkit.completion import NestedCompleter
+
+    def keyboard_interrupt_handler(x, y):
+        print()
+        print()
+        print("Farewell, Traveller.")
+        sys.exit(1)
+    signal.signal(signal.SIGINT, keyboard_interrupt_handler)
+
+    print("Welcome to donglify!")
+
+    try:
+        DonglifyState.mount_all()
+        while 1:
+            print(colored("available commands: " +
+                  ' '.join(donglify_cmds), 'dark_grey'))
+            user_input = prompt("donglify> ", completer=NestedCompleter.from_nested_dict(donglify_cmds))
+            try:
+                repl_command(user_input)
+            except DonglifyError as e:
+                # the failed command is reported, the session goes on
+                bad(str(e))
+    except (KeyboardInterrupt, EOFError):
+        print()
+        print("Farewell, Traveller.")
+        sys.exit(0)
+
+
+def repl_command(user_input):
+    with DonglifyState.transaction():
+        if user_input == 'status':
+            dongle_status()
+        elif user_input == 'list':
+            dongle_list_installs()
+        elif user_input == 'mount':
+            DonglifyState.mount_all()
+            dongle_status()
+        elif user_input == 'unmount':
+            DonglifyState.umount_all()
+            dongle_status()
+        elif user_input == 'add':
+            dongle_add_current_system()
+        elif user_input == 'reinstall':
+            dongle_reinstall_system()
+        elif user_input == 'update':
+            dongle_safe_update()
+        elif user_input == 'iso':
+            print(colored("available iso commands: " +
+              ' '.join(donglify_iso_cmds), 'dark_grey'))
+        elif user_input == 'iso list':
+            dongle_iso_list()
+        elif 'iso add' in user_input:
+            dongle_iso_add()
+        elif user_input == 'iso import':
+            dongle_iso_import()
+        elif user_input == 'iso verify':
+            dongle_iso_verify()
+        elif user_input == 'iso templates':
+            dongle_iso_list_templates()
+        elif user_input == 'initramfs profile':
+            dongle_initramfs_profile()
+        elif user_input == 'store report':
+            DongleStore.print_report(DonglifyState)
+        elif user_input == 'store gc':
+            DongleStore.gc(DonglifyState)
+        elif user_input == 'persist add':
+            dongle_persist_add()
+        elif user_input == 'persist remove':
+            dongle_persist_remove()
+        elif user_input == 'persist list':
+            dongle_persist_list()
+        elif user_input == 'persist sync':
+            dongle_persist_sync()
+        elif user_input == 'luks tune':
+            dongle_luks_tune()
+            print("Re-tune the dongle's key slots?")
+            if does_user_accept():
+                dongle_luks_tune(apply=True)
+        else:
+            print(f'command {user_input} not recognized')
+            print("Commands: " + " ".join(donglify_cmds))
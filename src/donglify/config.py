@@ -1,6 +1,9 @@
+import io
+import os
 import sys
+import threading
+import contextlib
 import configparser
-import pathlib
 
 from pydantic import BaseModel, TypeAdapter, ValidationError
 
@@ -15,21 +18,40 @@ class DongleInstall(BaseModel, extra="forbid"):
     cryptokeyfile: str
     hooks_added: str
     ucode: str
+    # inputs of the last kernel & initramfs build, see DonglifyBoot.fingerprint
+    build_fingerprint: str = ""
+    # mkinitcpio COMPRESSION and COMPRESSION_OPTIONS, "" is mkinitcpio's
+    # default, see 'initramfs profile'
+    compression: str = ""
+    compression_options: str = ""
+    # /etc/machine-id of the host the install was added from, the daemon
+    # rebuilds the installs of the host it runs on
+    machine_id: str = ""
 
 DongleInstallValidator = TypeAdapter(DongleInstall)
 
 class DongleISO(BaseModel, extra="forbid"):
     file_name: str
     loopback_cfg_location: str
+    # name of the grub.d/isos template the entry is rendered with
+    template: str = "loopback"
 
 DongleISOValidator = TypeAdapter(DongleISO)
 
+class DonglePersist(BaseModel, extra="forbid"):
+    # host directory mirrored to <name>/ on the persistent partition
+    host_path: str
+
+DonglePersistValidator = TypeAdapter(DonglePersist)
+
 class DongleDesc(BaseModel, extra="forbid"):
     version: str
     efi_uuid: str
     locked_boot_uuid: str
     unlocked_boot_uuid: str
     part_iso_uuid: str
+    # bumped by every commit of dongle.ini
+    generation: str = "0"
 
 DongleConfigValidator = TypeAdapter(DongleDesc)
 
@@ -45,6 +67,8 @@ class DonglifyConfigV1(DonglifyConfigV):
 
     isos: dict[str, DongleISO]
 
+    persists: dict[str, DonglePersist] = {}
+
     @staticmethod
     def convert_to_version(data):
         # add version field in data["config"]
@@ -60,38 +84,66 @@ class DonglifyConfigV1(DonglifyConfigV):
 
 DongleConfigV1Validator = TypeAdapter(DonglifyConfigV1)
 
-class DonglifyState:
+class DongleState:
+    # the state of one dongle.ini, kept by each Dongle for its own /boot
     LATEST_VERSION = "1"
-    @classmethod
-    def init(cls, data):
+    # set by non-interactive callers, dongle.ini is accepted without review
+    assume_yes = False
+
+    def __init__(self, path: str):
+        self.path = path
+        # None until dongle.ini is read
+        self.config: DongleDesc = None
+        self.installs: dict[str, DongleInstall] = {}
+        self.isos: dict[str, DongleISO] = {}
+        # dongle.ini files from before persist sync have no persist sections
+        self.persists: dict[str, DonglePersist] = {}
+        # dongle.ini as last read or committed, a commit of the same state is a no-op
+        self.committed = b""
+        self.transaction_depth = 0
+        # taken by every change, a dongle is worked on by one thread at a time
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def parse(data) -> tuple[DonglifyConfigV1, bool]:
+        # the state of dongle.ini and whether it was converted from an older
+        # version
         try:
-            cls.validate(data)
-            cls.ask_user_to_accept_config()
-        except Exception as e1:
+            return DongleState.validate(data), False
+        except DonglifyError as e1:
             try:
                 tell("attempting to convert dongle.ini to v1")
-                data = DonglifyConfigV1.convert_to_version(data)
-                cls.validate(data)
+                state = DongleState.validate(DonglifyConfigV1.convert_to_version(data))
                 good("dongle.ini has been converted to v1, manual verification is always recommended")
-                cls.ask_user_to_accept_config()
-                print("Would you like to save this configuration?")
-                if does_user_accept():
-                    cls.write()
-                    good("dongle.ini has been saved")
+                return state, True
             except Exception as _:
                 bad("could not convert dongle.ini to latest version")
                 bad("please fix dongle.ini manually and try again")
-                bad(f"Validation Exception: {e1}")
-                sys.exit(1)
-        
-    @classmethod
-    def validate(cls, data):
-        try:
-            state = DongleConfigV1Validator.validate_python(data, strict=True)
+                raise DonglifyError(f"Validation Exception: {e1}")
+
+    def load(self, data) -> bool:
+        # True when data was converted from an older version
+        state, converted = DongleState.parse(data)
+        with self.lock:
+            self.config = state.config
+            self.installs = state.installs
+            self.isos = state.isos
+            self.persists = state.persists
+        return converted
 
-            cls.config = state.config
-            cls.installs = state.installs
-            cls.isos = state.isos
+    def init(self, data):
+        converted = self.load(data)
+        self.ask_user_to_accept_config()
+        if converted:
+            print("Would you like to save this configuration?")
+            if self.assume_yes or does_user_accept():
+                self.write()
+                good("dongle.ini has been saved")
+
+    @staticmethod
+    def validate(data) -> DonglifyConfigV1:
+        try:
+            return DongleConfigV1Validator.validate_python(data, strict=True)
         except ValidationError as e:
             bad("dongle.ini is not valid: ")
             for error in e.errors():
@@ -99,79 +151,124 @@ class DonglifyState:
                 for l in error["loc"]:
                     loc += l.__str__() + "."
                 loc = loc[:-1]
-                bad(f" - Field: {loc} = {error["input"]}, {error["type"]}: {error["msg"]},")
-            raise Exception("Invalid dongle.ini")
+                bad(f" - Field: {loc} = {error['input']}, {error['type']}: {error['msg']},")
+            raise DonglifyError("Invalid dongle.ini")
+
+    def ask_user_to_accept_config(self):
+        if self.assume_yes:
+            return
 
-    @abstractmethod 
-    def ask_user_to_accept_config():
         print(colored("Please review that this dongle.ini is correct:", "yellow"))
-        parser = DonglifyState.create_parser()
+        parser = self.create_parser()
         parser.write(sys.stdout, space_around_delimiters=True)
 
         print("Looks good?")
         if not does_user_accept():
-            bad("dongle.ini has been rejected by user command.")
-            sys.exit(1)
+            raise DonglifyError("dongle.ini has been rejected by user command.")
 
-    @abstractmethod
-    def read():
+    @staticmethod
+    def load_data(path) -> dict:
         parser = configparser.ConfigParser()
         try:
-            parser.read("/boot/dongle.ini")
-            if not parser.sections():
-                bad("dongle.ini is empty")
-                sys.exit(1)
+            parser.read(path)
         except Exception as e:
-            bad("Error reading dongle.ini")
-            print(e)
-            sys.exit(1)
-        try:
-            data = {"isos": {}, "installs": {}}
-            for name in parser.sections():
-                if name == "dongle":
-                    data["config"] = dict(parser[name].items())
-                elif "iso." in name:
-                    data["isos"][name.split(".")[1]] = dict(parser[name].items())
-                else:
-                    data["installs"][name] = dict(parser[name].items())
-    
-            DonglifyState.init(data)
+            raise DonglifyError(f"Error reading dongle.ini: {e}")
+        if not parser.sections():
+            raise DonglifyError("dongle.ini is empty")
 
-        except Exception as e:
-            bad("Error parsing dongle.ini")
-            print(e)
-            sys.exit(1)
+        data = {"isos": {}, "installs": {}, "persists": {}}
+        for name in parser.sections():
+            if name == "dongle":
+                data["config"] = dict(parser[name].items())
+            elif name.startswith("persist."):
+                data["persists"][name.split(".", 1)[1]] = dict(parser[name].items())
+            elif "iso." in name:
+                data["isos"][name.split(".")[1]] = dict(parser[name].items())
+            else:
+                data["installs"][name] = dict(parser[name].items())
+        return data
+
+    def read(self, path=None, review=True):
+        # path defaults to the dongle's own dongle.ini, commits always go there
+        data = DongleState.load_data(path or self.path)
+        if review:
+            self.init(data)
+            self.committed = self.serialize()
+        else:
+            converted = self.load(data)
+            # a converted dongle.ini is written in the new format on the next commit
+            self.committed = b"" if converted else self.serialize()
+
+    def create_parser(self) -> configparser.ConfigParser:
+        return DongleState.build_parser(self.config, self.installs, self.isos, self.persists)
 
-    @classmethod
-    def create_parser(cls) -> configparser.ConfigParser:
+    @staticmethod
+    def build_parser(config: DongleDesc, installs: dict[str, DongleInstall],
+                     isos: dict[str, DongleISO],
+                     persists: dict[str, DonglePersist] = {}) -> configparser.ConfigParser:
         parser = configparser.ConfigParser()
-        parser.read_dict({"dongle": cls.config.model_dump()})
+        parser.read_dict({"dongle": config.model_dump()})
 
-        for name, install in DonglifyState.installs.items():
+        for name, install in installs.items():
             parser.read_dict({name: install.model_dump()})
 
-        for name, iso in DonglifyState.isos.items():
+        for name, iso in isos.items():
             parser.read_dict({"iso." + name: iso.model_dump()})
 
+        for name, persist in persists.items():
+            parser.read_dict({"persist." + name: persist.model_dump()})
+
         return parser
 
-    @classmethod
-    def write(cls):
-        parser = cls.create_parser()
-        with open("/boot/dongle.ini", 'w') as f:
-            parser.write(f, space_around_delimiters=True)
-
-        os.chmod("/boot/dongle.ini", 600)
-
-    @classmethod
-    def locate_and_load_config(cls, dev_name):
-        tell("attempting to locate dongle.ini")
-    
-        unlock_disk(dev_name, "dongleboot")
-        mount_mapper("dongleboot", "/boot")
-    
-        if not pathlib.Path("/boot/dongle.ini").exists():
-            bad("/boot/dongle.ini does not exist, choose another device partition or run dongle init")
-            sys.exit(1)
-    
-        cls.read()
+    def serialize(self) -> bytes:
+        return DongleState.serialize_parser(self.create_parser())
+
+    def write(self):
+        # inside a transaction the state is committed once when it ends
+        if self.transaction_depth == 0:
+            self.commit()
+
+    def commit(self) -> bool:
+        with self.lock:
+            if self.serialize() == self.committed:
+                return False
+
+            self.config.generation = str(int(self.config.generation) + 1)
+            data = self.serialize()
+            with DongleTrace.span("commit dongle.ini", generation=self.config.generation, path=self.path):
+                write_if_changed(self.path, data, mode=0o600)
+            self.committed = data
+            return True
+
+    def flush(self):
+        # run before the dongle's /boot is unmounted, the writes a transaction
+        # holds back would otherwise be committed to the empty mountpoint
+        if self.config is not None and os.path.ismount(os.path.dirname(self.path)):
+            self.commit()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # all writes of the block result in at most one commit of dongle.ini,
+        # when the block fails the in-memory state is rolled back instead
+        with self.lock:
+            snapshot = (self.config.model_copy(deep=True),
+                        {name: install.model_copy(deep=True) for name, install in self.installs.items()},
+                        {name: iso.model_copy(deep=True) for name, iso in self.isos.items()},
+                        {name: persist.model_copy(deep=True) for name, persist in self.persists.items()})
+            self.transaction_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.config, self.installs, self.isos, self.persists = snapshot
+                raise
+            finally:
+                self.transaction_depth -= 1
+
+            if self.transaction_depth == 0:
+                self.commit()
+
+    @staticmethod
+    def serialize_parser(parser: configparser.ConfigParser) -> bytes:
+        buffer = io.StringIO()
+        parser.write(buffer, space_around_delimiters=True)
+        return buffer.getvalue().encode('utf-8')
@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import select
+import socket
+import subprocess
+
+from donglify.lib import *
+
+from donglify.devices import *
+from donglify.mounts import *
+
+STATE_DIR = "/var/lib/donglify"
+# set by 'daemon notify' from the pacman hook, cleared once the dongle's
+# /boot was rebuilt
+PENDING_FILE = f"{STATE_DIR}/pending"
+# LUKS UUIDs of the /boot partitions of the dongles this host has synced
+KNOWN_FILE = f"{STATE_DIR}/dongles"
+SOCKET_PATH = "/run/donglify/daemon.sock"
+HOOK_PATH = "/etc/pacman.d/hooks/90-donglify.hook"
+SERVICE_PATH = "/etc/systemd/system/donglify.service"
+PACMAN_LOCK = "/var/lib/pacman/db.lck"
+NETLINK_KOBJECT_UEVENT = 15
+# the kernel's multicast group, udev's own is 2
+UEVENT_KERNEL_GROUP = 1
+# LUKS1 and LUKS2 keep the UUID at the same place of their binary header
+LUKS_UUID_OFFSET = 168
+LUKS_UUID_SIZE = 40
+
+class DongleDaemon:
+    # waits for kernel uevents instead of polling, a DONGLE_BOOT partition
+    # showing up while a rebuild is pending is unlocked and rebuilt in a
+    # child donglify process, which may exit on any error without taking the
+    # daemon with it
+    @staticmethod
+    def parse_uevent(data: bytes) -> dict[str, str]:
+        # "action@devpath\0KEY=VALUE\0..."
+        fields = data.decode('utf-8', errors='replace').split("\0")
+        event = {}
+        for field in fields[1:]:
+            key, sep, value = field.partition("=")
+            if sep:
+                event[key] = value
+        return event
+
+    @staticmethod
+    def luks_uuid(dev_name) -> str:
+        try:
+            with open(dev_name, "rb") as f:
+                if f.read(len(LUKS_MAGIC)) != LUKS_MAGIC:
+                    return ""
+                f.seek(LUKS_UUID_OFFSET)
+                return f.read(LUKS_UUID_SIZE).rstrip(b"\0").decode('ascii', errors='replace')
+        except OSError:
+            return ""
+
+    @staticmethod
+    def known_dongles() -> set[str]:
+        try:
+            with open(rooted(KNOWN_FILE)) as f:
+                return {line.strip() for line in f if line.strip() != ""}
+        except FileNotFoundError:
+            return set()
+
+    @staticmethod
+    def remember(uuid: str):
+        known = DongleDaemon.known_dongles()
+        if uuid in known:
+            return
+        os.makedirs(rooted(STATE_DIR), exist_ok=True)
+        with open(rooted(KNOWN_FILE), "a") as f:
+            f.write(uuid + "\n")
+
+    @staticmethod
+    def is_ours(dev_name) -> bool:
+        # before the first sync any DONGLE_BOOT partition is taken
+        known = DongleDaemon.known_dongles()
+        return len(known) == 0 or DongleDaemon.luks_uuid(dev_name) in known
+
+    @staticmethod
+    def dongle_of(event: dict[str, str]) -> str:
+        if event.get("ACTION") != "add" or event.get("SUBSYSTEM") != "block" or \
+                event.get("PARTNAME") != "DONGLE_BOOT" or "DEVNAME" not in event:
+            return None
+        # the uevent arrives before udev created the node and its links
+        execute(["udevadm", "settle", "--timeout=10"], desc="wait for udev to create the dongle's links",
+                check=False)
+        dev_name = "/dev/" + event["DEVNAME"]
+        return dev_name if DongleDaemon.is_ours(dev_name) else None
+
+    @staticmethod
+    def find_present() -> str:
+        for device in DeviceIndex.load().find_by_partlabel("DONGLE_BOOT"):
+            if DongleDaemon.is_ours(device.path):
+                return device.path
+        return None
+
+    @staticmethod
+    def is_pending() -> bool:
+        return os.path.exists(rooted(PENDING_FILE))
+
+    @staticmethod
+    def notify():
+        if os.environ.get(ENV_MARKER) is not None:
+            return
+        os.makedirs(rooted(STATE_DIR), exist_ok=True)
+        with open(rooted(PENDING_FILE), "w") as f:
+            f.write(f"{int(time.time())}\n")
+        tell("the dongle's /boot will be rebuilt when the dongle is plugged in")
+
+        # a running daemon syncs right away if the dongle is already in
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.sendto(b"pending", rooted(SOCKET_PATH))
+        except OSError:
+            pass
+
+    @staticmethod
+    def install():
+        for asset, dest in [("donglify.hook", HOOK_PATH), ("donglify.service", SERVICE_PATH)]:
+            path = rooted(dest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if write_if_changed(path, get_asset_data(asset), mode=0o644):
+                good(f"installed {dest}")
+            else:
+                good(f"{dest} is up to date")
+        tell("enable the daemon with 'systemctl enable --now donglify.service'")
+
+    @staticmethod
+    def wait_for_pacman():
+        # a kernel upgrade is still running when the dongle goes in mid way
+        while os.path.exists(rooted(PACMAN_LOCK)):
+            time.sleep(1)
+
+    @staticmethod
+    def unlock(dongle, key_file=None) -> bool:
+        dev_name = dongle.boot_part
+        if key_file is not None:
+            return execute(f"cryptsetup open {dev_name} {dongle.boot_name} --key-file={key_file}",
+                           desc=f"unlock the dongle's /boot {dev_name}", check=False) == 0
+        # the daemon has no terminal, the passphrase is asked on the console
+        # or the desktop's password agent
+        proc = subprocess.run(["systemd-ask-password", "--timeout=300", "--icon=drive-removable-media",
+                               f"Passphrase of the dongle's /boot ({dev_name}):"], capture_output=True)
+        if proc.returncode != 0:
+            return False
+        return execute(f"cryptsetup open {dev_name} {dongle.boot_name} --key-file=-",
+                       desc=f"unlock the dongle's /boot {dev_name}", input=proc.stdout.rstrip(b"\n"),
+                       check=False) == 0
+
+    @staticmethod
+    def sync(dev_name, key_file=None):
+        tell(f"dongle {dev_name} plugged in, rebuilding its /boot")
+        DongleDaemon.wait_for_pacman()
+        # the child works on the command line's dongle, same mappers and mountpoints
+        from donglify.dongle import Dongle
+        dongle = Dongle.host(dev_name)
+        if not disk_exists(f"/dev/mapper/{dongle.boot_name}") and not DongleDaemon.unlock(dongle, key_file):
+            bad(f"could not unlock {dev_name}, the rebuild stays pending")
+            return
+
+        proc = subprocess.run([sys.executable, "-m", "donglify.donglify", "--yes", "--dev", dev_name,
+                               "daemon", "sync"])
+        if proc.returncode == 0:
+            try:
+                os.remove(rooted(PENDING_FILE))
+            except FileNotFoundError:
+                pass
+            good(f"rebuilt the /boot of {dev_name}, safe to remove the dongle")
+            return
+
+        bad(f"rebuilding the /boot of {dev_name} failed with returncode {proc.returncode}, "
+            "the rebuild stays pending")
+        # the child may have left anything mounted
+        try:
+            dongle.umount_all()
+        except DonglifyError as e:
+            bad(str(e))
+
+    @staticmethod
+    def run(key_file=None, always=False):
+        uevents = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        uevents.bind((0, UEVENT_KERNEL_GROUP))
+
+        path = rooted(SOCKET_PATH)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        notifications = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        notifications.bind(path)
+
+        tell("waiting for the dongle and for kernel upgrades")
+        # the dongle may have been plugged in before the daemon started
+        dev_name = DongleDaemon.find_present()
+        if dev_name is not None and (always or DongleDaemon.is_pending()):
+            DongleDaemon.sync(dev_name, key_file)
+
+        while True:
+            readable, _, _ = select.select([uevents, notifications], [], [])
+            if uevents in readable:
+                dev_name = DongleDaemon.dongle_of(DongleDaemon.parse_uevent(uevents.recv(65536)))
+                if dev_name is not None and (always or DongleDaemon.is_pending()):
+                    DongleDaemon.sync(dev_name, key_file)
+            if notifications in readable:
+                notifications.recv(64)
+                dev_name = DongleDaemon.find_present()
+                if dev_name is not None:
+                    DongleDaemon.sync(dev_name, key_file)
+
+    @staticmethod
+    def main(args):
+        if args.daemon_cmd == "run":
+            DongleDaemon.run(args.key_file, args.always)
+        elif args.daemon_cmd == "notify":
+            DongleDaemon.notify()
+        elif args.daemon_cmd == "install":
+            DongleDaemon.install()
+        sys.exit(0)
@@ -0,0 +1,188 @@
+import os
+
+from donglify.lib import *
+from donglify.mounts import *
+
+LUKS_MAGIC = b"LUKS\xba\xbe"
+
+class BlockDevice:
+    def __init__(self, name: str, path: str, dev: str, size: int, parent=""):
+        self.name = name
+        self.path = path
+        # major:minor
+        self.dev = dev
+        # exact size in bytes
+        self.size = size
+        # kernel name of the whole disk for partitions, "" for disks
+        self.parent = parent
+        self.partlabel = ""
+        self.uuid = ""
+        self.fstype = ""
+        self.is_luks = False
+        # device-mapper names stacked on top, e.g. the unlocked LUKS container
+        self.holders: list[str] = []
+        self.mountpoints: list[str] = []
+
+    def to_dict(self) -> dict:
+        return {key: value for key, value in vars(self).items()}
+
+
+class DeviceIndex:
+    # one pass over /sys/block, /dev/disk and the mount table, backs uuid
+    # lookups, the status view and finding the dongle by its partition labels
+    def __init__(self, devices: dict[str, BlockDevice]):
+        self.devices = devices
+        self.by_uuid = {device.uuid: device for device in devices.values() if device.uuid != ""}
+
+    @staticmethod
+    def read(path, default=""):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            return default
+
+    @staticmethod
+    def read_uevent(path) -> dict[str, str]:
+        return dict(line.split("=", 1) for line in DeviceIndex.read(path).splitlines() if "=" in line)
+
+    @staticmethod
+    def read_links(directory) -> dict[str, str]:
+        # /dev/disk/by-* link name -> resolved device node
+        links = {}
+        try:
+            for name in os.listdir(directory):
+                links[os.path.realpath(os.path.join(directory, name))] = name.replace("\\x20", " ")
+        except FileNotFoundError:
+            pass
+        return links
+
+    @staticmethod
+    def load() -> "DeviceIndex":
+        devices = {}
+        nodes = {}
+
+        def add(sysdir, name, parent=""):
+            uevent = DeviceIndex.read_uevent(f"{sysdir}/uevent")
+            dev = DeviceIndex.read(f"{sysdir}/dev")
+            path = f"/dev/{name}"
+            dm_name = DeviceIndex.read(f"{sysdir}/dm/name")
+            if dm_name != "":
+                path = f"/dev/mapper/{dm_name}"
+            device = BlockDevice(name, path, dev, int(DeviceIndex.read(f"{sysdir}/size", "0")) * 512, parent)
+            device.partlabel = uevent.get("PARTNAME", "")
+            try:
+                device.holders = [DeviceIndex.read(f"/sys/block/{holder}/dm/name") or holder
+                                  for holder in os.listdir(f"{sysdir}/holders")]
+            except FileNotFoundError:
+                pass
+            devices[path] = device
+            nodes[f"/dev/{name}"] = device
+
+        for name in sorted(os.listdir("/sys/block")):
+            sysdir = f"/sys/block/{name}"
+            add(sysdir, name)
+            for child in sorted(os.listdir(sysdir)):
+                if os.path.exists(f"{sysdir}/{child}/partition"):
+                    add(f"{sysdir}/{child}", child, parent=name)
+
+        for node, uuid in DeviceIndex.read_links("/dev/disk/by-uuid").items():
+            if node in nodes:
+                nodes[node].uuid = uuid
+        for node, label in DeviceIndex.read_links("/dev/disk/by-partlabel").items():
+            if node in nodes and nodes[node].partlabel == "":
+                nodes[node].partlabel = label
+
+        for device in devices.values():
+            udev = DeviceIndex.read(f"/run/udev/data/b{device.dev}")
+            for line in udev.splitlines():
+                if line.startswith("E:ID_FS_TYPE="):
+                    device.fstype = line.split("=", 1)[1]
+            if device.fstype == "" and device.parent != "":
+                # without udev, look at the header ourselves, needs root
+                try:
+                    with open(device.path, "rb") as f:
+                        if f.read(len(LUKS_MAGIC)) == LUKS_MAGIC:
+                            device.fstype = "crypto_LUKS"
+                except OSError:
+                    pass
+            device.is_luks = device.fstype == "crypto_LUKS"
+
+        mounts = MountIndex.load()
+        for device in devices.values():
+            device.mountpoints = mounts.mountpoints_of(device.dev)
+
+        return DeviceIndex(devices)
+
+    def get(self, path) -> BlockDevice:
+        if path in self.devices:
+            return self.devices[path]
+        real = os.path.realpath(path)
+        for device in self.devices.values():
+            if f"/dev/{device.name}" == real:
+                return device
+        return None
+
+    def partitions_of(self, disk: BlockDevice) -> list[BlockDevice]:
+        return [device for device in self.devices.values() if device.parent == disk.name]
+
+    def find_by_partlabel(self, label) -> list[BlockDevice]:
+        return [device for device in self.devices.values() if device.partlabel == label]
+
+    def find_dongle_boot(self) -> str:
+        candidates = self.find_by_partlabel("DONGLE_BOOT")
+        if len(candidates) == 1:
+            return candidates[0].path
+        if len(candidates) == 0:
+            raise DonglifyError("no partition labeled DONGLE_BOOT found, is the dongle plugged in?")
+        raise DonglifyError("more than one DONGLE_BOOT partition found, choose one with --dev: " +
+                            ' '.join(device.path for device in candidates))
+
+    def disk_of(self, path) -> BlockDevice:
+        device = self.get(path)
+        if device is None:
+            return None
+        if device.parent == "":
+            return device
+        return self.devices.get(f"/dev/{device.parent}")
+
+    def sibling(self, path, partlabel) -> BlockDevice:
+        # the partition with this label on the disk of path
+        disk = self.disk_of(path)
+        if disk is None:
+            return None
+        for device in self.partitions_of(disk):
+            if device.partlabel == partlabel:
+                return device
+        return None
+
+    @staticmethod
+    def human_size(size: int) -> str:
+        for unit in ["B", "K", "M", "G"]:
+            if size < 1024:
+                return f"{size:.1f}{unit}" if unit != "B" else f"{size}{unit}"
+            size /= 1024
+        return f"{size:.1f}T"
+
+    def print_table(self, disk: BlockDevice):
+        print(f'{"NAME":<12}{"SIZE":>8}  {"PARTLABEL":<18}{"FSTYPE":<13}{"UUID":<38}MOUNTPOINTS')
+        for device in [disk] + self.partitions_of(disk):
+            print(f'{device.name:<12}{self.human_size(device.size):>8}  {device.partlabel:<18}'
+                  f'{device.fstype:<13}{device.uuid:<38}{" ".join(device.mountpoints)}')
+            for holder in device.holders:
+                mapper = self.devices.get(f"/dev/mapper/{holder}")
+                if mapper is not None:
+                    print(f'  {holder:<10}{self.human_size(mapper.size):>8}  {"":<18}'
+                          f'{mapper.fstype:<13}{mapper.uuid:<38}{" ".join(mapper.mountpoints)}')
+
+
+def get_uuid_by_dev(dev_name, index: DeviceIndex = None):
+    if index is None:
+        index = DeviceIndex.load()
+    device = index.get(dev_name)
+    if device is not None and device.uuid != "":
+        return device.uuid
+
+    # no udev managed /dev/disk/by-uuid for this device, probe it directly
+    return subprocess.run(["blkid", "-s", "UUID", "-o", "value", dev_name],
+                          capture_output=True).stdout.decode("utf-8").strip()
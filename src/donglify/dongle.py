@@ -0,0 +1,95 @@
+import os
+
+from donglify.lib import *
+
+from donglify.config import *
+from donglify.grub import *
+from donglify.mounts import *
+from donglify.devices import *
+
+# dongles handled side by side are mounted under <root>/<disk name>
+DONGLE_MOUNT_ROOT = "/mnt/donglify"
+
+class Dongle(DongleState):
+    # one dongle with its own dongle.ini state, LUKS mapper names and
+    # mountpoints, so one process can handle several of them at once, each
+    # from its own thread. Failures raise DonglifyError.
+    def __init__(self, boot_part: str = None, mountpoint_root=rooted(DONGLE_MOUNT_ROOT), tag=None):
+        self.boot_part = boot_part
+        if tag is None:
+            disk = DeviceIndex.load().disk_of(boot_part)
+            tag = os.path.basename(disk.path if disk is not None else boot_part)
+        # names the mappers and mountpoints, the disk's name by default
+        self.tag = tag
+        self.boot_name = f"dongleboot-{tag}"
+        self.persist_name = f"donglepersist-{tag}"
+        root = f"{mountpoint_root}/{tag}"
+        self.efi_dir = f"{root}/efi"
+        self.boot_dir = f"{root}/boot"
+        self.iso_dir = f"{root}/isos"
+        self.persist_dir = f"{root}/persist"
+        super().__init__(f"{self.boot_dir}/dongle.ini")
+
+    @staticmethod
+    def host(boot_part: str = None) -> "Dongle":
+        # the dongle of the command line, mounted at the host's /efi and
+        # /boot, which pacman and mkinitcpio build into
+        dongle = Dongle(boot_part, tag="")
+        dongle.boot_name, dongle.persist_name = "dongleboot", "donglepersist"
+        dongle.efi_dir, dongle.boot_dir = rooted("/efi"), rooted("/boot")
+        dongle.iso_dir, dongle.persist_dir = rooted("/mnt/iso"), rooted("/mnt/persist")
+        dongle.path = f"{dongle.boot_dir}/dongle.ini"
+        return dongle
+
+    @property
+    def title(self) -> str:
+        return f"the dongle {self.tag}" if self.tag else "the dongle"
+
+    def open(self, key_file=None, key=None, review=False):
+        # unlocks /boot and reads dongle.ini
+        with self.lock:
+            unlock_disk(self.boot_part, self.boot_name, key_file, key)
+            mount_mapper(self.boot_name, self.boot_dir)
+            if not os.path.exists(self.path):
+                raise DonglifyError(f"{self.boot_part} has no dongle.ini, choose another partition or run init")
+            self.read(review=review)
+
+    @DongleTrace.traced("mount dongle")
+    def mount_all(self):
+        with self.lock:
+            index = MountIndex.load()
+            actions = DongleMounts.plan_mount(
+                index,
+                [(self.config.efi_uuid, self.efi_dir, ""),
+                 (self.config.unlocked_boot_uuid, self.boot_dir, self.boot_name),
+                 (self.config.part_iso_uuid, self.iso_dir, "")],
+                [(self.config.locked_boot_uuid, self.boot_name)])
+            if not DongleMounts.check(DongleMounts.apply(actions)):
+                raise DonglifyError(f"could not mount {self.title}")
+            good(f"mounted all necessarily points from {self.title}")
+
+    @DongleTrace.traced("unmount dongle")
+    def umount_all(self, flush=True):
+        with self.lock:
+            # dongle.ini is never left to be committed after /boot is gone,
+            # unless the writes are dropped on purpose
+            if flush:
+                self.flush()
+            index = MountIndex.load()
+            actions = DongleMounts.plan_umount(index, [self.efi_dir, self.boot_dir, self.iso_dir],
+                                               [self.boot_name, self.persist_name])
+            if not DongleMounts.check(DongleMounts.apply(actions)):
+                raise DonglifyError(f"could not unmount {self.title}")
+            good(f"mounts of {self.title} are now clean, safe to remove it")
+
+    def grub_install(self, capture=False):
+        with self.lock:
+            DongleGrub.encrypted_install(self.efi_dir, self.boot_dir, self.config.locked_boot_uuid, capture)
+
+    def config_install(self):
+        with self.lock:
+            DongleGrub.config_install(self.boot_dir, self.installs, self.isos, self.config)
+
+
+# the dongle the command line works on, found and opened by donglify.main
+DonglifyState = Dongle.host()
@@ -1,174 +1,228 @@
 #!/bin/python3
 
-from prompt_toolkit import prompt
-from prompt_toolkit.completion import NestedCompleter
+import os
 import sys
-import subprocess
-import signal
-
-from termcolor import colored
+import argparse
 
+# only what every invocation needs is imported here, the commands pull in
+# pydantic, prompt_toolkit and friends when they actually run
 from donglify.lib import *
-from donglify.boot import *
-from donglify.grub import *
-from donglify.isos import *
-from donglify.config import *
-from donglify.partition import *
-
-# TODO: do real cleanup
 
-def dongle_add_current_system():
-    print("Fill configs for current system:")
+def is_read_only_command(args) -> bool:
+    return args.command in ("status", "list") or (args.command == "iso" and args.iso_cmd == "list") or \
+        (args.command == "persist" and args.persist_cmd == "list")
+
+
+def create_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="donglify",
+                                     description="The ultimate Archlinux encryption USB dongiled setup.")
+    parser.add_argument("--dev", help="the donglified USB /boot partition, e.g. /dev/sdb2, "
+                        "found by its DONGLE_BOOT partition label when omitted")
+    parser.add_argument("--yes", action="store_true", help="accept dongle.ini without review")
+    parser.add_argument("--version", action="store_true", help="print the version and exit")
+    parser.add_argument("--config", help="read this dongle.ini instead of locating the dongle, "
+                        "only for status, list, iso list and persist list")
+    parser.add_argument("--trace", metavar="FILE", help="record commands and phases with the bytes they wrote "
+                        "to the dongle, write them to FILE as Chrome trace JSON and print a summary at exit")
+    cmds = parser.add_subparsers(dest="command", metavar="command")
+
+    init = cmds.add_parser("init", help="partition and format a new dongle")
+    init.add_argument("device", help="the whole USB device, e.g. /dev/sdb")
+
+    reinit = cmds.add_parser("reinit", help="refresh a dongle in place, resetting only what is broken "
+                             "or asked for, the ISOs partition is kept")
+    reinit.add_argument("device", help="the whole USB device, e.g. /dev/sdb")
+    for part, help in [("efi", "reformat DONGLE_EFI"),
+                       ("boot", "re-create the /boot LUKS container with a new passphrase"),
+                       ("boot-fs", "reformat the filesystem inside the /boot LUKS container"),
+                       ("grub", "reinstall GRUB"),
+                       ("persist", "re-create the persistent partition, its data is lost")]:
+        reinit.add_argument(f"--{part}", action="store_true", help=help)
+
+    fleet = cmds.add_parser("fleet", help="provision many dongles from a spec file")
+    fleet.add_argument("spec")
+
+    for name in ["status", "list"]:
+        cmd = cmds.add_parser(name, help=f"show {name} of the dongle")
+        cmd.add_argument("--json", action="store_true")
+
+    cmds.add_parser("mount", help="mount all dongle partitions except donglepersist")
+    cmds.add_parser("unmount", help="unmount everything mount mounted")
+
+    add = cmds.add_parser("add", help="add the host system to the dongle")
+    add.add_argument("--name", required=True, help="install name, shown on GRUB")
+    add.add_argument("--kernel-name", required=True, help="kernel package name [linux/-hardened/-lts/..]")
+    add.add_argument("--kernel-args", default="")
+    add.add_argument("--ucode", required=True, help="microcode package [intel-ucode/amd-ucode]")
+    add.add_argument("--cryptokeyfile", default="", help="key file to be loaded into initramfs")
+    add.add_argument("--hooks-added", default="", help="hooks to be added to initramfs")
+
+    reinstall = cmds.add_parser("reinstall", help="reinstall an install's kernel and initramfs")
+    reinstall.add_argument("--install", required=True)
+
+    update = cmds.add_parser("update", help="run a system update and reinstall onto the dongle")
+    update.add_argument("--install", required=True)
+    update.add_argument("--cmd", required=True, help="the system's update command")
+
+    for cmd in [reinstall, update]:
+        cmd.add_argument("--incremental", action="store_true",
+                         help="skip the rebuild when packages and rendered configs are unchanged")
+        cmd.add_argument("--staged", action="store_true",
+                         help="build in a tmpfs with the dongle unmounted, then copy the changed images over "
+                         "and unmount the dongle")
+
+    iso = cmds.add_parser("iso", help="manage the dongle's ISOs")
+    iso_cmds = iso.add_subparsers(dest="iso_cmd", metavar="command", required=True)
+    iso_list = iso_cmds.add_parser("list")
+    iso_list.add_argument("--json", action="store_true")
+    iso_add = iso_cmds.add_parser("add")
+    iso_add.add_argument("--name", required=True)
+    iso_add.add_argument("--file", required=True, help="file name in the root of the ISOs partition")
+    iso_import = iso_cmds.add_parser("import", help="copy an iso onto the ISOs partition and add it")
+    iso_import.add_argument("path")
+    iso_import.add_argument("--name", help="defaults to the file name without .iso")
+    for cmd in [iso_add, iso_import]:
+        cmd.add_argument("--loopback-cfg", help="boot config inside the iso, found in the iso when omitted")
+        cmd.add_argument("--template", help="grub.d/isos template, see iso templates")
+    iso_verify = iso_cmds.add_parser("verify", help="hash new or changed isos and check vendor checksums")
+    iso_verify.add_argument("--workers", type=int, default=4)
+    iso_cmds.add_parser("templates")
+
+    initramfs = cmds.add_parser("initramfs", help="profile an install's initramfs")
+    initramfs_cmds = initramfs.add_subparsers(dest="initramfs_cmd", metavar="command", required=True)
+    initramfs_profile = initramfs_cmds.add_parser("profile", help="compare compressors and list what takes "
+                                                  "the space in the initramfs")
+    initramfs_profile.add_argument("--install", required=True)
+    initramfs_profile.add_argument("--top", type=int, default=15, help="how many files and hooks to list")
+    initramfs_profile.add_argument("--use", help="store this compression for the install, e.g. 'zstd -19', "
+                                   "or 'best' for the lowest estimated boot time")
+
+    store = cmds.add_parser("store", help="manage the deduplicated images on the dongle's /boot")
+    store_cmds = store.add_subparsers(dest="store_cmd", metavar="command", required=True)
+    store_report = store_cmds.add_parser("report", help="show the space used per install and the headroom")
+    store_report.add_argument("--json", action="store_true")
+    store_gc = store_cmds.add_parser("gc", help="remove images no install references")
+    store_gc.add_argument("--dry-run", action="store_true")
+
+    persist = cmds.add_parser("persist", help="mirror host directories to the persistent partition")
+    persist_cmds = persist.add_subparsers(dest="persist_cmd", metavar="command", required=True)
+    persist_add = persist_cmds.add_parser("add")
+    persist_add.add_argument("--name", required=True)
+    persist_add.add_argument("--path", required=True, help="host directory to mirror")
+    persist_remove = persist_cmds.add_parser("remove", help="stop syncing, the copy on the dongle is kept")
+    persist_remove.add_argument("--name", required=True)
+    persist_list = persist_cmds.add_parser("list")
+    persist_list.add_argument("--json", action="store_true")
+    persist_sync = persist_cmds.add_parser("sync", help="write what changed on the host to the dongle")
+    persist_sync.add_argument("--name", help="sync only this directory")
+    persist_sync.add_argument("--pull", action="store_true", help="mirror the dongle's copy to the host instead")
+    persist_sync.add_argument("--dry-run", action="store_true")
+    persist_sync.add_argument("--workers", type=int, default=4, help="files hashed in parallel")
+
+    luks = cmds.add_parser("luks", help="manage the dongle's LUKS key slots")
+    luks_cmds = luks.add_subparsers(dest="luks_cmd", metavar="command", required=True)
+    luks_tune = luks_cmds.add_parser("tune", help="pick key derivation costs for a target unlock time")
+    luks_tune.add_argument("--boot-target", type=float, default=3.0,
+                           help="seconds GRUB may take to unlock /boot")
+    luks_tune.add_argument("--persist-target", type=float, default=2.0,
+                           help="seconds Linux may take to unlock the persistent partition")
+    luks_tune.add_argument("--grub-slowdown", type=float, default=6.0,
+                           help="how many times slower GRUB's PBKDF2 is than cryptsetup's")
+    luks_tune.add_argument("--apply", action="store_true", help="re-tune the key slots of the dongle")
+
+    daemon = cmds.add_parser("daemon", help="rebuild the dongle's /boot when it is plugged in after a "
+                             "kernel upgrade")
+    daemon_cmds = daemon.add_subparsers(dest="daemon_cmd", metavar="command", required=True)
+    daemon_run = daemon_cmds.add_parser("run", help="wait for the dongle, run as root from a service")
+    daemon_run.add_argument("--key-file", help="unlock /boot with this key file instead of asking "
+                            "through systemd-ask-password")
+    daemon_run.add_argument("--always", action="store_true",
+                            help="rebuild on every insertion, not only after a kernel upgrade")
+    daemon_cmds.add_parser("notify", help="queue a rebuild, run by the pacman hook")
+    daemon_cmds.add_parser("install", help="install the pacman hook which runs notify and the service "
+                           "which runs the daemon")
+    daemon_cmds.add_parser("sync", help="rebuild the installs of this host now, run by the daemon")
+
+    return parser
 
-    name = input("install name, shown on GRUB: ")
-    current_install: DongleInstall = DongleInstallValidator.validate_python({
-        "kernel_name": input("kernel package name [linux/-hardened/-lts/..]: "),
-        "kernel_args": input("kernel args [optional]: "),
-        "ucode": input("microcode package to be installed [intel-ucode/amd-ucode]: "),
-        "cryptokeyfile": input("encryption key file to be loaded into initramfs [optional]: "),
-        "hooks_added": input("hooks to be added to initramfs [optional]: "),
-        "kernel_version": subprocess.run("uname -r", shell=True, capture_output=True).stdout.decode('utf-8').strip()
-    })
 
-    DonglifyState.installs[name] = current_install
-    DonglifyState.write()
+def main():
+    argv = sys.argv[1:]
+    # 'donglify /dev/sdX2' is kept as the short form of 'donglify --dev /dev/sdX2'
+    if len(argv) >= 1 and argv[0].startswith('/dev/'):
+        argv = ["--dev"] + argv
+
+    args = create_arg_parser().parse_args(argv)
+
+    if args.version or args.command is None:
+        import importlib.metadata
+        try:
+            version = importlib.metadata.version("donglify")
+        except importlib.metadata.PackageNotFoundError:
+            version = "unknown, running from source"
+        print(f"Version: {version}")
+        if args.version:
+            sys.exit(0)
 
-    tell("adding current host system to donglify")
-    dongle_umount_all()
-    ensure_local_dirs_mountpoint_only()
+    try:
+        run(args)
+    except DonglifyError as e:
+        bad(str(e))
+        sys.exit(e.returncode)
 
-    dongle_install_system(name)
 
+def run(args):
+    if args.trace is not None:
+        DongleTrace.enable(args.trace)
 
-def dongle_reinstall_system():
-    name = select_dongle_install()
-    if name == "":
-        bad("no available system configurations to reinstall")
+    if args.command == "init":
+        from donglify.partition import DonglePartitions
+        DongleTrace.watch(args.device)
+        DonglePartitions.init_device(args.device)
         return
-
-    dongle_install_system(name)
-
-
-def dongle_install_system(current_install_name: str):
-    DonglePartitions.mount_all()
-    DonglifyBoot.configure_sys(current_install_name)
-    DongleGrub.config_install()
-
-
-def dongle_list_installs():
-    if len(DonglifyState.installs) == 0:
-        bad("no system installs on dongle")
+    elif args.command == "reinit":
+        from donglify.reinit import DongleReinit, REINIT_PARTS
+        DongleTrace.watch(args.device)
+        DongleReinit.run(args.device, [part for part in REINIT_PARTS if getattr(args, part.replace("-", "_"))],
+                         args.yes)
         return
-
-    tell("listing registered installs on dongle")
-
-    for name, config in DonglifyState.installs.items():
-        print()
-        print(f'name: {name}')
-        print(f'kernel_name: {config.kernel_name}')
-        print(f'kernel_args: {config.kernel_args}')
-        print(f'kernel_version: {config.kernel_version}')
-        print(f'cryptokeyfile: {config.cryptokeyfile}')
-        print(f'hooks_added: {config.hooks_added}')
-        print(f'ucode: {config.ucode}')
-
-
-def select_dongle_install():
-    names = list(DonglifyState.installs.keys())
-
-    if len(names) == 0:
-        return ""
-
-    print("Select from available dongle install names:\n\t" +
-          colored(' '.join(names), 'green'))
-
-    return prompt("select> ", completer=WordCompleter(names, ignore_case=False))
-
-
-
-def dongle_safe_update():
-    name = select_dongle_install()
-    if name == "":
-        bad("no available installs, try the 'add' command first")
-
-    cmd = input("Enter your system's update command: ")
-    DonglePartitions.mount_all()
-    execute(cmd, "Runs user given system update command.")
-    dongle_install_system(name)
-
-donglify_iso_cmds = {
-    "list": None,
-    "add": None,
-    "templates": None
-}
-
-donglify_cmds = {'mount': None, 'unmount': None, 'add': None,
-                 'reinstall': None, 'update': None, 'status': None, 'list': None,
-                 "iso": donglify_iso_cmds}
-
-
-def main():
-    import importlib.metadata
-    version = importlib.metadata.version("donglify")
-    print(f"Version: {version}")
-
-    usage = f"Usage: donglify /dev/<name of usb>[index of encrypted dongleboot]\n" + \
-        "       donglify init /dev/<name of usb>"
-
-    if len(sys.argv) == 3 and "init" == sys.argv[1] and '/dev/' in sys.argv[2] and len(sys.argv[2]) == len('/dev/xyz'):
-        DonglePartitions.init_device(sys.argv[2])
-    elif len(sys.argv) != 2 or not '/dev/' in sys.argv[1] or not len(sys.argv[1]) >= len('/dev/xyz0'):
-        print(usage)
-        sys.exit(1)
-
-    def keyboard_interrupt_handler(x, y):
-        print()
-        print()
-        print("Farewell, Traveller.")
-        sys.exit(1)
-    signal.signal(signal.SIGINT, keyboard_interrupt_handler)
-
-    print("Welcome to donglify!")
-
-    try:
-        DonglifyState.locate_and_load_config(sys.argv[1])
-        DonglePartitions.mount_all()
-        while 1:
-            print(colored("available commands: " +
-                  ' '.join(donglify_cmds), 'dark_grey'))
-            user_input = prompt("donglify> ", completer=NestedCompleter.from_nested_dict(donglify_cmds))
-            if user_input == 'status':
-                subprocess.run("lsblk", shell=True)
-            elif user_input == 'list':
-                dongle_list_installs()
-            elif user_input == 'mount':
-                DonglePartitions.mount_all()
-                subprocess.run("lsblk", shell=True)
-            elif user_input == 'unmount':
-                dongle_umount_all()
-                subprocess.run("lsblk", shell=True)
-            elif user_input == 'add':
-                dongle_add_current_system()
-            elif user_input == 'reinstall':
-                dongle_reinstall_system()
-            elif user_input == 'update':
-                dongle_safe_update()
-            elif user_input == 'iso': 
-                print(colored("available iso commands: " +
-                  ' '.join(donglify_iso_cmds), 'dark_grey'))
-            elif user_input == 'iso list':
-                dongle_iso_list()
-            elif 'iso add' in user_input:
-                dongle_iso_add()
-            elif user_input == 'iso templates':
-                dongle_iso_list_templates()
-            else:
-                print(f'command {user_input} not recognized')
-                print("Commands: " + " ".join(donglify_cmds))
-    except (KeyboardInterrupt, EOFError):
-        print()
-        print("Farewell, Traveller.")
-        sys.exit(0)
+    elif args.command == "fleet":
+        from donglify.fleet import DongleFleet
+        DongleFleet.run(args.spec)
+        return
+    elif args.command == "daemon" and args.daemon_cmd != "sync":
+        from donglify.daemon import DongleDaemon
+        DongleDaemon.main(args)
+        return
+    os.environ[ENV_MARKER] = "1"
+
+    from donglify.config import DongleState
+    from donglify.dongle import DonglifyState
+    from donglify import commands
+
+    DongleState.assume_yes = args.yes
+    if args.config is not None:
+        if not is_read_only_command(args):
+            raise DonglifyError("--config can only be used with status, list, iso list and persist list")
+        DonglifyState.read(args.config)
+    else:
+        if args.dev is None:
+            from donglify.devices import DeviceIndex
+            args.dev = DeviceIndex.load().find_dongle_boot()
+            tell(f"found dongle /boot partition {args.dev}")
+        elif not len(args.dev) >= len('/dev/xyz0'):
+            create_arg_parser().print_usage()
+            raise DonglifyError("--dev must be the donglified USB /boot partition, e.g. --dev /dev/sdb2")
+        DongleTrace.watch(args.dev)
+        tell("attempting to locate dongle.ini")
+        DonglifyState.boot_part = args.dev
+        DonglifyState.open(review=True)
+
+    if args.command is None:
+        commands.repl()
+    else:
+        with DonglifyState.transaction():
+            commands.run_command(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import threading
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from donglify.lib import *
+from donglify.config import *
+from donglify.grub import *
+from donglify.partition import *
+from donglify.steps import *
+from donglify.catalog import DongleISOCatalog
+from donglify.layout import *
+from donglify.dongle import *
+
+class DongleFleetSpec(BaseModel, extra="forbid"):
+    devices: list[str]
+    iso_size: int
+    persistent_size: int
+    workers: int = 4
+    keyfile: str = ""
+    mountpoint_root: str = "/mnt/donglify"
+
+DongleFleetSpecValidator = TypeAdapter(DongleFleetSpec)
+
+class DongleFleetDevice(BaseModel, extra="forbid"):
+    keyfile: str = ""
+
+DongleFleetDeviceValidator = TypeAdapter(DongleFleetDevice)
+
+class DongleFleet:
+    # spec file layout:
+    #   [fleet]          devices, iso_size, persistent_size, workers, keyfile
+    #   [device.<sdX>]   keyfile, overrides the fleet keyfile for that device
+    #   [install.<name>] same fields as an install in dongle.ini
+    #   [iso.<name>]     same fields as an iso in dongle.ini, plus an optional
+    #                    source path copied onto the ISOs partition
+    # a keyfile of '-' reads that device's passphrase as one line from stdin.
+    @staticmethod
+    def read_spec(path):
+        parser = configparser.ConfigParser()
+        if not parser.read(path) or not parser.has_section("fleet"):
+            raise DonglifyError(f"{path} has no [fleet] section")
+
+        fleet = dict(parser["fleet"].items())
+        fleet["devices"] = fleet.get("devices", "").split()
+        spec = DongleFleetSpecValidator.validate_python(fleet)
+
+        devices = {dev_name: DongleFleetDevice() for dev_name in spec.devices}
+        installs = {}
+        isos = {}
+        sources = {}
+        for section in parser.sections():
+            data = dict(parser[section].items())
+            if section.startswith("device."):
+                dev_name = "/dev/" + section.split(".", 1)[1]
+                if dev_name not in devices:
+                    raise DonglifyError(f"[{section}] is not listed in the fleet devices")
+                devices[dev_name] = DongleFleetDeviceValidator.validate_python(data)
+            elif section.startswith("install."):
+                installs[section.split(".", 1)[1]] = DongleInstallValidator.validate_python(data)
+            elif section.startswith("iso."):
+                name = section.split(".", 1)[1]
+                source = data.pop("source", "")
+                isos[name] = DongleISOValidator.validate_python(data)
+                if source != "":
+                    sources[name] = source
+            elif section != "fleet":
+                raise DonglifyError(f"unknown section [{section}] in {path}")
+
+        return spec, devices, installs, isos, sources
+
+    @staticmethod
+    def plan(dev_name, spec: DongleFleetSpec) -> DongleLayout:
+        return DongleLayout.plan(DongleTopology.load(dev_name), spec.iso_size, spec.persistent_size)
+
+    @staticmethod
+    @DongleTrace.traced("provision")
+    def provision(dev_name, spec: DongleFleetSpec, key_file, key, installs, isos, sources, progress,
+                  layout: DongleLayout = None):
+        if layout is None:
+            layout = DongleFleet.plan(dev_name, spec)
+
+        # names the mappers and mountpoints, so the dongles never collide
+        dongle = Dongle(DonglePartitions.partition(dev_name, 2), spec.mountpoint_root,
+                        tag=os.path.basename(dev_name))
+
+        progress(dev_name, "partitioning")
+        execute(f'parted -s {dev_name} mklabel gpt', desc="set USB partition table as GPT", capture=True)
+        DonglePartitions.create_partitions(dev_name, layout, script=True)
+
+        progress(dev_name, "formatting")
+        with DongleTrace.span("format", device=dev_name):
+            run_steps(DonglePartitions.format_steps(dev_name, dongle.boot_name, dongle.persist_name,
+                                                    key_file=key_file, key=key, layout=layout))
+
+        config = DongleConfigValidator.validate_python(DonglePartitions.collect_uuids(dev_name, dongle.boot_name))
+        dongle.config, dongle.installs, dongle.isos = config, installs, isos
+
+        try:
+            if sources:
+                progress(dev_name, "copying isos")
+                mount(config.part_iso_uuid, dongle.iso_dir)
+                catalog = DongleISOCatalog.load(dongle.iso_dir)
+                for iso_name, source in sources.items():
+                    file_name = isos[iso_name].file_name
+                    with DongleTrace.span("copy iso", file=file_name, size=os.path.getsize(source)):
+                        sha256 = DongleISOCatalog.copy_image(source, f"{dongle.iso_dir}/{file_name}")
+                    catalog.add_image(file_name, sha256)
+
+            progress(dev_name, "installing grub")
+            mount(config.efi_uuid, dongle.efi_dir)
+            mount_mapper(dongle.boot_name, dongle.boot_dir)
+            dongle.grub_install(capture=True)
+            # the kernels of the installs are only put in place by a reinstall
+            # from the host system, until then their entries would not boot
+            DongleGrub.config_install(dongle.boot_dir, installs={}, isos=isos, config=config)
+
+            progress(dev_name, "writing dongle.ini")
+            dongle.commit()
+        except BaseException:
+            # a half provisioned dongle gets no dongle.ini, it is only
+            # unmounted and locked
+            try:
+                dongle.umount_all(flush=False)
+            except DonglifyError as e:
+                bad(f"{dev_name}: {e}")
+            raise
+        dongle.umount_all()
+
+        progress(dev_name, "done")
+        return config
+
+    @staticmethod
+    def run(spec_path):
+        try:
+            spec, devices, installs, isos, sources = DongleFleet.read_spec(spec_path)
+        except (ValidationError, DonglifyError) as e:
+            raise DonglifyError(f"could not read fleet spec {spec_path}\n{e}")
+
+        for dev_name in spec.devices:
+            if not disk_exists(dev_name):
+                raise DonglifyError(f"{dev_name} does not exist")
+            DongleTrace.watch(dev_name)
+
+        layouts = {dev_name: DongleFleet.plan(dev_name, spec) for dev_name in spec.devices}
+        for layout in layouts.values():
+            layout.print_plan()
+        for name, source in sources.items():
+            if not os.path.isfile(source):
+                raise DonglifyError(f"source of iso {name}, {source}, does not exist")
+
+        print(colored("Acknowledge that the following procedure *will* destroy ALL data on:\n  " +
+                      '\n  '.join(spec.devices) + "\nYOU WILL NOT BE ASKED AGAIN",
+                      'red', attrs=["reverse", "blink", "bold"]))
+        ack = input(
+            "Acknowledge by writing the following in caps: DESTROY MY DONGLES\n")
+        if ack != "DESTROY MY DONGLES":
+            print("Stopping procedure by user command. No data was lost.")
+            return
+
+        # passphrases are read up front in device order, so the workers never
+        # compete for stdin
+        keys = {}
+        for dev_name in spec.devices:
+            key_file = devices[dev_name].keyfile or spec.keyfile
+            if key_file == "":
+                raise DonglifyError(f"no keyfile given for {dev_name}, "
+                                    f"set keyfile in [fleet] or [device.{os.path.basename(dev_name)}]")
+            if key_file == "-":
+                line = sys.stdin.readline()
+                if line == "":
+                    raise DonglifyError(f"stdin ended before the passphrase of {dev_name}")
+                keys[dev_name] = (None, line.rstrip("\n").encode('utf-8'))
+            else:
+                keys[dev_name] = (key_file, None)
+
+        states = {dev_name: "queued" for dev_name in spec.devices}
+        states_lock = threading.Lock()
+
+        def progress(dev_name, state):
+            with states_lock:
+                states[dev_name] = state
+                finished = sum(1 for s in states.values() if s in ("done", "failed"))
+                tell(f"[{finished}/{len(states)}] {dev_name}: {state}")
+
+        def worker(dev_name):
+            start = time.monotonic()
+            try:
+                key_file, key = keys[dev_name]
+                config = DongleFleet.provision(dev_name, spec, key_file, key, installs, isos, sources, progress,
+                                               layouts[dev_name])
+                return config, time.monotonic() - start
+            except BaseException as e:
+                progress(dev_name, "failed")
+                bad(f"{dev_name} failed: {e!r}")
+                return None, time.monotonic() - start
+
+        with ThreadPoolExecutor(max_workers=spec.workers) as pool:
+            results = dict(zip(spec.devices, pool.map(worker, spec.devices)))
+
+        print()
+        print(f'{"device":<16}{"result":<10}{"time":>8}  efi uuid')
+        for dev_name, (config, elapsed) in results.items():
+            result = "ok" if config is not None else "failed"
+            efi_uuid = config.efi_uuid if config is not None else "-"
+            print(f'{dev_name:<16}{result:<10}{elapsed:>7.0f}s  {efi_uuid}')
+
+        failed = [dev_name for dev_name, (config, _) in results.items() if config is None]
+        if failed:
+            raise DonglifyError(f"{len(failed)} of {len(results)} dongles failed: {' '.join(failed)}")
+
+        good(f"all {len(results)} dongles have been provisioned")
+        if installs:
+            tell("run 'reinstall' from each host system to install the kernels of its installs")
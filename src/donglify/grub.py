@@ -1,45 +1,168 @@
+import os
+import re
 import shutil
 import pathlib
+import threading
 
 from donglify.lib import *
 from donglify.config import *
 
+# grub-install reads the host's /etc/default/grub, which is swapped for the
+# dongle template during the install, so only one install may run at a time
+default_grub_lock = threading.Lock()
+
+# per entry fragments and per group menus, under /boot/grub
+MENU_DIR = "donglify"
+
+# embedded into the core image on the unencrypted EFI partition. GRUB reads
+# every module it loads later from the encrypted /boot through its slow
+# software decryption, so everything grub.cfg uses is embedded: these unlock
+# /boot and read it and the ISO images, the rest comes from the menu's
+# templates, see DongleGrub.core_modules
+BASE_MODULES = ["part_gpt", "cryptodisk", "luks", "pbkdf2", "ext2", "iso9660", "normal"]
+# the module of each command the menu runs, None for the commands of GRUB's
+# kernel and normal.mod
+COMMAND_MODULES = {"insmod": None, "set": None, "export": None, "menuentry": None, "submenu": None,
+                   "search": "search", "configfile": "configfile", "source": "configfile", "echo": "echo",
+                   "test": "test", "loadfont": "font", "terminal_input": "terminal",
+                   "terminal_output": "terminal", "linux": "linux", "initrd": "linux", "loopback": "loopback"}
+# what render_menu itself puts into grub.cfg and the group files
+MENU_COMMANDS = ["submenu", "configfile", "source"]
+# LUKS1 header fields, NUL padded
+LUKS1_CIPHER_NAME = (8, 32)
+LUKS1_HASH_SPEC = (72, 32)
+LUKS_CIPHER_MODULES = {"aes": "gcry_rijndael", "serpent": "gcry_serpent", "twofish": "gcry_twofish"}
+LUKS_HASH_MODULES = {"sha1": "gcry_sha1", "sha256": "gcry_sha256", "sha512": "gcry_sha512"}
+
 class DongleGrub:
     @staticmethod
-    def encrypted_install():
-        shutil.move("/etc/default/grub", "/etc/default/grub.bak")
-    
-        template = get_asset_data("templates/defaultgrub").decode('utf-8')
-        pathlib.Path("/etc/default/grub").write_text(template)
-    
-        cmd = f'grub-install --target=x86_64-efi --efi-directory=/efi --bootloader-id=GRUB --removable'
-        execute(cmd, desc="install grub into dongle")
-    
-        shutil.move("/etc/default/grub.bak", "/etc/default/grub")
+    def core_modules() -> list[str]:
+        # every module the templates insmod and the module of every command
+        # they run
+        templates = ["grub.d/header.cfg", "grub.d/system.cfg"] + \
+            [f"grub.d/isos/{name}" for name in list_assets("grub.d/isos")]
+        commands = list(MENU_COMMANDS)
+        modules = list(BASE_MODULES)
+        for template in templates:
+            for line in get_asset_data(template).decode('utf-8').splitlines():
+                words = line.split()
+                if not words or words[0].startswith("#") or words[0] == "}" or "=" in words[0]:
+                    continue
+                commands.append(words[0])
+                if words[0] == "insmod":
+                    modules += words[1:]
+
+        for command in commands:
+            if command not in COMMAND_MODULES:
+                bad(f"no module known for the grub command {command}, it is loaded from the encrypted /boot")
+            elif COMMAND_MODULES[command] is not None:
+                modules.append(COMMAND_MODULES[command])
+        return list(dict.fromkeys(modules))
 
     @staticmethod
-    def config_install():
-        grubcfg = get_asset_data("grub.d/header.cfg").decode('utf-8')
-    
-        for name, config in DonglifyState.installs.items():
-            template = get_asset_data("grub.d/system.cfg").decode('utf-8')
-            template_line = template.replace("{name}", name.replace("iso.", ''))
-            template_line = template_line.replace("{kernel_args}", config.kernel_args)
-            template_line = template_line.replace("{kernel_version}", config.kernel_version)
-    
-            grubcfg += template_line
-    
-        for name, iso in DonglifyState.isos.items():
-            template = get_asset_data("grub.d/isos/loopback.cfg").decode('utf-8')
-            template_line = template.replace("{name}", name.replace("iso.", ''))
-            template_line = template_line.replace("{file_name}", iso.file_name)
-            template_line = template_line.replace("{loopback_cfg_location}", iso.loopback_cfg_location)
-            grubcfg += template_line
-        
-        pathlib.Path("/boot/grub/grub.cfg").write_text(grubcfg)
+    def crypto_modules(locked_boot_uuid: str) -> list[str]:
+        # the cipher and hash of the /boot LUKS1 header, cryptsetup's
+        # defaults when the header can not be read
+        cipher, hash_spec = "aes", "sha256"
+        try:
+            with open(f"/dev/disk/by-uuid/{locked_boot_uuid}", "rb") as f:
+                header = f.read(LUKS1_HASH_SPEC[0] + LUKS1_HASH_SPEC[1])
+            if header.startswith(b"LUKS\xba\xbe"):
+                cipher, hash_spec = [header[offset:offset + size].rstrip(b"\0").decode('ascii')
+                                     for offset, size in [LUKS1_CIPHER_NAME, LUKS1_HASH_SPEC]]
+        except (OSError, UnicodeDecodeError):
+            pass
+        return [LUKS_CIPHER_MODULES.get(cipher, "gcry_rijndael"), LUKS_HASH_MODULES.get(hash_spec, "gcry_sha256")]
+
+    @staticmethod
+    @DongleTrace.traced("grub-install")
+    def encrypted_install(efi_dir, boot_dir, locked_boot_uuid, capture=False):
+        modules = ' '.join(DongleGrub.core_modules() + DongleGrub.crypto_modules(locked_boot_uuid))
+
+        with default_grub_lock:
+            shutil.move(rooted("/etc/default/grub"), rooted("/etc/default/grub.bak"))
     
-        unicodepf2 = get_asset_data("unicode.pf2")
-        with open("/boot/grub/unicode.pf2", "wb") as f:
-            f.write(unicodepf2)
+            template = get_asset_data("templates/defaultgrub").decode('utf-8')
+            pathlib.Path(rooted("/etc/default/grub")).write_text(template)
     
-        good("grub.cfg has been written")
+            try:
+                cmd = f'grub-install --target=x86_64-efi --efi-directory={efi_dir} --boot-directory={boot_dir} ' + \
+                    f'--bootloader-id=GRUB --removable --modules="{modules}"'
+                execute(cmd, desc="install grub into dongle", capture=capture)
+            finally:
+                shutil.move(rooted("/etc/default/grub.bak"), rooted("/etc/default/grub"))
+
+    @staticmethod
+    def render_install(name: str, config: DongleInstall) -> str:
+        template = get_asset_data("grub.d/system.cfg").decode('utf-8')
+        template = template.replace("{name}", name.replace("iso.", ''))
+        template = template.replace("{kernel_args}", config.kernel_args)
+        return template.replace("{kernel_version}", config.kernel_version)
+
+    @staticmethod
+    def render_iso(name: str, iso: DongleISO, desc: DongleDesc) -> str:
+        template = get_asset_data(f"grub.d/isos/{iso.template}.cfg").decode('utf-8')
+        template = template.replace("{name}", name.replace("iso.", ''))
+        template = template.replace("{file_name}", iso.file_name)
+        template = template.replace("{loopback_cfg_location}", iso.loopback_cfg_location)
+        # found by its filesystem UUID, without looking into every
+        # partition of every disk for the file
+        return template.replace("{part_iso_uuid}", desc.part_iso_uuid)
+
+    @staticmethod
+    def iso_family(iso: DongleISO) -> str:
+        # archlinux-2024.01.01-x86_64.iso -> archlinux
+        family = re.match(r"[A-Za-z]+", os.path.basename(iso.file_name))
+        return family.group(0).lower() if family else "other"
+
+    @staticmethod
+    def fragment_name(kind: str, name: str) -> str:
+        return f"{kind}-" + re.sub(r"[^A-Za-z0-9._-]", "_", name.removeprefix(f"{kind}.")) + ".cfg"
+
+    @staticmethod
+    def render_menu(installs: dict[str, DongleInstall], isos: dict[str, DongleISO],
+                    desc: DongleDesc) -> dict[str, str]:
+        # path relative to /boot/grub -> content. grub.cfg only holds the
+        # header and one submenu per group, a group's file is read when it
+        # is selected and sources the fragment of each of its entries, so
+        # changing an entry rewrites that entry's fragment alone
+        files = {}
+        groups: dict[str, list[str]] = {}
+        for name, config in installs.items():
+            fragment = DongleGrub.fragment_name("install", name)
+            files[f"{MENU_DIR}/{fragment}"] = DongleGrub.render_install(name, config)
+            groups.setdefault("installs", []).append(fragment)
+        for name, iso in isos.items():
+            fragment = DongleGrub.fragment_name("iso", name)
+            files[f"{MENU_DIR}/{fragment}"] = DongleGrub.render_iso(name, iso, desc)
+            groups.setdefault(f"isos-{DongleGrub.iso_family(iso)}", []).append(fragment)
+
+        grubcfg = [get_asset_data("grub.d/header.cfg").decode('utf-8')]
+        for group in sorted(groups, key=lambda group: (group != "installs", group)):
+            title = "installs" if group == "installs" else f"[iso] {group.removeprefix('isos-')}"
+            grubcfg.append(f"submenu '{title}' {{\n"
+                           f"\tconfigfile $prefix/{MENU_DIR}/{group}.cfg\n}}\n")
+            files[f"{MENU_DIR}/{group}.cfg"] = ''.join(f"source $prefix/{MENU_DIR}/{fragment}\n"
+                                                       for fragment in groups[group])
+        files["grub.cfg"] = ''.join(grubcfg)
+        return files
+
+    @staticmethod
+    @DongleTrace.traced("grub config")
+    def config_install(boot_dir, installs: dict[str, DongleInstall], isos: dict[str, DongleISO],
+                       config: DongleDesc):
+        files = DongleGrub.render_menu(installs, isos, config)
+        os.makedirs(f"{boot_dir}/grub/{MENU_DIR}", exist_ok=True)
+        written = [path for path, content in files.items()
+                   if write_if_changed(f"{boot_dir}/grub/{path}", content.encode('utf-8'))]
+        # fragments of removed entries and emptied groups
+        for entry in os.listdir(f"{boot_dir}/grub/{MENU_DIR}"):
+            if f"{MENU_DIR}/{entry}" not in files:
+                os.remove(f"{boot_dir}/grub/{MENU_DIR}/{entry}")
+                written.append(f"{MENU_DIR}/{entry}")
+        if written:
+            good(f"grub menu: {len(written)} of {len(files)} files written or removed")
+        else:
+            tell("grub menu is up to date")
+
+        write_if_changed(f"{boot_dir}/grub/unicode.pf2", get_asset_data("unicode.pf2"))
@@ -0,0 +1,217 @@
+import os
+import re
+import time
+import shutil
+import tempfile
+import subprocess
+
+from donglify.lib import *
+
+from donglify.config import *
+from donglify.boot import *
+from donglify.dongle import Dongle
+
+# GRUB reads the initramfs through its own disk and LUKS1 code, without
+# AES-NI, far slower than the stick itself
+GRUB_READ_MIB_S = 15.0
+# block size of the /boot ext4, images take whole blocks on the dongle
+BOOT_BLOCK_SIZE = 4096
+CPIO_MAGIC = b"070701"
+CPIO_HEADER_SIZE = 110
+
+# (COMPRESSION, COMPRESSION_OPTIONS) of mkinitcpio.conf worth comparing
+COMPRESSORS = [("zstd", "-3"), ("zstd", "-9"), ("zstd", "-19"), ("lz4", ""), ("xz", ""), ("cat", "")]
+# the same pipelines mkinitcpio runs for each of them
+COMPRESS_COMMANDS = {
+    "zstd": ["zstd", "-q", "-T0"],
+    "lz4": ["lz4", "-q", "-l"],
+    "xz": ["xz", "-q", "-T0", "--check=crc32"],
+    "cat": ["cat"],
+}
+DECOMPRESS_COMMANDS = {
+    "zstd": ["zstd", "-d", "-q", "-c"],
+    "lz4": ["lz4", "-d", "-q", "-c"],
+    "xz": ["xz", "-d", "-q", "-c"],
+    "cat": ["cat"],
+}
+
+def compression_label(compression: str, options: str) -> str:
+    if compression == "":
+        return "default (zstd)"
+    return f"{compression} {options}".strip()
+
+
+class DongleInitramfsResult:
+    def __init__(self, compression: str, options: str, size: int, decompress_s: float):
+        self.compression = compression
+        self.options = options
+        # bytes the image takes on the dongle's /boot
+        self.size = size
+        self.decompress_s = decompress_s
+
+    @property
+    def label(self) -> str:
+        return compression_label(self.compression, self.options)
+
+    @property
+    def boot_s(self) -> float:
+        # reading the image in GRUB and decompressing it in the kernel
+        return self.size / (GRUB_READ_MIB_S * 1024 * 1024) + self.decompress_s
+
+
+class DongleInitramfs:
+    @staticmethod
+    def cpio_entries(data: bytes) -> list[tuple[str, int]]:
+        # (path, size) of the regular files of a newc archive, mkinitcpio
+        # may concatenate several with zero padding in between
+        entries = []
+        offset = 0
+        while offset + CPIO_HEADER_SIZE <= len(data):
+            if data[offset:offset + 6] != CPIO_MAGIC:
+                if data[offset:offset + 4] == b"\0\0\0\0":
+                    offset += 4
+                    continue
+                break
+            fields = [int(data[offset + 6 + i * 8:offset + 14 + i * 8], 16) for i in range(13)]
+            mode, file_size, name_size = fields[1], fields[6], fields[11]
+            name_start = offset + CPIO_HEADER_SIZE
+            name = data[name_start:name_start + name_size - 1].decode('utf-8', errors='replace')
+            data_start = -(-(name_start + name_size) // 4) * 4
+            offset = -(-(data_start + file_size) // 4) * 4
+            if name == "TRAILER!!!":
+                continue
+            if mode & 0o170000 == 0o100000:
+                entries.append(("/" + name.removeprefix("./").lstrip("/"), file_size))
+        return entries
+
+    @staticmethod
+    def hook_files(verbose_output: str) -> dict[str, str]:
+        # path -> build hook which added it, from 'mkinitcpio -v'
+        hook_of = {}
+        hook = "(base)"
+        for line in verbose_output.splitlines():
+            running = re.search(r"Running build hook: \[(.+?)\]", line)
+            adding = re.search(r"adding \w+: (\S+)", line)
+            if running:
+                hook = running.group(1)
+            elif adding:
+                hook_of.setdefault(adding.group(1), hook)
+        return hook_of
+
+    @staticmethod
+    @DongleTrace.traced("initramfs build")
+    def build(dongle: Dongle, name: str, image: str) -> dict[str, str]:
+        # one uncompressed image, the compressors are compared on it without
+        # rebuilding, returns the hook of every file
+        DonglifyBoot.setup_mkinitcpio_config(dongle, name)
+        cmd = ["mkinitcpio", "-v", "-z", "cat", "-k", f"{dongle.boot_dir}/vmlinuz-{name}", "-g", image]
+        tell(f"building an uncompressed initramfs of {name}")
+        with DongleTrace.span("mkinitcpio", "execute", cmd=' '.join(cmd)) as attrs:
+            proc = subprocess.run(cmd, capture_output=True)
+            attrs["returncode"] = proc.returncode
+        output = proc.stdout.decode('utf-8', errors='replace')
+        if proc.returncode != 0:
+            sys.stdout.write(output)
+            sys.stderr.write(proc.stderr.decode('utf-8', errors='replace'))
+            raise DonglifyError(f"mkinitcpio failed with returncode {proc.returncode}")
+        return DongleInitramfs.hook_files(output)
+
+    @staticmethod
+    def measure(image: str, compression: str, options: str, workdir: str) -> DongleInitramfsResult:
+        compressed = os.path.join(workdir, f"initramfs.{compression}{options}")
+        with open(image, "rb") as src, open(compressed, "wb") as dest:
+            subprocess.run(COMPRESS_COMMANDS[compression] + options.split(), stdin=src, stdout=dest, check=True)
+        size = -(-os.path.getsize(compressed) // BOOT_BLOCK_SIZE) * BOOT_BLOCK_SIZE
+
+        # best of three, the first run also pages the image in
+        decompress_s = 0.0
+        if compression != "cat":
+            timings = []
+            for _ in range(3):
+                with open(compressed, "rb") as src:
+                    start = time.perf_counter()
+                    subprocess.run(DECOMPRESS_COMMANDS[compression], stdin=src, stdout=subprocess.DEVNULL,
+                                   check=True)
+                    timings.append(time.perf_counter() - start)
+            decompress_s = min(timings)
+        os.remove(compressed)
+        return DongleInitramfsResult(compression, options, size, decompress_s)
+
+    @staticmethod
+    @DongleTrace.traced("initramfs profile")
+    def profile(dongle: Dongle, name: str, top=15) -> list[DongleInitramfsResult]:
+        results = []
+        with tempfile.TemporaryDirectory(prefix="donglify-initramfs-") as workdir:
+            image = os.path.join(workdir, "initramfs.cpio")
+            hook_of = DongleInitramfs.build(dongle, name, image)
+
+            for compression, options in COMPRESSORS:
+                if shutil.which(COMPRESS_COMMANDS[compression][0]) is None:
+                    bad(f"{COMPRESS_COMMANDS[compression][0]} is not installed, skipping {compression}")
+                    continue
+                results.append(DongleInitramfs.measure(image, compression, options, workdir))
+
+            with open(image, "rb") as f:
+                entries = DongleInitramfs.cpio_entries(f.read())
+
+        total = sum(size for _, size in entries)
+        print(f"uncompressed: {total / (1024 * 1024):.1f} MiB in {len(entries)} files")
+        print("largest files:")
+        for path, size in sorted(entries, key=lambda entry: -entry[1])[:top]:
+            print(f"  {size / 1024:>10.0f} KiB  {path}  [{DongleInitramfs.hook_of(path, hook_of)}]")
+
+        hooks = {}
+        for path, size in entries:
+            hook = DongleInitramfs.hook_of(path, hook_of)
+            hooks[hook] = hooks.get(hook, 0) + size
+        print("by hook:")
+        for hook, size in sorted(hooks.items(), key=lambda item: -item[1])[:top]:
+            print(f"  {size / 1024:>10.0f} KiB  {hook}")
+
+        current = dongle.installs[name]
+        # mkinitcpio's default is zstd at zstd's default level
+        setting = (current.compression, current.compression_options)
+        if setting == ("", ""):
+            setting = ("zstd", "-3")
+        print(f'{"compression":<16}{"size MiB":>10}{"decompress ms":>15}{"est. boot ms":>14}')
+        for result in sorted(results, key=lambda result: result.boot_s):
+            chosen = " *" if (result.compression, result.options) == setting else ""
+            print(f'{result.label:<16}{result.size / (1024 * 1024):>10.1f}{result.decompress_s * 1000:>15.1f}'
+                  f'{result.boot_s * 1000:>14.0f}{chosen}')
+        print(f"est. boot is reading at {GRUB_READ_MIB_S:.0f} MiB/s in GRUB plus decompressing on this machine, "
+              f"* is {name}'s current setting")
+
+        try:
+            stat = os.statvfs(dongle.boot_dir)
+            print(f"/boot has {stat.f_bavail * stat.f_frsize / (1024 * 1024):.0f} MiB free for every "
+                  f"install's images")
+        except OSError:
+            pass
+        return results
+
+    @staticmethod
+    def hook_of(path, hook_of: dict[str, str]) -> str:
+        if path in hook_of:
+            return hook_of[path]
+        # kernel modules are added in one batch after the hooks ran
+        if "/lib/modules/" in path:
+            return "(modules)"
+        return "(base)"
+
+    @staticmethod
+    def choose(dongle: Dongle, name: str, results: list[DongleInitramfsResult], label: str):
+        # 'best' is the lowest estimated boot time
+        if label == "best":
+            chosen = min(results, key=lambda result: result.boot_s)
+        else:
+            matches = [result for result in results if result.label == label]
+            if not matches:
+                raise DonglifyError(f"{label} was not profiled, choose one of: " +
+                                    ', '.join(result.label for result in results))
+            chosen = matches[0]
+
+        current = dongle.installs[name]
+        current.compression = chosen.compression
+        current.compression_options = chosen.options
+        dongle.write()
+        good(f"{name} now builds its initramfs with {chosen.label}, takes effect on the next reinstall")
@@ -0,0 +1,202 @@
+import mmap
+
+SECTOR_SIZE = 2048
+# volume descriptors start at sector 16 and end with a terminator
+FIRST_DESCRIPTOR = 16
+MAX_DESCRIPTORS = 64
+
+# boot configs GRUB can hand over to, in order of preference, with the
+# template of grub.d/isos that boots them
+BOOT_CONFIGS = [
+    ("/boot/grub/loopback.cfg", "loopback"),
+    ("/boot/grub/grub.cfg", "loopback"),
+    ("/EFI/BOOT/grub.cfg", "loopback"),
+]
+
+class ISO9660Entry:
+    def __init__(self, name: str, extent: int, size: int, is_dir: bool):
+        self.name = name
+        # first sector of the data
+        self.extent = extent
+        self.size = size
+        self.is_dir = is_dir
+        # as spelled on the image, set by lookup
+        self.path = ""
+
+
+class ISO9660Image:
+    # reads directory records straight out of a memory map of the image, so
+    # only the sectors of the directories on a looked up path are paged in.
+    # Names come from Rock Ridge NM entries when present, else from Joliet,
+    # else the plain ISO9660 names, lower cased without their ';1' suffix.
+    def __init__(self, path):
+        self.path = path
+        self.volume_label = ""
+        self.el_torito = False
+        self.root: ISO9660Entry = None
+        self.joliet = False
+        self.rock_ridge = False
+        self.susp_skip = 0
+
+        with open(path, "rb") as f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                self.map = b""
+        self.read_descriptors()
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read_descriptors(self):
+        primary_root = None
+        joliet_root = None
+        for sector in range(FIRST_DESCRIPTOR, FIRST_DESCRIPTOR + MAX_DESCRIPTORS):
+            descriptor = self.map[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE]
+            if len(descriptor) < SECTOR_SIZE or descriptor[1:6] != b"CD001":
+                break
+            kind = descriptor[0]
+            if kind == 0 and descriptor[7:30].rstrip(b"\0") == b"EL TORITO SPECIFICATION":
+                self.el_torito = True
+            elif kind == 1:
+                self.volume_label = descriptor[40:72].decode('ascii', errors='replace').strip()
+                primary_root = self.parse_record(descriptor, 156)[0]
+            elif kind == 2 and descriptor[88:91] in (b"%/@", b"%/C", b"%/E"):
+                joliet_root = self.parse_record(descriptor, 156)[0]
+            elif kind == 255:
+                break
+
+        if primary_root is None:
+            raise ValueError(f"{self.path} is not an ISO9660 image")
+
+        # GRUB prefers Rock Ridge over Joliet, names are looked up the same way
+        self.root = primary_root
+        self.detect_rock_ridge()
+        if not self.rock_ridge and joliet_root is not None:
+            self.root = joliet_root
+            self.joliet = True
+
+    def detect_rock_ridge(self):
+        # the SUSP 'SP' entry sits in the system use area of the root's '.'
+        start = self.root.extent * SECTOR_SIZE
+        length = self.map[start]
+        if length == 0:
+            return
+        name_length = self.map[start + 32]
+        system_use = self.map[start + 33 + name_length + (1 - name_length % 2):start + length]
+        if system_use[0:2] == b"SP" and system_use[4:6] == b"\xbe\xef":
+            self.susp_skip = system_use[6]
+            self.rock_ridge = True
+
+    def parse_record(self, data, offset) -> tuple[ISO9660Entry, int]:
+        # returns the entry and the length of the record, (None, 0) at padding
+        length = data[offset]
+        if length == 0:
+            return None, 0
+        extent = int.from_bytes(data[offset + 2:offset + 6], "little")
+        size = int.from_bytes(data[offset + 10:offset + 14], "little")
+        is_dir = bool(data[offset + 25] & 0x02)
+        name_length = data[offset + 32]
+        raw_name = data[offset + 33:offset + 33 + name_length]
+
+        if raw_name in (b"\0", b"\1"):
+            name = "." if raw_name == b"\0" else ".."
+        elif self.joliet:
+            name = raw_name.decode('utf-16-be', errors='replace').split(";")[0]
+        else:
+            # GRUB shows plain names in lower case
+            name = raw_name.decode('ascii', errors='replace').split(";")[0].lower()
+            if not is_dir:
+                name = name.rstrip(".")
+            if self.rock_ridge:
+                system_use_start = offset + 33 + name_length + (1 - name_length % 2) + self.susp_skip
+                name = self.rock_ridge_name(data[system_use_start:offset + length]) or name
+
+        return ISO9660Entry(name, extent, size, is_dir), length
+
+    def rock_ridge_name(self, system_use) -> str:
+        name = b""
+        # CE entries continue the system use area elsewhere on the image,
+        # bounded in case of a loop in a broken image
+        for _ in range(8):
+            continuation = None
+            i = 0
+            while i + 4 <= len(system_use):
+                signature = system_use[i:i + 2]
+                length = system_use[i + 2]
+                if length < 4:
+                    break
+                if signature == b"NM":
+                    name += system_use[i + 5:i + length]
+                elif signature == b"CE":
+                    block = int.from_bytes(system_use[i + 4:i + 8], "little")
+                    offset = int.from_bytes(system_use[i + 12:i + 16], "little")
+                    size = int.from_bytes(system_use[i + 20:i + 24], "little")
+                    continuation = (block * SECTOR_SIZE + offset, size)
+                elif signature == b"ST":
+                    break
+                i += length
+            if continuation is None:
+                break
+            start, size = continuation
+            system_use = self.map[start:start + size]
+        return name.decode('utf-8', errors='replace')
+
+    def list_dir(self, directory: ISO9660Entry) -> list[ISO9660Entry]:
+        entries = []
+        start = directory.extent * SECTOR_SIZE
+        data = self.map[start:start + directory.size]
+        offset = 0
+        while offset < len(data):
+            entry, length = self.parse_record(data, offset)
+            if entry is None:
+                # records never cross a sector, the rest of this one is padding
+                offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            if entry.name not in (".", ".."):
+                entries.append(entry)
+            offset += length
+        return entries
+
+    def lookup(self, path: str) -> ISO9660Entry:
+        # plain ISO9660 names are upper case, match case-insensitively
+        entry = self.root
+        entry.path = "/"
+        for part in [part for part in path.split("/") if part != ""]:
+            if not entry.is_dir:
+                return None
+            matches = [child for child in self.list_dir(entry) if child.name.lower() == part.lower()]
+            if not matches:
+                return None
+            exact = [child for child in matches if child.name == part]
+            parent = entry
+            entry = (exact or matches)[0]
+            entry.path = parent.path.rstrip("/") + "/" + entry.name
+        return entry
+
+    def find_boot_config(self) -> tuple[str, str]:
+        # the boot config path and the template to boot it with, ("", "")
+        # when the image has none GRUB can use
+        for path, template in BOOT_CONFIGS:
+            entry = self.lookup(path)
+            if entry is not None and not entry.is_dir:
+                return entry.path, template
+        return "", ""
+
+
+def inspect_iso(path) -> tuple[str, str, str]:
+    # (volume label, boot config, template), empty strings for a file
+    # which is not an ISO9660 image
+    try:
+        with ISO9660Image(path) as image:
+            return (image.volume_label,) + image.find_boot_config()
+    except (OSError, ValueError, IndexError):
+        return "", "", ""
@@ -1,15 +1,36 @@
 import os
+import json
+import shutil
 import pathlib
 
 from donglify.lib import *
 from donglify.grub import *
 
-from prompt_toolkit import prompt
-from prompt_toolkit.completion import WordCompleter
-
 from donglify.config import *
+from donglify.dongle import DonglifyState
+
+def load_iso_catalog(dest=None):
+    # only read when the partition is already mounted, listing never waits
+    # for a mount let alone for hashing
+    dest = DonglifyState.iso_dir if dest is None else dest
+    if not os.path.ismount(dest):
+        return None
+    from donglify.catalog import DongleISOCatalog
+    return DongleISOCatalog.load(dest)
+
+
+def dongle_iso_list(as_json=False):
+    catalog = load_iso_catalog()
+
+    if as_json:
+        isos = {}
+        for name, iso in DonglifyState.isos.items():
+            isos[name] = iso.model_dump()
+            if catalog is not None and iso.file_name in catalog.images:
+                isos[name]["image"] = catalog.images[iso.file_name].model_dump()
+        print(json.dumps(isos, indent=2))
+        return
 
-def dongle_iso_list():
     if len(DonglifyState.isos.items()) == 0:
         print("no isos are added to dongle")
         return
@@ -19,29 +40,164 @@ def dongle_iso_list():
         print(f'name: {name}')
         print(f'file_name: {iso.file_name}')
         print(f'loopback_cfg_location: {iso.loopback_cfg_location}')
+        print(f'template: {iso.template}')
+        if catalog is not None and iso.file_name in catalog.images:
+            image = catalog.images[iso.file_name]
+            print(f'size: {image.size}')
+            print(f'volume_label: {image.volume_label}')
+            if image.boot_config != "" and image.boot_config != iso.loopback_cfg_location:
+                bad(f'the boot config found in the iso is {image.boot_config}, '
+                    f'the entry uses {iso.loopback_cfg_location}')
+            elif image.boot_config == "":
+                bad('no boot config GRUB can use found in the iso')
+            print(f'sha256: {image.sha256 or "not hashed yet, run iso verify"}')
+            if image.checksum != "":
+                print(f'vendor checksum: {image.checksum}')
+
+
+@DongleTrace.traced("iso verify")
+def dongle_iso_verify(workers=4):
+    from donglify.catalog import DongleISOCatalog
+
+    dest = DonglifyState.iso_dir
+    mount(DonglifyState.config.part_iso_uuid, dest)
+    catalog = DongleISOCatalog.load(dest)
+    catalog.verify(workers)
+
+    for name, image in sorted(catalog.images.items()):
+        if image.checksum == "mismatch":
+            bad(f"{name}: sha256 does not match the vendor checksum")
+        elif image.checksum == "ok":
+            good(f"{name}: matches the vendor checksum")
+        else:
+            tell(f"{name}: {image.sha256}, no vendor checksum found")
+
+    mismatched = [name for name, image in sorted(catalog.images.items()) if image.checksum == "mismatch"]
+    if mismatched:
+        raise DonglifyError(f"{', '.join(mismatched)} do not match their vendor checksums")
+
+
+def iso_templates() -> list[str]:
+    return [name.removesuffix(".cfg") for name in list_assets("grub.d/isos")]
+
+
+def resolve_boot_config(path, loopback_cfg_location, template, interactive):
+    # fills in what was not given from the boot config found inside the image
+    from donglify.iso9660 import inspect_iso
+
+    _, boot_config, detected_template = inspect_iso(path)
+    if boot_config != "":
+        tell(f"found {boot_config} in {os.path.basename(path)}")
+
+    if loopback_cfg_location is None:
+        default = boot_config or "/boot/grub/loopback.cfg"
+        if interactive:
+            loopback_cfg_location = input(f"loopback.cfg location in ISO [{default}]: ") or default
+        elif boot_config == "":
+            raise DonglifyError(f"no boot config GRUB can use found in {os.path.basename(path)}, "
+                                "give one with --loopback-cfg")
+        else:
+            loopback_cfg_location = boot_config
+
+    if template is None:
+        template = detected_template or "loopback"
+    if template not in iso_templates():
+        raise DonglifyError(f"no iso template named {template}, available: {' '.join(iso_templates())}")
 
+    return loopback_cfg_location, template
 
-def dongle_iso_add():
-    dest = "/mnt/iso"
+
+@DongleTrace.traced("iso add")
+def dongle_iso_add(name=None, file_name=None, loopback_cfg_location=None, template=None):
+    interactive = name is None
+    dest = DonglifyState.iso_dir
     mount(DonglifyState.config.part_iso_uuid, dest)
     isos = os.listdir(dest)
 
-    name = input("Name of the system to be added: ")
+    if name is None:
+        name = input("Name of the system to be added: ")
 
-    iso: DongleISO = DongleISOValidator.validate_python({
-        "file_name": prompt(
+    if file_name is None:
+        from prompt_toolkit import prompt
+        from prompt_toolkit.completion import WordCompleter
+
+        file_name = prompt(
             "Filename of the iso on ISOs partition (must be in root of ISOs partition): ",
-            completer=WordCompleter(isos)),
-        "loopback_cfg_location": input(
-            "loopback.cfg location in ISO [/boot/grub/loopback.cfg]: ") or "/boot/grub/loopback.cfg"
+            completer=WordCompleter(isos))
+    elif file_name not in isos:
+        raise DonglifyError(f"{file_name} is not in the root of the ISOs partition")
+
+    loopback_cfg_location, template = resolve_boot_config(f"{dest}/{file_name}", loopback_cfg_location,
+                                                          template, interactive)
+
+    iso: DongleISO = DongleISOValidator.validate_python({
+        "file_name": file_name,
+        "loopback_cfg_location": loopback_cfg_location,
+        "template": template
     })
 
     DonglifyState.isos[name] = iso
 
-    grub_config_install()
+    DonglifyState.config_install()
+    DonglifyState.write()
+
+
+@DongleTrace.traced("iso import")
+def dongle_iso_import(path=None, name=None, loopback_cfg_location=None, template=None):
+    from donglify.catalog import DongleISOCatalog
+
+    interactive = path is None
+    if path is None:
+        path = input("Path of the iso to import: ")
+    if not os.path.isfile(path):
+        raise DonglifyError(f"{path} does not exist")
+
+    file_name = os.path.basename(path)
+    if name is None:
+        default = file_name.removesuffix('.iso')
+        name = (input(f"Name of the system to be added [{default}]: ") if interactive else "") or default
+    # checked on the source, before spending minutes on the copy
+    loopback_cfg_location, template = resolve_boot_config(path, loopback_cfg_location, template, interactive)
+
+    dest = DonglifyState.iso_dir
+    mount(DonglifyState.config.part_iso_uuid, dest)
+
+    free = shutil.disk_usage(dest).free
+    size = os.path.getsize(path)
+    if os.path.exists(f"{dest}/{file_name}"):
+        raise DonglifyError(f"{file_name} already exists on the ISOs partition")
+    if size > free + DongleISOCatalog.partial_size(f"{dest}/{file_name}"):
+        raise DonglifyError(f"{file_name} needs {size // (1024 * 1024)} MiB, "
+                            f"the ISOs partition has {free // (1024 * 1024)} MiB free")
+
+    tell(f"importing {path} to {dest}/{file_name}")
+    with DongleTrace.span("copy iso", file=file_name, size=size):
+        sha256 = DongleISOCatalog.copy_image(path, f"{dest}/{file_name}")
+
+    catalog = DongleISOCatalog.load(dest)
+    checksums = catalog.vendor_checksums(os.path.dirname(os.path.abspath(path)))
+    checksum = ""
+    if file_name in checksums:
+        checksum = "ok" if checksums[file_name] == sha256 else "mismatch"
+    if checksum == "mismatch":
+        # the copy is not kept, it would only take space on the ISOs partition
+        os.remove(f"{dest}/{file_name}")
+        raise DonglifyError(f"{file_name}: sha256 does not match the vendor checksum next to {path}, "
+                            "the copy was removed")
+    catalog.add_image(file_name, sha256, checksum)
+    good(f"{file_name} imported, sha256 {sha256}" + (", matches the vendor checksum" if checksum == "ok" else ""))
+
+    DonglifyState.isos[name] = DongleISOValidator.validate_python({
+        "file_name": file_name,
+        "loopback_cfg_location": loopback_cfg_location,
+        "template": template
+    })
+
+    DonglifyState.config_install()
     DonglifyState.write()
 
 
 def dongle_iso_list_templates():
     print("available iso grub configuration templates: ")
-    subprocess.run("ls grub.d/isos/", shell=True)
+    for template in iso_templates():
+        print(f"  {template}")
@@ -0,0 +1,158 @@
+import os
+import math
+
+from donglify.lib import *
+
+MiB = 1024 * 1024
+# USB sticks rarely report their erase block, 4 MiB covers the allocation
+# units of common flash and costs nothing on a multi-GB stick
+DEFAULT_ERASE_BLOCK = 4 * MiB
+# the backup GPT at the end of the disk
+GPT_BACKUP_SECTORS = 33
+EFI_SIZE = 256 * MiB
+BOOT_SIZE = 2048 * MiB
+# LUKS2 reserves 16 MiB for its header by default
+LUKS2_HEADER = 16 * MiB
+
+class DongleTopology:
+    def __init__(self, name: str, size: int, logical_block_size=512, physical_block_size=512,
+                 minimum_io_size=512, optimal_io_size=0, discard_granularity=0, alignment_offset=0):
+        self.name = name
+        # bytes
+        self.size = size
+        self.logical_block_size = logical_block_size
+        self.physical_block_size = physical_block_size
+        self.minimum_io_size = minimum_io_size
+        self.optimal_io_size = optimal_io_size
+        self.discard_granularity = discard_granularity
+        self.alignment_offset = alignment_offset
+
+    @staticmethod
+    def load(dev_name) -> "DongleTopology":
+        name = os.path.basename(os.path.realpath(dev_name))
+
+        def read(path, default=0):
+            try:
+                with open(f"/sys/block/{name}/{path}") as f:
+                    return int(f.read().strip())
+            except (OSError, ValueError):
+                return default
+
+        return DongleTopology(name, read("size") * 512,
+                              logical_block_size=read("queue/logical_block_size", 512),
+                              physical_block_size=read("queue/physical_block_size", 512),
+                              minimum_io_size=read("queue/minimum_io_size", 512),
+                              optimal_io_size=read("queue/optimal_io_size"),
+                              discard_granularity=read("queue/discard_granularity"),
+                              alignment_offset=read("alignment_offset"))
+
+    @property
+    def erase_block(self) -> int:
+        # every size the device reports as significant has to divide it
+        erase_block = DEFAULT_ERASE_BLOCK
+        for size in [self.physical_block_size, self.minimum_io_size, self.optimal_io_size,
+                     self.discard_granularity]:
+            if size > 0:
+                erase_block = math.lcm(erase_block, size)
+        return erase_block
+
+
+class DonglePartitionPlan:
+    def __init__(self, number: int, label: str, fstype: str, start: int, size: int):
+        self.number = number
+        self.label = label
+        # parted file system type hint, "" for none
+        self.fstype = fstype
+        # bytes, start and size are multiples of the erase block
+        self.start = start
+        self.size = size
+
+
+class DongleLayout:
+    def __init__(self, topology: DongleTopology, partitions: list[DonglePartitionPlan]):
+        self.topology = topology
+        self.partitions = partitions
+
+    @staticmethod
+    def plan(topology: DongleTopology, isos_size: int, persistent_size: int) -> "DongleLayout":
+        # sizes are in MiB, the persistent partition takes the rest of the
+        # disk when it is not 0, like parted's 100%. It is the only optional
+        # one, everything else expects the ISOs on 3 and it on 4.
+        if isos_size <= 0:
+            raise DonglifyError("the ISOs partition needs a size, dongle.ini refers to it")
+        erase_block = topology.erase_block
+
+        shift = topology.alignment_offset
+
+        def align_up(offset):
+            return -(-(offset - shift) // erase_block) * erase_block + shift
+
+        def align_down(offset):
+            return (offset - shift) // erase_block * erase_block + shift
+
+        end_of_disk = align_down(topology.size - GPT_BACKUP_SECTORS * topology.logical_block_size)
+        partitions = []
+        offset = align_up(MiB)
+        for label, fstype, size in [("DONGLE_EFI", "fat32", EFI_SIZE), ("DONGLE_BOOT", "", BOOT_SIZE),
+                                    ("DONGLE_ISOs", "", isos_size * MiB),
+                                    ("DONGLE_PERSISTENT", "", end_of_disk if persistent_size != 0 else 0)]:
+            if size == 0:
+                continue
+            available = end_of_disk - offset
+            # the persistent partition takes the rest, the others their size
+            size = available if label == "DONGLE_PERSISTENT" else align_up(size)
+            if size <= 0 or size > available:
+                raise DonglifyError(f"{label} does not fit on the {topology.size // MiB} MiB device, "
+                                    f"{max(available, 0) // MiB} MiB are left for it")
+            partitions.append(DonglePartitionPlan(len(partitions) + 1, label, fstype, offset, size))
+            offset += size
+
+        return DongleLayout(topology, partitions)
+
+    def get(self, label) -> DonglePartitionPlan:
+        for partition in self.partitions:
+            if partition.label == label:
+                return partition
+        return None
+
+    def sectors(self, size) -> int:
+        return size // self.topology.logical_block_size
+
+    def luks_args(self, luks_type) -> str:
+        # the encrypted data starts on an erase block boundary of the device
+        erase_block = self.topology.erase_block
+        if luks_type == "luks1":
+            return f" --align-payload={erase_block // 512}"
+        header = -(-LUKS2_HEADER // erase_block) * erase_block
+        return f" --offset={header // 512} --sector-size=4096"
+
+    def ext4_args(self, label) -> str:
+        # one erase block as the RAID stride makes the block allocator place
+        # file data and metadata on erase block boundaries. The inode tables
+        # and journal are initialized now, not by the kernel in the
+        # background the first time the dongle is mounted.
+        stride = self.topology.erase_block // 4096
+        args = f"-b 4096 -E stride={stride},stripe_width={stride},lazy_itable_init=0,lazy_journal_init=0"
+        if label == "DONGLE_BOOT":
+            args += " -J size=16"
+        elif label == "DONGLE_ISOs":
+            # few, multi-GB files, nothing of root's to reserve space for
+            args += " -T largefile -m 0 -J size=32"
+        return args
+
+    def vfat_args(self) -> str:
+        # the cluster size is left to mkfs.fat, 4 KiB clusters would leave the
+        # 256 MiB FAT32 below the 65525 clusters FAT32 needs, which firmware
+        # then takes for FAT16 or rejects
+        return f"-S {self.topology.logical_block_size}"
+
+    def print_plan(self):
+        topology = self.topology
+        print(f"{topology.name}: {topology.size // MiB} MiB, logical/physical block "
+              f"{topology.logical_block_size}/{topology.physical_block_size}, optimal io "
+              f"{topology.optimal_io_size}, discard granularity {topology.discard_granularity}")
+        print(f"partitions aligned to {topology.erase_block // 1024} KiB erase blocks:")
+        print(f'  {"#":<3}{"label":<20}{"start sector":>14}{"end sector":>14}{"size MiB":>10}')
+        for partition in self.partitions:
+            print(f'  {partition.number:<3}{partition.label:<20}{self.sectors(partition.start):>14}'
+                  f'{self.sectors(partition.start + partition.size) - 1:>14}{partition.size // MiB:>10}')
@@ -1,15 +1,38 @@
 import os
 import sys
+import hashlib
+import tempfile
+import functools
 import subprocess
 
-from termcolor import colored
-from prompt_toolkit import prompt
-from prompt_toolkit.completion import WordCompleter
+from donglify.trace import DongleTrace
 
 import logging
 logger = logging.getLogger("donglify")
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 
+# host paths go through rooted(), DONGLIFY_ROOT relocates all of them under
+# one directory, see benchmarks/e2e.py
+ROOT = os.environ.get("DONGLIFY_ROOT", "").rstrip("/")
+
+def rooted(path):
+    return ROOT + path
+
+
+class DonglifyError(Exception):
+    # raised instead of exiting, so a process handling several dongles at
+    # once survives the failure of one, the command line exits with
+    # returncode
+    def __init__(self, msg, returncode=1):
+        super().__init__(msg)
+        self.returncode = returncode
+
+
+# termcolor and prompt_toolkit are imported on first use, most invocations
+# never prompt and startup time matters when called from pacman hooks
+def colored(*args, **kwargs):
+    from termcolor import colored
+    return colored(*args, **kwargs)
 
 def good(msg):
     logger.info(colored(msg, "green"))
@@ -21,44 +44,102 @@ def tell(msg):
     logger.info(colored(msg, attrs=["bold"]))
 
 def does_user_accept():
+    from prompt_toolkit import prompt
     answer = str(prompt("[yes/no] > "))
     if answer.upper() == "YES":
         return True
     return False
 
+# set for everything donglify runs, the pacman hook ignores the pacman runs
+# of donglify itself, they are followed by a rebuild anyway
+ENV_MARKER = "DONGLIFY_RUNNING"
+
+
 def disk_exists(path):
     return os.path.exists(path)
 
-def execute(cmd, desc=""):
-    logger.info(colored("executing: ", "green", attrs=["bold"]) + colored(cmd, "yellow", attrs=["bold"]) +
+def execute(cmd, desc="", capture=False, input=None, check=True):
+    # a list is executed directly, without spawning a shell
+    shell = isinstance(cmd, str)
+    shown = cmd if shell else ' '.join(cmd)
+    logger.info(colored("executing: ", "green", attrs=["bold"]) + colored(shown, "yellow", attrs=["bold"]) +
         colored(f' # {desc}', "dark_grey"))
 
-    proc = subprocess.run(cmd, shell=True)
+    # captured commands keep their output off the terminal while other
+    # commands are running next to them, it is only shown when they fail
+    with DongleTrace.span(shown.split()[0], "execute", cmd=shown, desc=desc) as attrs:
+        proc = subprocess.run(cmd, shell=shell, capture_output=capture, input=input)
+        attrs["returncode"] = proc.returncode
     if 0 != proc.returncode:
+        if capture:
+            sys.stdout.write(proc.stdout.decode('utf-8', errors='replace'))
+            sys.stderr.write(proc.stderr.decode('utf-8', errors='replace'))
+        if check:
+            raise DonglifyError(f'{shown.split()[0]} failed with returncode {proc.returncode}', proc.returncode)
         print(
             colored(f'command failed with returncode {proc.returncode}', 'red'))
-        sys.exit(proc.returncode)
 
     return proc.returncode
 
 
-import pkgutil
+@functools.cache
 def get_asset_data(name):
+    import pkgutil
     data = pkgutil.get_data(__name__, "assets/" + name)
     if data is None:
         raise Exception("could not find assets/" + name)
     return data
 
+def list_assets(directory) -> list[str]:
+    import importlib.resources
+    return sorted(entry.name for entry in importlib.resources.files(__package__).joinpath(
+        "assets/" + directory).iterdir())
+
+def write_if_changed(path, data: bytes, mode=None) -> bool:
+    # writes to the dongle are slow and wear the flash, identical content is
+    # never rewritten and new content replaces the old file atomically
+    try:
+        if os.stat(path).st_size == len(data):
+            with open(path, "rb") as f:
+                if hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest():
+                    return False
+    except FileNotFoundError:
+        pass
+
+    dirname = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".donglify-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    dirfd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+    return True
+
 def unlock(uuid, cryptname):
     if not disk_exists(f'/dev/mapper/{cryptname}'):
         cmd = f'cryptsetup open /dev/disk/by-uuid/{uuid} {cryptname}'
         execute(cmd, desc=f'Unlock UUID={uuid} partition and name it as {cryptname}')
 
 
-def unlock_disk(disk, cryptname):
+def unlock_disk(disk, cryptname, key_file=None, key=None):
     if not disk_exists(f'/dev/mapper/{cryptname}'):
         cmd = f'cryptsetup open {disk} {cryptname}'
-        execute(cmd, desc=f'Unlock disk {disk} partition and name it as {cryptname}')
+        if key_file is not None or key is not None:
+            cmd += f' --key-file={key_file or "-"}'
+        execute(cmd, desc=f'Unlock disk {disk} partition and name it as {cryptname}', input=key)
 
 
 def lock(luksname):
@@ -76,6 +157,8 @@ def mount(uuid, dest):
 
 
 def mount_mapper(mapper_name, dest):
+    os.makedirs(dest, exist_ok=True)
+
     if not os.path.ismount(f'{dest}'):
         cmd = f'mount /dev/mapper/{mapper_name} {dest}'
         execute(cmd, desc=f'mount dongle\'s partition mapper name {mapper_name} to {dest}')
@@ -88,23 +171,8 @@ def umount(mntpnt):
 
 
 def ensure_local_dirs_mountpoint_only():
-    if not os.path.ismount("/efi") and not os.path.ismount("/boot"):
-        cmd = 'chattr +i /efi'
+    if not os.path.ismount(rooted("/efi")) and not os.path.ismount(rooted("/boot")):
+        cmd = f'chattr +i {rooted("/efi")}'
         execute(cmd, desc=f'make host /efi only a mountpoint')
-        cmd = 'chattr +i /boot'
+        cmd = f'chattr +i {rooted("/boot")}'
         execute(cmd, desc=f'make host /efi only a mountpoint')
-
-
-def get_uuid_by_dev(dev_name):
-    cmd = f'lsblk -n -oNAME,UUID {dev_name} --raw'
-    return subprocess.run(cmd, shell=True, capture_output=True).stdout.decode("utf-8") \
-        .strip().split('\n')[0].split(' ')[-1].strip()
-
-def dongle_umount_all():
-    umount("/efi")
-    umount("/boot")
-    umount("/mnt/iso")
-    lock("dongleboot")
-    lock("donglepersist")
-
-    good("system mounts are now clean, safe to remove dongle")
@@ -0,0 +1,170 @@
+import os
+import re
+import functools
+import threading
+import subprocess
+
+from donglify.lib import *
+
+# GRUB derives the key of the /boot partition with its own portable PBKDF2,
+# several times slower than cryptsetup's on the same CPU
+GRUB_SLOWDOWN = 6.0
+# the persistent partition is unlocked by Linux, but possibly on a slower
+# machine than the one the dongle was made on
+PERSIST_SLOWDOWN = 2.0
+BOOT_UNLOCK_TARGET = 3.0
+PERSIST_UNLOCK_TARGET = 2.0
+# ciphers GRUB's cryptodisk can open, in order of preference when equally fast
+GRUB_CIPHERS = ["aes-xts", "serpent-xts", "twofish-xts"]
+PBKDF2_HASH = "sha256"
+PBKDF2_MIN_ITERATIONS = 1000
+ARGON2_MIN_ITERATIONS = 4
+ARGON2_MAX_MEMORY = 1024 * 1024
+BENCHMARK_LOCK = threading.Lock()
+
+class DongleLuksBenchmark:
+    def __init__(self):
+        # hash -> iterations per second
+        self.pbkdf2: dict[str, int] = {}
+        # argon2i/argon2id -> (iterations, memory KiB, threads, ms)
+        self.argon2: dict[str, tuple[int, int, int, int]] = {}
+        # (cipher, key bits) -> (encryption MiB/s, decryption MiB/s)
+        self.ciphers: dict[tuple[str, int], tuple[float, float]] = {}
+
+    @staticmethod
+    def parse(output: str) -> "DongleLuksBenchmark":
+        benchmark = DongleLuksBenchmark()
+        for line in output.splitlines():
+            pbkdf2 = re.match(r"^PBKDF2-(\w+)\s+(\d+) iterations per second", line)
+            argon2 = re.match(r"^(argon2id?)\s+(\d+) iterations, (\d+) memory, (\d+) parallel threads.*"
+                              r"requested (\d+) ms", line)
+            cipher = re.match(r"^\s*([\w-]+)\s+(\d+)b\s+([\d.]+) MiB/s\s+([\d.]+) MiB/s", line)
+            if pbkdf2:
+                benchmark.pbkdf2[pbkdf2.group(1)] = int(pbkdf2.group(2))
+            elif argon2:
+                benchmark.argon2[argon2.group(1)] = tuple(int(argon2.group(n)) for n in range(2, 6))
+            elif cipher:
+                benchmark.ciphers[(cipher.group(1), int(cipher.group(2)))] = \
+                    (float(cipher.group(3)), float(cipher.group(4)))
+        return benchmark
+
+    @staticmethod
+    def run() -> "DongleLuksBenchmark":
+        # the LUKS steps of parallel formats wait for the one benchmark
+        # instead of running theirs side by side
+        with BENCHMARK_LOCK:
+            return DongleLuksBenchmark.measure()
+
+    @staticmethod
+    @functools.cache
+    def measure() -> "DongleLuksBenchmark":
+        # cached, provisioning many dongles benchmarks the host once
+        with DongleTrace.span("cryptsetup benchmark"):
+            proc = subprocess.run(["cryptsetup", "benchmark"], capture_output=True)
+        return DongleLuksBenchmark.parse(proc.stdout.decode('utf-8', errors='replace'))
+
+
+class DongleLuksParams:
+    def __init__(self, luks_type: str, cipher="", key_size=0, pbkdf="", iterations=0, memory=0, parallel=0):
+        self.luks_type = luks_type
+        # cryptsetup cipher spec, e.g. aes-xts-plain64, "" keeps the default
+        self.cipher = cipher
+        self.key_size = key_size
+        # pbkdf2 or argon2id, "" keeps cryptsetup's own calibration
+        self.pbkdf = pbkdf
+        self.iterations = iterations
+        # argon2 only, KiB
+        self.memory = memory
+        self.parallel = parallel
+
+    def pbkdf_args(self) -> str:
+        if self.pbkdf == "pbkdf2":
+            # LUKS1 has one hash for the whole header, set at luksFormat
+            hash_arg = f" --hash {PBKDF2_HASH}" if self.luks_type == "luks2" else ""
+            return f" --pbkdf pbkdf2{hash_arg} --pbkdf-force-iterations {self.iterations}"
+        if self.pbkdf.startswith("argon2"):
+            return f" --pbkdf {self.pbkdf} --pbkdf-memory {self.memory} --pbkdf-parallel {self.parallel} " \
+                   f"--pbkdf-force-iterations {self.iterations}"
+        return ""
+
+    def format_args(self) -> str:
+        args = ""
+        if self.cipher != "":
+            args += f" --cipher {self.cipher} --key-size {self.key_size}"
+        if self.pbkdf == "pbkdf2" and self.luks_type == "luks1":
+            args += f" --hash {PBKDF2_HASH}"
+        return args + self.pbkdf_args()
+
+    def describe(self) -> str:
+        if self.pbkdf == "":
+            return f"{self.luks_type}: cryptsetup defaults, no benchmark available"
+        described = f"{self.luks_type}: {self.cipher or 'default cipher'}"
+        if self.key_size:
+            described += f" {self.key_size} bit key"
+        described += f", {self.pbkdf} with {self.iterations} iterations"
+        if self.memory:
+            described += f", {self.memory // 1024} MiB, {self.parallel} threads"
+        return described
+
+
+class DongleLuks:
+    @staticmethod
+    def fastest_cipher(benchmark: DongleLuksBenchmark) -> tuple[str, int]:
+        # XTS with a 512 bit key is AES-256, taken unless it is much slower
+        best = None
+        for cipher in GRUB_CIPHERS:
+            for key_size in [512, 256]:
+                speed = benchmark.ciphers.get((cipher, key_size))
+                if speed is None:
+                    continue
+                if best is None or min(speed) > best[2] * 1.1:
+                    best = (cipher, key_size, min(speed))
+        if best is None:
+            return "", 0
+        return best[0] + "-plain64", best[1]
+
+    @staticmethod
+    def tune_boot(benchmark: DongleLuksBenchmark, target=BOOT_UNLOCK_TARGET,
+                  slowdown=GRUB_SLOWDOWN) -> DongleLuksParams:
+        rate = benchmark.pbkdf2.get(PBKDF2_HASH)
+        if rate is None:
+            return DongleLuksParams("luks1")
+        cipher, key_size = DongleLuks.fastest_cipher(benchmark)
+        iterations = max(PBKDF2_MIN_ITERATIONS, int(target * rate / slowdown))
+        return DongleLuksParams("luks1", cipher, key_size, "pbkdf2", iterations)
+
+    @staticmethod
+    def tune_persist(benchmark: DongleLuksBenchmark, target=PERSIST_UNLOCK_TARGET,
+                     slowdown=PERSIST_SLOWDOWN) -> DongleLuksParams:
+        if "argon2id" not in benchmark.argon2:
+            return DongleLuksParams("luks2")
+        iterations, memory, threads, ms = benchmark.argon2["argon2id"]
+        # the cost is about linear in iterations times memory
+        use_memory = min(memory, ARGON2_MAX_MEMORY)
+        scaled = iterations * (target * 1000 / ms) * (memory / use_memory) / slowdown
+        cipher, key_size = DongleLuks.fastest_cipher(benchmark)
+        return DongleLuksParams("luks2", cipher, key_size, "argon2id",
+                                max(ARGON2_MIN_ITERATIONS, int(scaled)), use_memory, min(threads, 4))
+
+    @staticmethod
+    @functools.cache
+    def default_params(luks_type) -> DongleLuksParams:
+        benchmark = DongleLuksBenchmark.run()
+        if luks_type == "luks1":
+            return DongleLuks.tune_boot(benchmark)
+        return DongleLuks.tune_persist(benchmark)
+
+    @staticmethod
+    def retune(dev_name, params: DongleLuksParams):
+        # rewrites the key slot the passphrase opens with new key derivation
+        # parameters, the data and the volume key are left alone. The cipher
+        # can only change by re-encrypting, which this does not do.
+        if params.pbkdf == "":
+            bad(f"no benchmark available, not re-tuning {dev_name}")
+            return
+        if params.luks_type == "luks1":
+            # asks for the old and the new passphrase, which may be the same
+            cmd = f"cryptsetup luksChangeKey{params.pbkdf_args()} {dev_name}"
+        else:
+            cmd = f"cryptsetup luksConvertKey{params.pbkdf_args()} {dev_name}"
+        execute(cmd, desc=f"re-tune the key slot of {dev_name}, {params.describe()}")
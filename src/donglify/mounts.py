@@ -0,0 +1,175 @@
+import os
+import threading
+
+from donglify.lib import *
+from donglify.steps import *
+
+class MountEntry:
+    def __init__(self, mountpoint: str, source: str, fstype: str, dev: str):
+        self.mountpoint = mountpoint
+        self.source = source
+        self.fstype = fstype
+        # major:minor of the mounted block device
+        self.dev = dev
+
+
+class MountIndex:
+    # one snapshot of the mount table and the device-mapper devices, the
+    # state every action below is computed against
+    def __init__(self, mounts: dict[str, MountEntry], mappers: dict[str, str]):
+        self.mounts = mounts
+        # mapper name -> major:minor
+        self.mappers = mappers
+
+    @staticmethod
+    def unescape(field: str) -> str:
+        # mountinfo escapes space, tab, newline and backslash as octal
+        return field.replace("\\040", " ").replace("\\011", "\t") \
+            .replace("\\012", "\n").replace("\\134", "\\")
+
+    @staticmethod
+    def load() -> "MountIndex":
+        mounts = {}
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields = line.split()
+                sep = fields.index("-")
+                mountpoint = MountIndex.unescape(fields[4])
+                # the last mount on a mountpoint is the visible one
+                mounts[mountpoint] = MountEntry(mountpoint, MountIndex.unescape(fields[sep + 2]),
+                                                fields[sep + 1], fields[2])
+
+        mappers = {}
+        try:
+            for block in os.listdir("/sys/block"):
+                if not block.startswith("dm-"):
+                    continue
+                with open(f"/sys/block/{block}/dm/name") as f:
+                    name = f.read().strip()
+                with open(f"/sys/block/{block}/dev") as f:
+                    mappers[name] = f.read().strip()
+        except FileNotFoundError:
+            pass
+
+        return MountIndex(mounts, mappers)
+
+    @staticmethod
+    def dev_of(path) -> str:
+        try:
+            rdev = os.stat(path).st_rdev
+        except FileNotFoundError:
+            return ""
+        return f"{os.major(rdev)}:{os.minor(rdev)}"
+
+    def is_mounted(self, mountpoint) -> bool:
+        return mountpoint in self.mounts
+
+    def is_unlocked(self, cryptname) -> bool:
+        return cryptname in self.mappers
+
+    def mountpoints_of(self, dev) -> list[str]:
+        return [entry.mountpoint for entry in self.mounts.values() if entry.dev == dev]
+
+
+class MountAction:
+    def __init__(self, name: str, cmd: list[str], desc: str, after=(), interactive=False):
+        self.name = name
+        self.cmd = cmd
+        self.desc = desc
+        self.after = list(after)
+        self.interactive = interactive
+
+
+class MountResult:
+    def __init__(self, action: MountAction, status: str, returncode=0):
+        self.action = action
+        # ok, failed or skipped, when an action it depends on did not succeed
+        self.status = status
+        self.returncode = returncode
+
+    def __repr__(self):
+        return f"MountResult({self.action.name}, {self.status}, {self.returncode})"
+
+
+class DongleMounts:
+    @staticmethod
+    def plan_mount(index: MountIndex, mounts: list[tuple[str, str, str]],
+                   unlocks: list[tuple[str, str]]) -> list[MountAction]:
+        # mounts are (uuid, mountpoint, cryptname the uuid lives in or ""),
+        # unlocks are (uuid, cryptname), mounts inside a LUKS container wait
+        # for its unlock while the others run next to it
+        actions = []
+        unlocked_by = {}
+        for uuid, cryptname in unlocks:
+            if index.is_unlocked(cryptname):
+                continue
+            actions.append(MountAction(f"unlock {cryptname}",
+                                       ["cryptsetup", "open", f"/dev/disk/by-uuid/{uuid}", cryptname],
+                                       f"Unlock UUID={uuid} partition and name it as {cryptname}",
+                                       interactive=True))
+            unlocked_by[cryptname] = actions[-1].name
+
+        for uuid, mountpoint, cryptname in mounts:
+            if index.is_mounted(mountpoint):
+                entry = index.mounts[mountpoint]
+                dev = index.dev_of(f"/dev/disk/by-uuid/{uuid}")
+                if dev != "" and dev != entry.dev:
+                    bad(f"{mountpoint} is already mounted from {entry.source}, leaving it as is")
+                continue
+            os.makedirs(mountpoint, exist_ok=True)
+            actions.append(MountAction(f"mount {mountpoint}", ["mount", f"UUID={uuid}", mountpoint],
+                                       f"mount dongle's partition UUID={uuid} to {mountpoint}",
+                                       after=[unlocked_by[cryptname]] if cryptname in unlocked_by else []))
+        return actions
+
+    @staticmethod
+    def plan_umount(index: MountIndex, mountpoints: list[str], cryptnames: list[str]) -> list[MountAction]:
+        actions = []
+        umounted = {}
+        for mountpoint in mountpoints:
+            if index.is_mounted(mountpoint):
+                actions.append(MountAction(f"umount {mountpoint}", ["umount", mountpoint],
+                                           f"un-mount dongle's {mountpoint}"))
+                umounted[mountpoint] = actions[-1].name
+
+        for cryptname in cryptnames:
+            if not index.is_unlocked(cryptname):
+                continue
+            after = []
+            for mountpoint in index.mountpoints_of(index.mappers[cryptname]):
+                if mountpoint not in umounted:
+                    actions.append(MountAction(f"umount {mountpoint}", ["umount", mountpoint],
+                                               f"un-mount {mountpoint} of {cryptname}"))
+                    umounted[mountpoint] = actions[-1].name
+                after.append(umounted[mountpoint])
+            actions.append(MountAction(f"lock {cryptname}", ["cryptsetup", "close", cryptname],
+                                       f"Lock the dongle's {cryptname} parition", after=after))
+        return actions
+
+    @staticmethod
+    def apply(actions: list[MountAction]) -> list[MountResult]:
+        results = {}
+        results_lock = threading.Lock()
+
+        def run(action: MountAction):
+            with results_lock:
+                blocked = any(results[dep].status != "ok" for dep in action.after)
+            if blocked:
+                result = MountResult(action, "skipped")
+            else:
+                returncode = execute(action.cmd, desc=action.desc, capture=not action.interactive, check=False)
+                result = MountResult(action, "ok" if returncode == 0 else "failed", returncode)
+            with results_lock:
+                results[action.name] = result
+
+        run_steps([DongleStep(action.name, lambda action=action: run(action), after=action.after,
+                              interactive=action.interactive) for action in actions])
+        return [results[action.name] for action in actions]
+
+    @staticmethod
+    def check(results: list[MountResult]) -> bool:
+        failed = [result for result in results if result.status != "ok"]
+        for result in failed:
+            bad(f"{result.action.name}: {result.status}" +
+                (f" with returncode {result.returncode}" if result.status == "failed" else ""))
+        return not failed
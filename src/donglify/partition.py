@@ -1,14 +1,19 @@
 import sys
 import subprocess
 
-from termcolor import colored
-
 from donglify.lib import *
 from donglify.config import *
 from donglify.grub import *
+from donglify.steps import *
+from donglify.mounts import *
+from donglify.devices import *
+from donglify.layout import *
+from donglify.luks import *
+from donglify.dongle import DonglifyState
 
 class DonglePartitions:
     @staticmethod
+    @DongleTrace.traced("init")
     def init_device(dev_name):
         print(colored(f"Acknowledge that the following procedure *will* destroy ALL data on '{dev_name}'\n"
                       "YOU WILL NOT BE ASKED AGAIN", 'red', attrs=["reverse", "blink", "bold"]))
@@ -19,113 +24,156 @@ class DonglePartitions:
             print("Farewell.")
             sys.exit(0)
     
-        cmd = f'sudo parted {dev_name} mklabel gpt'
-        execute(cmd, desc="set USB partition table as GPT")
+        dongle = DeviceIndex.load().get(dev_name)
+        if dongle is None:
+            raise DonglifyError(f"{dev_name} is not a block device")
     
-        cmd = f'lsblk -n -oNAME,SIZE {dev_name}'
-        dongle_size = str(subprocess.run(cmd, shell=True, capture_output=True) \
-                          .stdout.decode('utf-8')).strip().split(' ')[1].replace("G", "")
+        print("dongle has size: " + DeviceIndex.human_size(dongle.size))
     
-        print("dongle has size: " + dongle_size + "GB")
-    
-        dongle_isos_size = int(0.5 * float(dongle_size) * 1024)
-        dongle_persistent_size = int(0.5 * float(dongle_size) * 1024)
+        # what is left after the EFI and boot partitions
+        topology = DongleTopology.load(dev_name)
+        free_size = (topology.size - EFI_SIZE - BOOT_SIZE) // MiB - 2 * topology.erase_block // MiB
+        dongle_isos_size = int(0.5 * free_size)
+        dongle_persistent_size = int(0.5 * free_size)
     
         print("recommended partition scheme: ")
-        print("DONGLE_EFI partition: 256 MB")
-        print("DONGLE_BOOT partition: 2048 MB")
-        print("DONGLE_ISOs partition: " + str(dongle_isos_size) + " MB")
+        print(f"DONGLE_EFI partition: {EFI_SIZE // MiB} MiB")
+        print(f"DONGLE_BOOT partition: {BOOT_SIZE // MiB} MiB")
+        print("DONGLE_ISOs partition: " + str(dongle_isos_size) + " MiB")
         print("DONGLE_PERSISTENT partition: " +
-              str(dongle_persistent_size) + " MB")
+              str(dongle_persistent_size) + " MiB")
     
         iso_size = input(
-            "What would you like to have for ISO partition size in MB? [empty for same] ")
+            "What would you like to have for ISO partition size in MiB? [empty for same] ")
         persistent_size = input(
-            "What would you like to have for persistent partition size in MB? [empty for same] ")
+            "What would you like to have for persistent partition size in MiB? [empty for same] ")
     
         if iso_size != "":
             dongle_isos_size = int(iso_size)
         if persistent_size != "":
             dongle_persistent_size = int(persistent_size)
+
+        layout = DongleLayout.plan(topology, dongle_isos_size, dongle_persistent_size)
+        layout.print_plan()
+        print("Apply this layout?")
+        if not does_user_accept():
+            print("Stopping procedure by user command. No data was lost.")
+            sys.exit(0)
+
+        cmd = f'sudo parted {dev_name} mklabel gpt'
+        execute(cmd, desc="set USB partition table as GPT")
     
-        current_offset = 8
-        parted = "parted -a optimal"
-        cmd = f'{parted} {dev_name} mkpart "DONGLE_EFI" fat32 {str(current_offset)}MB 256MB'
-        execute(cmd, desc="create efi partition on dongle")
-    
-        cmd = f'{parted} {dev_name} set 1 esp on'
-        execute(cmd, desc="mark /efi as esp")
-    
-        current_offset += 256 + 8
-        cmd = f'{parted} {dev_name} mkpart "DONGLE_BOOT" {str(current_offset)}MB {str(2048 + current_offset)}MB'
-        execute(cmd, desc="create boot partition on dongle")
-    
-        cmd = f'{parted} {dev_name} set 2 boot on'
-        execute(cmd, desc="mark /boot as boot")
-    
-        current_offset += 2048 + 8
-        if iso_size != 0:
-            cmd = f'{parted} {dev_name} mkpart "DONGLE_ISOs" {str(current_offset)}MB {str(dongle_isos_size + current_offset)}MB'
-            execute(cmd, desc="create ISOs partition on dongle")
-            current_offset += dongle_isos_size + 8
-    
-        if persistent_size != 0:
-            cmd = f'{parted} {dev_name} mkpart "DONGLE_PERSISTENT" {str(current_offset)}MB 100%'
-            execute(cmd, desc="create persistent partition on dongle")
-    
-        cmd = f'mkfs.vfat -n DONGLE_EFI  -F 32 {dev_name}1'
-        execute(cmd, desc="format DONGLE_EFI as FAT16")
-    
-        cmd = f'cryptsetup luksFormat --type luks1 {dev_name}2'
-        execute(cmd, desc="encrypt dongle's /boot partition, user will be asked for passphrase automatically")
-    
-        unlock_disk(f'{dev_name}2', "dongleboot")
-    
-        cmd = f'mkfs.ext4 /dev/mapper/dongleboot'
-        execute(cmd, desc="format dongle's /boot partition as ext4")
-    
-        cmd = f'mkfs.ext4 {dev_name}3'
-        execute(cmd, desc="format dongle's ISOs partition as ext4")
-    
-        cmd = f'cryptsetup luksFormat --type luks2 {dev_name}4'
-        execute(cmd, desc="encrypt dongle's persistent partition, user will be asked for passphrase automatically")
-    
-        unlock_disk(f'{dev_name}4', "donglepersist")
-        cmd = f'mkfs.ext4 /dev/mapper/donglepersist'
-        execute(cmd, desc="format dongle's persistent partition")
+        DonglePartitions.create_partitions(dev_name, layout)
+
+        # once the partition table exists the partitions are formatted
+        # independently, the big mkfs.ext4 runs overlap the passphrase prompts
+        with DongleTrace.span("format", device=dev_name):
+            run_steps(DonglePartitions.format_steps(dev_name, layout=layout))
     
         # find uuids and fill into /boot/dongle.ini
         data = {
-            "config": {
-                "version": DonglifyState.LATEST_VERSION,
-                "efi_uuid": get_uuid_by_dev(f'{dev_name}1'),
-                "locked_boot_uuid": get_uuid_by_dev(f'{dev_name}2'),
-                "unlocked_boot_uuid": get_uuid_by_dev("/dev/mapper/dongleboot"),
-                "part_iso_uuid": get_uuid_by_dev(f'{dev_name}3'),
-            },
+            "config": DonglePartitions.collect_uuids(dev_name),
             "installs": {},
             "isos": {}
         }
         DonglifyState.init(data)
     
         # grub-install
-        DonglePartitions.mount_all()
-        DongleGrub.encrypted_install()
+        DonglifyState.mount_all()
+        DonglifyState.grub_install()
     
         DonglifyState.write()
     
-        subprocess.run("lsblk -f", shell=True)
+        index = DeviceIndex.load()
+        index.print_table(index.get(dev_name))
         good("dongle's partition initialization done")
         tell("you are recommended to start adding system installs onto your dongle")
         sys.exit(0)
 
 
     @staticmethod
-    def mount_all():
-        mount(DonglifyState.config.efi_uuid, "/efi")
-        unlock(DonglifyState.config.locked_boot_uuid, "dongleboot")
-        mount(DonglifyState.config.unlocked_boot_uuid, "/boot")
-        mount(DonglifyState.config.part_iso_uuid, "/mnt/iso")
-        good("mounted all necessarily points from donglified usb")
-    
+    def partition(dev_name, number) -> str:
+        # /dev/sdb -> /dev/sdb1, /dev/loop0 and /dev/nvme0n1 -> /dev/loop0p1
+        if dev_name[-1].isdigit():
+            return f'{dev_name}p{number}'
+        return f'{dev_name}{number}'
+
+    @staticmethod
+    @DongleTrace.traced("create partitions")
+    def create_partitions(dev_name, layout: DongleLayout, script=False):
+        # exact sectors from the plan, parted must not move them
+        parted = "parted -s -a none" if script else "parted -a none"
+        for partition in layout.partitions:
+            fstype = f' {partition.fstype}' if partition.fstype != "" else ""
+            start = layout.sectors(partition.start)
+            end = layout.sectors(partition.start + partition.size) - 1
+            cmd = f'{parted} {dev_name} unit s mkpart "{partition.label}"{fstype} {start}s {end}s'
+            execute(cmd, desc=f"create {partition.label} partition on dongle", capture=script)
+
+        cmd = f'{parted} {dev_name} set 1 esp on'
+        execute(cmd, desc="mark /efi as esp", capture=script)
     
+        cmd = f'{parted} {dev_name} set 2 boot on'
+        execute(cmd, desc="mark /boot as boot", capture=script)
+
+    @staticmethod
+    def format_steps(dev_name, boot_name="dongleboot", persist_name="donglepersist",
+                     key_file=None, key=None, layout: DongleLayout = None) -> list[DongleStep]:
+        # without a key file or key cryptsetup asks the user for the passphrase
+        interactive = key_file is None and key is None
+        luks_args = ""
+        if not interactive:
+            luks_args = f' --batch-mode --key-file={key_file or "-"}'
+
+        efi_part, boot_part, isos_part, persist_part = \
+            (DonglePartitions.partition(dev_name, n) for n in range(1, 5))
+        if layout is None:
+            # only the filesystem tuning is needed, which depends on the device alone
+            layout = DongleLayout(DongleTopology.load(dev_name), [])
+
+        def luks_format(part, luks_type):
+            # benchmarked once a LUKS step runs, steps that format no LUKS
+            # container never wait for cryptsetup benchmark
+            return lambda: execute(f'cryptsetup luksFormat --type {luks_type}{luks_args}'
+                                   f'{layout.luks_args(luks_type)}'
+                                   f'{DongleLuks.default_params(luks_type).format_args()} {part}',
+                                   desc=f"encrypt dongle's {part} partition", capture=not interactive,
+                                   input=key)
+
+        steps = [
+            DongleStep("efi", f'mkfs.vfat -n DONGLE_EFI -F 32 {layout.vfat_args()} {efi_part}',
+                       desc="format DONGLE_EFI as FAT16"),
+            DongleStep("boot-luks", [
+                luks_format(boot_part, "luks1"),
+                lambda: unlock_disk(boot_part, boot_name, key_file=key_file, key=key),
+            ], interactive=interactive),
+            DongleStep("boot-fs", f'mkfs.ext4 {layout.ext4_args("DONGLE_BOOT")} /dev/mapper/{boot_name}',
+                       desc="format dongle's /boot partition as ext4", after=["boot-luks"]),
+            DongleStep("isos-fs", f'mkfs.ext4 {layout.ext4_args("DONGLE_ISOs")} {isos_part}',
+                       desc="format dongle's ISOs partition as ext4"),
+            DongleStep("persist-luks", [
+                luks_format(persist_part, "luks2"),
+                lambda: unlock_disk(persist_part, persist_name, key_file=key_file, key=key),
+            ], interactive=interactive),
+            DongleStep("persist-fs",
+                       f'mkfs.ext4 {layout.ext4_args("DONGLE_PERSISTENT")} /dev/mapper/{persist_name}',
+                       desc="format dongle's persistent partition", after=["persist-luks"]),
+        ]
+        if layout.partitions and layout.get("DONGLE_PERSISTENT") is None:
+            # planned without a persistent partition
+            steps = [step for step in steps if not step.name.startswith("persist-")]
+        return steps
+
+    @staticmethod
+    @DongleTrace.traced("collect uuids")
+    def collect_uuids(dev_name, boot_name="dongleboot"):
+        execute('udevadm settle', desc="wait for the new filesystems to be registered", capture=True)
+        index = DeviceIndex.load()
+        efi_part, boot_part, isos_part = (DonglePartitions.partition(dev_name, n) for n in range(1, 4))
+        return {
+            "version": DongleState.LATEST_VERSION,
+            "efi_uuid": get_uuid_by_dev(efi_part, index),
+            "locked_boot_uuid": get_uuid_by_dev(boot_part, index),
+            "unlocked_boot_uuid": get_uuid_by_dev(f'/dev/mapper/{boot_name}', index),
+            "part_iso_uuid": get_uuid_by_dev(isos_part, index),
+        }
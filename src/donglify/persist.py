@@ -0,0 +1,313 @@
+import os
+import json
+import stat
+import shutil
+import hashlib
+import concurrent.futures
+
+from donglify.lib import *
+
+from donglify.config import *
+from donglify.devices import *
+from donglify.dongle import Dongle, DonglifyState
+
+# signatures of the files on the persistent partition, one file per synced
+# directory, next to the directories themselves
+INDEX_DIR = ".donglify-index"
+BLOCK_SIZE = 1024 * 1024
+HASH_WORKERS = 4
+
+def block_signature(path) -> list[str]:
+    # blake2b of every BLOCK_SIZE block, hashlib releases the GIL while it
+    # hashes so the workers run in parallel
+    blocks = []
+    with open(path, "rb") as f:
+        while chunk := f.read(BLOCK_SIZE):
+            blocks.append(hashlib.blake2b(chunk, digest_size=16).hexdigest())
+    return blocks
+
+
+def scan_tree(root) -> dict[str, os.stat_result]:
+    # relative path -> lstat, symlinks are not followed
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                entries[os.path.relpath(path, root)] = os.lstat(path)
+            except FileNotFoundError:
+                pass
+    return entries
+
+
+class DongleSyncStats:
+    def __init__(self):
+        self.skipped = 0
+        self.updated = 0
+        self.created = 0
+        self.deleted = 0
+        self.blocks_written = 0
+        self.bytes_written = 0
+        self.bytes_hashed = 0
+
+
+class DonglePersistSync:
+    # mirrors src to dest. Files with the same size and modification time are
+    # skipped, the others are compared block by block and only the blocks
+    # which differ are written, in place. The signatures of the dongle's side
+    # are cached in index, keyed by size and modification time.
+    def __init__(self, src: str, dest: str, index: dict[str, list], pull: bool, workers=HASH_WORKERS):
+        self.src = src
+        self.dest = dest
+        # relative path -> [size, mtime_ns, block signature] of the files on the dongle
+        self.index = index
+        # pull when the dongle is src, push when it is dest
+        self.pull = pull
+        self.workers = workers
+        self.stats = DongleSyncStats()
+
+    def signature(self, path, st: os.stat_result, on_dongle: bool, rel: str) -> tuple[list[str], int]:
+        # the signature and the bytes hashed for it
+        if st is None:
+            return [], 0
+        if on_dongle:
+            cached = self.index.get(rel)
+            if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                return cached[2], 0
+        blocks = block_signature(path)
+        if on_dongle:
+            self.index[rel] = [st.st_size, st.st_mtime_ns, blocks]
+        return blocks, st.st_size
+
+    def signatures(self, rel, src_st, dest_st) -> tuple[list[str], list[str], int]:
+        # runs on the workers
+        src_blocks, src_hashed = self.signature(os.path.join(self.src, rel), src_st, self.pull, rel)
+        dest_blocks, dest_hashed = self.signature(os.path.join(self.dest, rel), dest_st, not self.pull, rel)
+        return src_blocks, dest_blocks, src_hashed + dest_hashed
+
+    def apply_metadata(self, path, st: os.stat_result):
+        os.lchown(path, st.st_uid, st.st_gid)
+        if not stat.S_ISLNK(st.st_mode):
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+    def write_delta(self, rel, src_st, src_blocks: list[str], dest_blocks: list[str]):
+        src_path = os.path.join(self.src, rel)
+        dest_path = os.path.join(self.dest, rel)
+        changed = [i for i, block in enumerate(src_blocks) if i >= len(dest_blocks) or dest_blocks[i] != block]
+
+        with open(src_path, "rb") as fsrc:
+            fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT, 0o600)
+            try:
+                for i in changed:
+                    fsrc.seek(i * BLOCK_SIZE)
+                    data = fsrc.read(BLOCK_SIZE)
+                    os.pwrite(fd, data, i * BLOCK_SIZE)
+                    self.stats.bytes_written += len(data)
+                os.ftruncate(fd, src_st.st_size)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.stats.blocks_written += len(changed)
+        self.apply_metadata(dest_path, src_st)
+
+        if not self.pull:
+            # the dongle's copy now has the source's size, mtime and blocks
+            self.index[rel] = [src_st.st_size, src_st.st_mtime_ns, src_blocks]
+
+    def remove(self, rel, st: os.stat_result):
+        path = os.path.join(self.dest, rel)
+        if stat.S_ISDIR(st.st_mode):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        self.index.pop(rel, None)
+
+    def run(self, dry_run=False) -> DongleSyncStats:
+        os.makedirs(self.dest, exist_ok=True)
+        src_entries = scan_tree(self.src)
+        dest_entries = scan_tree(self.dest)
+
+        # entries of another kind than their source go first, then the
+        # directories and symlinks, the files are left to the workers
+        files = []
+        for rel in sorted(src_entries):
+            src_st = src_entries[rel]
+            dest_st = dest_entries.get(rel)
+            if dest_st is not None and stat.S_IFMT(dest_st.st_mode) != stat.S_IFMT(src_st.st_mode):
+                if not dry_run:
+                    self.remove(rel, dest_st)
+                dest_entries.pop(rel)
+                dest_st = None
+
+            dest_path = os.path.join(self.dest, rel)
+            if stat.S_ISDIR(src_st.st_mode):
+                if dest_st is None and not dry_run:
+                    os.mkdir(dest_path)
+            elif stat.S_ISLNK(src_st.st_mode):
+                target = os.readlink(os.path.join(self.src, rel))
+                if dest_st is None or os.readlink(dest_path) != target:
+                    if not dry_run:
+                        if dest_st is not None:
+                            os.remove(dest_path)
+                        os.symlink(target, dest_path)
+                        self.apply_metadata(dest_path, src_st)
+            elif stat.S_ISREG(src_st.st_mode):
+                if dest_st is not None and dest_st.st_size == src_st.st_size and \
+                        dest_st.st_mtime_ns == src_st.st_mtime_ns:
+                    self.stats.skipped += 1
+                    continue
+                files.append((rel, src_st, dest_st))
+
+        stale = sorted((rel for rel in dest_entries if rel not in src_entries), reverse=True)
+        if dry_run:
+            for rel, _, dest_st in files:
+                print(f"{'update' if dest_st is not None else 'create'} {rel}")
+            for rel in stale:
+                print(f"delete {rel}")
+            return self.stats
+
+        # hashing runs ahead on the workers while the changed blocks are
+        # written one file after the other, in the order they are ready
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.signatures, rel, src_st, dest_st): (rel, src_st, dest_st)
+                       for rel, src_st, dest_st in files}
+            for future in concurrent.futures.as_completed(futures):
+                rel, src_st, dest_st = futures[future]
+                src_blocks, dest_blocks, hashed = future.result()
+                self.stats.bytes_hashed += hashed
+                self.write_delta(rel, src_st, src_blocks, dest_blocks)
+                if dest_st is None:
+                    self.stats.created += 1
+                else:
+                    self.stats.updated += 1
+
+        # deepest first, a directory is empty by the time it is removed
+        for rel in stale:
+            if os.path.lexists(os.path.join(self.dest, rel)):
+                self.remove(rel, dest_entries[rel])
+                self.stats.deleted += 1
+
+        # directories get their times last, writing into them changed them
+        for rel in sorted(src_entries, reverse=True):
+            if stat.S_ISDIR(src_entries[rel].st_mode):
+                self.apply_metadata(os.path.join(self.dest, rel), src_entries[rel])
+
+        if self.pull:
+            for rel in list(self.index):
+                if rel not in src_entries:
+                    self.index.pop(rel)
+        return self.stats
+
+
+class DonglePersist:
+    @staticmethod
+    @DongleTrace.traced("mount persist")
+    def mount(dongle: Dongle):
+        index = DeviceIndex.load()
+        locked_boot = index.by_uuid.get(dongle.config.locked_boot_uuid)
+        if locked_boot is None:
+            raise DonglifyError(f"{dongle.title} is not plugged in")
+        persistent = index.sibling(locked_boot.path, "DONGLE_PERSISTENT")
+        if persistent is None:
+            raise DonglifyError(f"{dongle.title} has no DONGLE_PERSISTENT partition")
+        unlock_disk(persistent.path, dongle.persist_name)
+        mount_mapper(dongle.persist_name, dongle.persist_dir)
+
+    @staticmethod
+    def umount(dongle: Dongle):
+        umount(dongle.persist_dir)
+        lock(dongle.persist_name)
+
+    @staticmethod
+    def read_index(dongle: Dongle, name) -> dict[str, list]:
+        try:
+            with open(f"{dongle.persist_dir}/{INDEX_DIR}/{name}.json") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        # signatures of another block size are useless
+        if data.get("block_size") != BLOCK_SIZE:
+            return {}
+        return data["files"]
+
+    @staticmethod
+    def write_index(dongle: Dongle, name, files: dict[str, list]):
+        os.makedirs(f"{dongle.persist_dir}/{INDEX_DIR}", exist_ok=True)
+        data = json.dumps({"block_size": BLOCK_SIZE, "files": files}, sort_keys=True)
+        write_if_changed(f"{dongle.persist_dir}/{INDEX_DIR}/{name}.json", data.encode('utf-8'))
+
+    @staticmethod
+    @DongleTrace.traced("persist sync")
+    def sync(dongle: Dongle, names: list[str], pull=False, dry_run=False, workers=HASH_WORKERS):
+        DonglePersist.mount(dongle)
+        try:
+            for name in names:
+                host_path = dongle.persists[name].host_path
+                dongle_path = f"{dongle.persist_dir}/{name}"
+                src, dest = (dongle_path, host_path) if pull else (host_path, dongle_path)
+                if not os.path.isdir(src):
+                    bad(f"{src} does not exist, not syncing {name}")
+                    continue
+
+                tell(f"syncing {src} to {dest}")
+                index = DonglePersist.read_index(dongle, name)
+                stats = DonglePersistSync(src, dest, index, pull, workers).run(dry_run)
+                if dry_run:
+                    continue
+                DonglePersist.write_index(dongle, name, index)
+                good(f"{name}: {stats.created} created, {stats.updated} updated, {stats.deleted} deleted, "
+                     f"{stats.skipped} unchanged, {stats.blocks_written} blocks "
+                     f"({stats.bytes_written / (1024 * 1024):.1f} MiB) written, "
+                     f"{stats.bytes_hashed / (1024 * 1024):.1f} MiB hashed")
+        finally:
+            DonglePersist.umount(dongle)
+
+
+def dongle_persist_add(name=None, host_path=None):
+    if name is None:
+        name = input("Name of the synced directory: ")
+        host_path = input("Host directory to mirror: ")
+
+    host_path = os.path.abspath(host_path)
+    if not os.path.isdir(host_path):
+        raise DonglifyError(f"{host_path} is not a directory")
+
+    DonglifyState.persists[name] = DonglePersistValidator.validate_python({"host_path": host_path})
+    DonglifyState.write()
+    good(f"{host_path} is synced as {name}, run persist sync to copy it to the dongle")
+
+
+def dongle_persist_remove(name=None):
+    if name is None:
+        name = input("Name of the synced directory to remove: ")
+    if name not in DonglifyState.persists:
+        raise DonglifyError(f"no synced directory named {name} on dongle")
+    # the copy on the persistent partition is left alone
+    DonglifyState.persists.pop(name)
+    DonglifyState.write()
+
+
+def dongle_persist_list(as_json=False):
+    if as_json:
+        print(json.dumps({name: persist.model_dump() for name, persist in DonglifyState.persists.items()},
+                         indent=2))
+        return
+
+    if len(DonglifyState.persists) == 0:
+        print("no directories are synced to the dongle")
+        return
+
+    for name, persist in DonglifyState.persists.items():
+        print(f'{name}: {persist.host_path}')
+
+
+def dongle_persist_sync(name=None, pull=False, dry_run=False, workers=HASH_WORKERS):
+    names = list(DonglifyState.persists) if name is None else [name]
+    for name in names:
+        if name not in DonglifyState.persists:
+            raise DonglifyError(f"no synced directory named {name} on dongle")
+    if not names:
+        bad("no directories are synced to the dongle, try persist add first")
+        return
+    DonglePersist.sync(DonglifyState, names, pull, dry_run, workers)
@@ -0,0 +1,247 @@
+import os
+import subprocess
+
+from donglify.lib import *
+
+from donglify.config import *
+from donglify.grub import *
+from donglify.steps import *
+from donglify.mounts import *
+from donglify.devices import *
+from donglify.layout import *
+from donglify.catalog import DongleISOCatalog
+from donglify.partition import DonglePartitions
+from donglify.dongle import DonglifyState
+
+# partition number and label of every DONGLE_* partition init creates
+DONGLE_PARTITIONS = [(1, "DONGLE_EFI"), (2, "DONGLE_BOOT"), (3, "DONGLE_ISOs"), (4, "DONGLE_PERSISTENT")]
+# what reinit can reset, the ISOs partition is never one of them
+REINIT_PARTS = ["efi", "boot", "boot-fs", "grub", "persist"]
+
+class DongleReinit:
+    # refreshes a dongle in place: the partition table and the ISOs
+    # partition are kept, of the rest only what is broken or asked for is
+    # reset, each reset partition discarded first so the stick drops its
+    # blocks instead of them being overwritten
+    @staticmethod
+    def fstype(part) -> str:
+        return subprocess.run(["blkid", "-p", "-s", "TYPE", "-o", "value", part],
+                              capture_output=True).stdout.decode('utf-8').strip()
+
+    @staticmethod
+    def layout(dev_name) -> dict[str, str]:
+        # label -> partition, the partitions must be where init put them
+        index = DeviceIndex.load()
+        disk = index.get(dev_name)
+        if disk is None:
+            raise DonglifyError(f"{dev_name} is not a block device")
+        labels = {device.partlabel: device.path for device in index.partitions_of(disk)}
+
+        parts = {}
+        for number, label in DONGLE_PARTITIONS:
+            expected = DonglePartitions.partition(dev_name, number)
+            if label not in labels:
+                if label == "DONGLE_PERSISTENT":
+                    continue
+                raise DonglifyError(f"{dev_name} has no {label} partition, it needs a full init")
+            if os.path.realpath(labels[label]) != os.path.realpath(expected):
+                raise DonglifyError(f"{label} is {labels[label]} instead of {expected}, it needs a full init")
+            parts[label] = expected
+
+        if DongleReinit.fstype(parts["DONGLE_ISOs"]) != "ext4":
+            raise DonglifyError(f"the ISOs partition {parts['DONGLE_ISOs']} has no ext4 filesystem, "
+                                "it needs a full init")
+        return parts
+
+    @staticmethod
+    def check_efi(part) -> str:
+        # what is wrong with it, "" when nothing is
+        if DongleReinit.fstype(part) != "vfat":
+            return "no FAT filesystem"
+        if execute(["fsck.fat", "-n", part], desc="check DONGLE_EFI", capture=True, check=False) != 0:
+            return "filesystem errors"
+        return ""
+
+    @staticmethod
+    def check_boot_fs() -> str:
+        mapper = f"/dev/mapper/{DonglifyState.boot_name}"
+        if DongleReinit.fstype(mapper) != "ext4":
+            return "no ext4 filesystem in the LUKS container"
+        if execute(["fsck.ext4", "-n", mapper], desc="check the /boot filesystem", capture=True,
+                   check=False) != 0:
+            return "filesystem errors"
+        return ""
+
+    @staticmethod
+    def check_grub() -> str:
+        if not os.path.exists(f"{DonglifyState.efi_dir}/EFI/BOOT/BOOTX64.EFI"):
+            return "no EFI/BOOT/BOOTX64.EFI"
+        if not os.path.isdir(f"{DonglifyState.boot_dir}/grub/x86_64-efi"):
+            return "no /boot/grub/x86_64-efi"
+        return ""
+
+    @staticmethod
+    def read_state() -> DonglifyConfigV1:
+        try:
+            state, _ = DongleState.parse(DongleState.load_data(DonglifyState.path))
+            return state
+        except DonglifyError as e:
+            bad(f"dongle.ini can not be used, {e}")
+            return None
+
+    @staticmethod
+    def inspect_boot(parts, resets) -> DonglifyConfigV1:
+        # dongle.ini is read whenever /boot still unlocks and mounts, also
+        # when /boot is reset, so its entries are carried over the reset
+        if "boot" in resets:
+            tell("unlocking /boot to keep its dongle.ini, leave the prompts empty when its passphrase is lost")
+        else:
+            tell("unlocking /boot to check it, reset it with --boot when its passphrase is lost")
+        try:
+            unlock_disk(parts["DONGLE_BOOT"], DonglifyState.boot_name)
+        except DonglifyError:
+            if "boot" not in resets:
+                raise
+            bad("/boot could not be unlocked")
+            return None
+
+        if "boot" not in resets:
+            reason = DongleReinit.check_boot_fs()
+            if reason != "":
+                resets.setdefault("boot-fs", reason)
+
+        # read only, the filesystem may have errors
+        boot = DonglifyState.boot_dir
+        os.makedirs(boot, exist_ok=True)
+        if execute(["mount", "-o", "ro", f"/dev/mapper/{DonglifyState.boot_name}", boot], desc="mount /boot to read dongle.ini",
+                   capture=True, check=False) != 0:
+            return None
+        try:
+            state = DongleReinit.read_state()
+            if not any(part in resets for part in ["efi", "boot-fs", "grub"]):
+                mount(get_uuid_by_dev(parts["DONGLE_EFI"]), DonglifyState.efi_dir)
+                reason = DongleReinit.check_grub()
+                if reason != "":
+                    resets["grub"] = reason
+        finally:
+            # /boot's LUKS container stays open for the reset
+            umount(DonglifyState.efi_dir)
+            umount(boot)
+        return state
+
+    @staticmethod
+    def recover_isos(iso_dir) -> dict[str, DongleISO]:
+        # entries for the images the ISOs partition carries, from the boot
+        # configs found inside them
+        catalog = DongleISOCatalog.load(iso_dir)
+        catalog.scan()
+        catalog.save()
+        isos = {}
+        for file_name, image in sorted(catalog.images.items()):
+            if image.boot_config == "":
+                bad(f"no boot config GRUB can use found in {file_name}, add it with iso add")
+                continue
+            isos[file_name.removesuffix(".iso")] = DongleISOValidator.validate_python({
+                "file_name": file_name,
+                "loopback_cfg_location": image.boot_config,
+                "template": image.template or "loopback",
+            })
+        return isos
+
+    @staticmethod
+    def discard(part, topology: DongleTopology):
+        if topology.discard_granularity == 0:
+            tell(f"{topology.name} does not support discard, {part} is formatted over")
+            return
+        execute(f"blkdiscard -f {part}", desc=f"discard {part} before it is formatted", capture=True)
+
+    @staticmethod
+    @DongleTrace.traced("reinit")
+    def run(dev_name, requested: list[str], assume_yes=False):
+        parts = DongleReinit.layout(dev_name)
+        topology = DongleTopology.load(dev_name)
+        DonglifyState.umount_all()
+
+        # part -> why it is reset
+        resets = {part: "requested" for part in requested}
+        if "boot" in resets:
+            resets["boot-fs"] = "its LUKS container is reset"
+        if "efi" not in resets:
+            reason = DongleReinit.check_efi(parts["DONGLE_EFI"])
+            if reason != "":
+                resets["efi"] = reason
+
+        state = None
+        if DongleReinit.fstype(parts["DONGLE_BOOT"]) != "crypto_LUKS":
+            resets.setdefault("boot", "no LUKS container")
+            resets["boot-fs"] = "its LUKS container is reset"
+        else:
+            state = DongleReinit.inspect_boot(parts, resets)
+        if "efi" in resets or "boot-fs" in resets:
+            resets.setdefault("grub", "reinstalled with a reset partition")
+        if "persist" in resets and "DONGLE_PERSISTENT" not in parts:
+            raise DonglifyError(f"{dev_name} has no DONGLE_PERSISTENT partition")
+
+        print(f"{dev_name}, partition table and DONGLE_ISOs are kept:")
+        for part in REINIT_PARTS:
+            print(f"  {part:<10}{'reset, ' + resets[part] if part in resets else 'kept'}")
+        if state is None:
+            print("  dongle.ini is rebuilt, the ISO entries from the images on the ISOs partition")
+        if not resets and state is not None:
+            lock(DonglifyState.boot_name)
+            good("nothing to reset, the dongle is intact")
+            return
+        if not assume_yes:
+            print("Reset these parts?")
+            if not does_user_accept():
+                print("Stopping procedure by user command. No data was lost.")
+                return
+
+        if "boot" in resets:
+            lock(DonglifyState.boot_name)
+        if "persist" in resets:
+            lock(DonglifyState.persist_name)
+        for part, label in [("efi", "DONGLE_EFI"), ("boot", "DONGLE_BOOT"), ("persist", "DONGLE_PERSISTENT")]:
+            if part in resets:
+                DongleReinit.discard(parts[label], topology)
+
+        # the steps of init for the reset parts alone, the ISOs are never formatted
+        names = {"efi": ["efi"], "boot": ["boot-luks"], "boot-fs": ["boot-fs"],
+                 "persist": ["persist-luks", "persist-fs"]}
+        wanted = [name for part in resets for name in names.get(part, [])]
+        steps = DonglePartitions.format_steps(dev_name, DonglifyState.boot_name, DonglifyState.persist_name,
+                                              layout=DongleLayout(topology, []))
+        steps = [step for step in steps if step.name in wanted]
+        for step in steps:
+            step.after = [dep for dep in step.after if dep in wanted]
+        with DongleTrace.span("format", device=dev_name):
+            run_steps(steps)
+
+        data = DonglePartitions.collect_uuids(dev_name, DonglifyState.boot_name)
+        installs, persists = ({}, {}) if state is None else (state.installs, state.persists)
+        if "boot-fs" in resets:
+            # the kernels went with the filesystem, the next reinstall builds them
+            for install in installs.values():
+                install.build_fingerprint = ""
+        if state is not None:
+            # generations go on from where the old dongle.ini was
+            data["generation"] = state.config.generation
+
+        DonglifyState.config = DongleConfigValidator.validate_python(data)
+        DonglifyState.installs = installs
+        DonglifyState.persists = persists
+        DonglifyState.mount_all()
+        DonglifyState.isos = state.isos if state is not None else DongleReinit.recover_isos(DonglifyState.iso_dir)
+
+        if "grub" in resets:
+            DonglifyState.grub_install()
+        DonglifyState.config_install()
+        DonglifyState.committed = b""
+        DonglifyState.commit()
+        DonglifyState.umount_all()
+
+        good(f"{dev_name} has been refreshed, {len(DonglifyState.isos)} ISO entries kept")
+        if state is None:
+            tell("the installs of the old dongle.ini are gone, add each host system again")
+        elif installs and "boot-fs" in resets:
+            tell("run 'reinstall' from each host system to put the kernels of its installs back")
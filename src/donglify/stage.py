@@ -0,0 +1,129 @@
+import os
+import shutil
+import hashlib
+import contextlib
+
+from donglify.lib import *
+
+from donglify.config import *
+from donglify.boot import *
+from donglify.grub import *
+from donglify.store import *
+from donglify.mounts import *
+from donglify.dongle import Dongle
+
+STAGE_DIR = "/run/donglify/stage"
+# room for a kernel, its initramfs with fallback and microcode, pacman
+# writes the images of other installed kernels too
+STAGE_SIZE = "1G"
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+class DongleStage:
+    # staged builds run pacman and mkinitcpio against a tmpfs bound over
+    # /boot while the dongle's /boot and /efi are unmounted, the dongle is
+    # mounted again afterwards to copy the changed images over in one pass
+    @staticmethod
+    @contextlib.contextmanager
+    def staged(dongle: Dongle):
+        # pacman and mkinitcpio build into the host's /boot
+        boot, stage = rooted("/boot"), rooted(STAGE_DIR)
+        # the LUKS container stays open, nothing is written through it
+        dongle.flush()
+        umount(dongle.efi_dir)
+        umount(dongle.boot_dir)
+        # a stage left by a failed build may still hold its images, every
+        # build starts from an empty one
+        DongleStage.discard()
+        os.makedirs(stage, exist_ok=True)
+        execute(f"mount -t tmpfs -o size={STAGE_SIZE},mode=0755 donglify-stage {stage}",
+                desc="create the staging area for kernel & initramfs builds")
+        try:
+            execute(f"mount --bind {stage} {boot}", desc="build into the staging area in place of /boot")
+            yield stage
+        finally:
+            umount(boot)
+            # the dongle is mounted again whether or not the build succeeded
+            dongle.mount_all()
+
+    @staticmethod
+    def discard():
+        umount(rooted(STAGE_DIR))
+
+    @staticmethod
+    def copy_verified(src, dest, digest):
+        tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.part")
+        with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+            shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+
+        # read back from the stick, not from the page cache
+        fd = os.open(tmp, os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        sha = hashlib.sha256()
+        with os.fdopen(fd, "rb") as f:
+            while chunk := f.read(COPY_CHUNK_SIZE):
+                sha.update(chunk)
+        if sha.hexdigest() != digest:
+            os.remove(tmp)
+            raise DonglifyError(f"{dest} does not read back as written, the dongle's /boot is left as it was")
+        os.replace(tmp, dest)
+
+    @staticmethod
+    @DongleTrace.traced("commit staged images")
+    def commit(dongle: Dongle, name: str, stage: str):
+        dongle.mount_all()
+        boot, store = dongle.boot_dir, DongleStore.store_dir(dongle)
+        os.makedirs(store, exist_ok=True)
+
+        written = 0
+        for image in DongleStore.image_names(dongle, name):
+            src = os.path.join(stage, image)
+            if not os.path.exists(src):
+                raise DonglifyError(f"the staged build did not produce {image}, the dongle's /boot is left as it was")
+            dest = os.path.join(boot, image)
+            digest = DongleStore.digest(src)
+            obj = os.path.join(store, digest)
+            if os.path.exists(obj) and os.path.exists(dest) and os.path.samefile(obj, dest):
+                good(f"/boot/{image} is unchanged")
+                continue
+            if os.path.exists(obj):
+                good(f"/boot/{image} is already stored, linking it")
+                DongleStore.link(obj, dest)
+                continue
+            size = os.path.getsize(src)
+            tell(f"writing /boot/{image}, {size / (1024 * 1024):.1f} MiB")
+            DongleStage.copy_verified(src, dest, digest)
+            os.link(dest, obj)
+            written += size
+
+        dirfd = os.open(boot, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        good(f"wrote {written / (1024 * 1024):.1f} MiB of new images to the dongle")
+        freed = DongleStore.prune(dongle)
+        if freed:
+            good(f"freed {freed / (1024 * 1024):.1f} MiB of replaced images on /boot")
+
+    @staticmethod
+    @DongleTrace.traced("staged install")
+    def install(dongle: Dongle, name: str, cmd=None, incremental=False):
+        # the dongle's images are looked at before they are hidden
+        dongle.mount_all()
+        missing = DonglifyBoot.missing_images(dongle, name)
+        try:
+            with DongleStage.staged(dongle) as stage:
+                if cmd is not None:
+                    execute(cmd, "Runs user given system update command.")
+                built = DonglifyBoot.configure_sys(dongle, name, incremental, missing)
+
+            # dongle.ini is committed whether or not anything was built
+            if built:
+                DongleStage.commit(dongle, name, stage)
+                dongle.config_install()
+            dongle.commit()
+            dongle.umount_all()
+        finally:
+            DongleStage.discard()
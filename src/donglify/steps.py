@@ -0,0 +1,72 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from donglify.lib import *
+
+class DongleStep:
+    # cmd is a shell command, a callable or a list of those ran in order.
+    # interactive steps own the terminal, only one of them runs at a time.
+    def __init__(self, name: str, cmd, desc="", after=(), interactive=False):
+        self.name = name
+        self.cmd = cmd
+        self.desc = desc
+        self.after = list(after)
+        self.interactive = interactive
+
+    def run(self):
+        cmds = self.cmd if isinstance(self.cmd, list) else [self.cmd]
+        for cmd in cmds:
+            if callable(cmd):
+                cmd()
+            else:
+                execute(cmd, desc=self.desc, capture=not self.interactive)
+
+
+def run_steps(steps: list[DongleStep], max_workers=4):
+    names = {step.name for step in steps}
+    for step in steps:
+        for dep in step.after:
+            if dep not in names:
+                raise Exception(f"step {step.name} depends on unknown step {dep}")
+
+    terminal = threading.Lock()
+
+    def run_step(step: DongleStep):
+        if step.interactive:
+            with terminal:
+                step.run()
+        else:
+            step.run()
+
+    done = set()
+    running = {}
+    failure = None
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while len(done) < len(steps):
+            if failure is None:
+                for step in steps:
+                    if step.name in done or step in running.values():
+                        continue
+                    if all(dep in done for dep in step.after):
+                        running[pool.submit(run_step, step)] = step
+
+            if not running:
+                if failure is not None:
+                    break
+                pending = [step.name for step in steps if step.name not in done]
+                raise Exception("steps have circular dependencies: " + ' '.join(pending))
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                try:
+                    future.result()
+                    done.add(step.name)
+                except BaseException as e:
+                    # let the steps already running finish, but start no new ones
+                    if failure is None:
+                        bad(f"step '{step.name}' failed, waiting for running steps to finish")
+                        failure = e
+
+    if failure is not None:
+        raise failure
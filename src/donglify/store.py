@@ -0,0 +1,198 @@
+import os
+import json
+import hashlib
+
+from donglify.lib import *
+
+from donglify.config import *
+from donglify.dongle import Dongle
+
+# under the dongle's /boot
+STORE_DIR = "store"
+MiB = 1024 * 1024
+HASH_CHUNK_SIZE = 8 * MiB
+
+class DongleStore:
+    # /boot images are kept once per content in /boot/store/<sha256>, the
+    # names GRUB boots (vmlinuz-<install>, ...) are hardlinks to them. An
+    # object without other links is garbage.
+    @staticmethod
+    def image_names(dongle: Dongle, name: str) -> list[str]:
+        current_install = dongle.installs[name]
+        return [f'vmlinuz-{name}', f'initramfs-{name}.img', f'{current_install.ucode}-{name}.img']
+
+    @staticmethod
+    def digest(path) -> str:
+        # chunked, hashlib.file_digest needs Python 3.11
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @staticmethod
+    def store_dir(dongle: Dongle) -> str:
+        return f"{dongle.boot_dir}/{STORE_DIR}"
+
+    @staticmethod
+    def adopt(dongle: Dongle, path) -> bool:
+        # True when path was a duplicate and now links to an existing object
+        store = DongleStore.store_dir(dongle)
+        os.makedirs(store, exist_ok=True)
+        obj = os.path.join(store, DongleStore.digest(path))
+        if not os.path.exists(obj):
+            os.link(path, obj)
+            return False
+        if os.path.samefile(obj, path):
+            return False
+        DongleStore.link(obj, path)
+        return True
+
+    @staticmethod
+    def link(obj, path):
+        # replaced atomically, the name always points at a complete image
+        tmp = path + ".donglify-link"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.link(obj, tmp)
+        os.replace(tmp, path)
+
+    @staticmethod
+    @DongleTrace.traced("store images")
+    def adopt_install(dongle: Dongle, name: str):
+        for image in DongleStore.image_names(dongle, name):
+            path = f'{dongle.boot_dir}/{image}'
+            if os.path.exists(path) and DongleStore.adopt(dongle, path):
+                good(f"/boot/{image} is identical to an image of another install, sharing it")
+        # the images this build replaced are only left in the store
+        freed = DongleStore.prune(dongle)
+        if freed:
+            good(f"freed {freed / MiB:.1f} MiB of replaced images on /boot")
+
+    @staticmethod
+    def prune(dongle: Dongle) -> int:
+        # removes the objects no name in /boot links to, returns the bytes freed
+        store = DongleStore.store_dir(dongle)
+        freed = 0
+        for digest, st in DongleStore.objects(dongle).items():
+            if st.st_nlink > 1:
+                continue
+            os.remove(os.path.join(store, digest))
+            freed += st.st_blocks * 512
+        return freed
+
+    @staticmethod
+    def objects(dongle: Dongle) -> dict[str, os.stat_result]:
+        store = DongleStore.store_dir(dongle)
+        try:
+            return {name: os.stat(os.path.join(store, name)) for name in os.listdir(store)}
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def stale_images(dongle: Dongle) -> list[str]:
+        # install images in /boot of installs which are gone from dongle.ini
+        referenced = set()
+        for name in dongle.installs:
+            referenced.update(DongleStore.image_names(dongle, name))
+        stale = []
+        for entry in sorted(os.listdir(dongle.boot_dir)):
+            is_image = entry.startswith("vmlinuz-") or \
+                (entry.endswith(".img") and (entry.startswith("initramfs-") or "-ucode-" in entry))
+            if is_image and entry not in referenced and os.path.isfile(f"{dongle.boot_dir}/{entry}"):
+                stale.append(entry)
+        return stale
+
+    @staticmethod
+    @DongleTrace.traced("store gc")
+    def gc(dongle: Dongle, dry_run=False):
+        # images from before the store are adopted first, so duplicates
+        # among them are freed as well
+        if not dry_run:
+            for name in dongle.installs:
+                DongleStore.adopt_install(dongle, name)
+
+        # inode -> links removed along with stale images, objects are looked
+        # at as they were before, a dry run removes nothing
+        objects = DongleStore.objects(dongle)
+        dropped: dict[int, int] = {}
+        freed = 0
+        stale = DongleStore.stale_images(dongle)
+        if stale:
+            print("images of no install in dongle.ini:\n\t" + ' '.join(stale))
+        if stale and (dry_run or dongle.assume_yes or does_user_accept()):
+            for entry in stale:
+                path = f"{dongle.boot_dir}/{entry}"
+                st = os.stat(path)
+                dropped[st.st_ino] = dropped.get(st.st_ino, 0) + 1
+                if st.st_nlink == dropped[st.st_ino]:
+                    freed += st.st_blocks * 512
+                if not dry_run:
+                    os.remove(path)
+                    good(f"removed /boot/{entry}")
+
+        for digest, st in objects.items():
+            if st.st_nlink - dropped.get(st.st_ino, 0) > 1:
+                continue
+            freed += st.st_blocks * 512
+            if dry_run:
+                print(f"would remove unreferenced /boot/{STORE_DIR}/{digest}")
+            else:
+                os.remove(os.path.join(DongleStore.store_dir(dongle), digest))
+        verb = "would free" if dry_run else "freed"
+        good(f"{verb} {freed / MiB:.1f} MiB on /boot")
+
+    @staticmethod
+    def report(dongle: Dongle) -> dict:
+        # an object's space is owned by an install alone or shared, by the
+        # inodes its images link to
+        users: dict[int, set[str]] = {}
+        sizes: dict[int, int] = {}
+        installs = {}
+        for name in dongle.installs:
+            images = {}
+            for image in DongleStore.image_names(dongle, name):
+                try:
+                    st = os.stat(f"{dongle.boot_dir}/{image}")
+                except FileNotFoundError:
+                    continue
+                images[image] = st.st_size
+                users.setdefault(st.st_ino, set()).add(name)
+                sizes[st.st_ino] = st.st_blocks * 512
+            installs[name] = {"images": images}
+
+        for name, install in installs.items():
+            inodes = [ino for ino, names in users.items() if name in names]
+            install["exclusive"] = sum(sizes[ino] for ino in inodes if len(users[ino]) == 1)
+            install["shared"] = sum(sizes[ino] for ino in inodes if len(users[ino]) > 1)
+
+        stat = os.statvfs(dongle.boot_dir)
+        used = sum(sizes.values())
+        exclusive = [install["exclusive"] for install in installs.values() if install["exclusive"] > 0]
+        average = sum(exclusive) // len(exclusive) if exclusive else 0
+        free = stat.f_bavail * stat.f_frsize
+        return {
+            "installs": installs,
+            "images_bytes": used,
+            "total_bytes": stat.f_blocks * stat.f_frsize,
+            "free_bytes": free,
+            # more installs of the average size the free space holds, an
+            # update needs room for one install's new images next to the old
+            "headroom_installs": (free - average) // average if average else None,
+        }
+
+    @staticmethod
+    def print_report(dongle: Dongle, as_json=False):
+        report = DongleStore.report(dongle)
+        if as_json:
+            print(json.dumps(report, indent=2))
+            return
+
+        print(f'{"install":<20}{"images MiB":>12}{"own MiB":>10}{"shared MiB":>12}')
+        for name, install in report["installs"].items():
+            print(f'{name:<20}{sum(install["images"].values()) / MiB:>12.1f}'
+                  f'{install["exclusive"] / MiB:>10.1f}{install["shared"] / MiB:>12.1f}')
+        print(f'/boot: {report["images_bytes"] / MiB:.1f} MiB of install images, '
+              f'{report["free_bytes"] / MiB:.1f} of {report["total_bytes"] / MiB:.1f} MiB free')
+        if report["headroom_installs"] is not None:
+            print(f'room for about {max(report["headroom_installs"], 0)} more installs of the average size')
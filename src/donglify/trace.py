@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import threading
+import contextlib
+
+class DongleSpan:
+    def __init__(self, name: str, category: str, attrs: dict):
+        self.name = name
+        # execute for commands, phase for the steps of a flow
+        self.category = category
+        self.attrs = attrs
+        self.tid = threading.get_ident()
+        self.start_ns = 0
+        self.end_ns = 0
+
+
+class DongleTrace:
+    # records commands and phases as timed spans with the bytes written to
+    # the dongle meanwhile, read from /sys/block/<disk>/stat. Disabled it
+    # costs one attribute check per span.
+    enabled = False
+    # kernel names of the watched disks, e.g. sdb
+    devices: list[str] = []
+    spans: list[DongleSpan] = []
+    start_ns = 0
+    lock = threading.Lock()
+
+    @staticmethod
+    def enable(path):
+        DongleTrace.enabled = True
+        DongleTrace.start_ns = time.perf_counter_ns()
+        atexit.register(DongleTrace.finish, path)
+
+    @staticmethod
+    def watch(dev_name):
+        # the whole disk of a partition, its stat counts the writes of all of them
+        name = os.path.basename(os.path.realpath(dev_name))
+        if not os.path.exists(f"/sys/block/{name}"):
+            name = os.path.basename(os.path.dirname(os.path.realpath(f"/sys/class/block/{name}")))
+        if os.path.exists(f"/sys/block/{name}/stat") and name not in DongleTrace.devices:
+            DongleTrace.devices.append(name)
+
+    @staticmethod
+    def write_bytes() -> int:
+        total = 0
+        for name in DongleTrace.devices:
+            try:
+                with open(f"/sys/block/{name}/stat") as f:
+                    # the 7th field is sectors written, always 512 bytes each
+                    total += int(f.read().split()[6]) * 512
+            except (OSError, IndexError, ValueError):
+                pass
+        return total
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, category="phase", **attrs):
+        # yields the attributes, callers add results such as the returncode
+        if not DongleTrace.enabled:
+            yield attrs
+            return
+
+        span = DongleSpan(name, category, attrs)
+        written = DongleTrace.write_bytes()
+        span.start_ns = time.perf_counter_ns()
+        try:
+            yield attrs
+        finally:
+            span.end_ns = time.perf_counter_ns()
+            attrs["write_bytes"] = DongleTrace.write_bytes() - written
+            with DongleTrace.lock:
+                DongleTrace.spans.append(span)
+
+    @staticmethod
+    def traced(name):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with DongleTrace.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def chrome_trace() -> dict:
+        events = []
+        for span in DongleTrace.spans:
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": (span.start_ns - DongleTrace.start_ns) / 1000,
+                "dur": (span.end_ns - span.start_ns) / 1000,
+                "pid": os.getpid(),
+                "tid": span.tid,
+                "args": span.attrs,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    @staticmethod
+    def print_summary(out=sys.stderr):
+        # phases nest, their time and writes include those of their commands
+        totals = {}
+        for span in DongleTrace.spans:
+            key = (span.category, span.name)
+            count, ns, written = totals.get(key, (0, 0, 0))
+            totals[key] = (count + 1, ns + span.end_ns - span.start_ns, written + span.attrs["write_bytes"])
+
+        print(f'{"":<8}{"name":<32}{"count":>6}{"total ms":>11}{"written MiB":>13}', file=out)
+        for (category, name), (count, ns, written) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            print(f'{category:<8}{name[:31]:<32}{count:>6}{ns / 1e6:>11.1f}{written / (1024 * 1024):>13.1f}',
+                  file=out)
+
+    @staticmethod
+    def finish(path):
+        with open(path, "w") as f:
+            json.dump(DongleTrace.chrome_trace(), f)
+        DongleTrace.print_summary()
+        print(f"trace written to {path}, open it in chrome://tracing or ui.perfetto.dev", file=sys.stderr)